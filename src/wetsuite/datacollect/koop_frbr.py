@@ -64,49 +64,40 @@ class FRBRFetcher:
         self.count_errors = 0
 
     def uncached_fetch(self, url, retries=3):
-        "Unconditional fetch from an URL"
+        """Unconditional fetch from an URL.
+        download() retries what seems temporary (up to retries attempts in total); if it still times out, we return None.
+        """
         # print("UFETCH", url)
-        while retries > 0:
-            try:
-                self.count_fetches += 1
-                data = wetsuite.helpers.net.download(url)
-                time.sleep(self.waittime_sec)
-                return data
-            except requests.exceptions.Timeout:
-                if self.verbose >= 2:
-                    print(
-                        f"U TRYAGAIN {str(retries)}"
-                    )  # trying again just once 'fixes' most cases
-                retries -= 1
-                time.sleep(max(2, self.waittime_sec))
+        self.count_fetches += 1
+        try:
+            data = wetsuite.helpers.net.download(url, attempts=retries)
+        except requests.exceptions.Timeout:
+            if self.verbose >= 2:
+                print(f"U GAVEUP {url}")
+            return None
+        time.sleep(self.waittime_sec)
+        return data
 
     def cached_folder_fetch(self, url, retries=3):
-        "cache-backed fetch  (from the first one you handed into the constructor)"
-        retries = max(1, retries)
-        while retries > 0:
-            try:
-                bytedata, came_from_cache = wetsuite.helpers.localdata.cached_fetch(
-                    self.cache_store, url
-                )
-                if came_from_cache:
-                    self.count_cacheds += 1
-                    # if self.verbose:
-                    # print("CFETCH_CACHED", url)
-                else:
-                    self.count_fetches += 1
-                    # if self.verbose:
-                    # print("CFETCH_FETCHED", url)
-                    time.sleep(self.waittime_sec)
-                return bytedata
-            except requests.exceptions.Timeout:
-                if self.verbose >= 2:
-                    print(
-                        f"C TRYAGAIN {retries}"
-                    )  # trying again just once 'fixes' most cases
-                retries -= 1
-                time.sleep(1)
-            # except urllib3.exceptions.ReadTimeoutError
-        raise ValueError("Didn't manage to download")
+        """cache-backed fetch  (from the first one you handed into the constructor)
+        @param retries: how many attempts download() gets, in total, when failures seem temporary
+        """
+        try:
+            bytedata, came_from_cache = wetsuite.helpers.localdata.cached_fetch(
+                self.cache_store, url, attempts=retries
+            )
+        except requests.exceptions.Timeout as e:
+            raise ValueError("Didn't manage to download") from e
+        if came_from_cache:
+            self.count_cacheds += 1
+            # if self.verbose:
+            # print("CFETCH_CACHED", url)
+        else:
+            self.count_fetches += 1
+            # if self.verbose:
+            # print("CFETCH_FETCHED", url)
+            time.sleep(self.waittime_sec)
+        return bytedata
 
     def add_page(self, page_url):
         """add an URL to an internal "pages to still look at" set
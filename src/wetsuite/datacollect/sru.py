@@ -16,8 +16,7 @@
 
 import time, sys
 
-import requests
-
+import wetsuite.helpers.net
 import wetsuite.helpers.escape
 import wetsuite.helpers.etree
 
@@ -84,7 +83,7 @@ class SRUBase:
         """
         url = self._url()
         url += "&operation=explain"
-        r = requests.get(url, timeout=timeout)
+        r = wetsuite.helpers.net.session().get(url, timeout=timeout)
 
         if readable:
             tree = wetsuite.helpers.etree.fromstring(r.content)
@@ -110,7 +109,7 @@ class SRUBase:
 
         if self.verbose:
             print(url)
-        r = requests.get(url, timeout=timeout)
+        r = wetsuite.helpers.net.session().get(url, timeout=timeout)
         tree = wetsuite.helpers.etree.fromstring(r.content)
         tree = wetsuite.helpers.etree.strip_namespace(tree)  # easier without namespaces
 
@@ -198,6 +197,11 @@ class SRUBase:
 
         Notes:
           - strips namespaces from the results - makes writing code more convenient
+          - fetches via wetsuite.helpers.net.download(), so timeouts, connection errors, and temporary
+            HTTP errors (408, 429, 500, 502, 503, 504) are retried a few times (see wetsuite.helpers.net.configure_retries()).
+            If the server keeps answering 500, we raise a ValueError;
+            other non-OK statuses (e.g. a 404) raise wetsuite.helpers.net.HTTPStatusError (also a ValueError),
+            rather than us trying to parse the error page.
 
 
         CONSIDER:
@@ -234,21 +238,18 @@ class SRUBase:
         if self.verbose:
             print("[SRU searchRetrieve] fetching %r" % url)
 
+        # download() retries timeouts and such, see wetsuite.helpers.net.configure_retries()
         try:
-            r = requests.get(url, timeout=(20, 20))  # CONSIDER: use general fetcher?
-        except requests.exceptions.ReadTimeout:
-            r = requests.get(
-                url, timeout=(20, 20)
-            )  # TODO: this makes no sense, don't do it
-
-        if r.status_code == 500:
-            raise ValueError(
-                "SRU server reported an Internal Server Error (HTTP status 500) for %r"
-                % url
-            )
-            # raise RuntimeError( "SRU server reported an Internal Server Error (HTTP status 500) for %r"%url )
-
-        tree = wetsuite.helpers.etree.fromstring(r.content)
+            content = wetsuite.helpers.net.download(url, timeout=(20, 20))
+        except wetsuite.helpers.net.HTTPStatusError as e:
+            if e.status_code == 500:
+                raise ValueError(
+                    "SRU server reported an Internal Server Error (HTTP status 500) for %r"
+                    % url
+                ) from e
+            raise
+
+        tree = wetsuite.helpers.etree.fromstring(content)
 
         # easier without namespaces, they serve no disambiguating function in most of these cases anyway
         # TODO: think about that, user code may not expact that
@@ -16,10 +16,10 @@ import os
 import re
 import json
 import time
-import tempfile
-import bz2
+import codecs
+import shutil
+import sqlite3
 import fnmatch
-import lzma  # standard library since py3.3, before that we could fall back to backports.lzma
 import zipfile
 
 import wetsuite.helpers.util
@@ -50,6 +50,9 @@ def fetch_index():
       - C{download_size_human}, real_size_human: more readable version,
         e.g. where C{real_size} might be the integer 397740, C{real_size_human} would be 388KiB
       - C{type}                content type of dataset
+      - C{num_items}           (optional) the amount of items in the data, so that loading it need not count them
+      - C{sha256}              (optional) hex SHA-256 of the file at url, which downloads are checked against
+      - C{blake2b}             (optional) the same, as hex BLAKE2b, which is used if there is no sha256
 
     TODO: an example
 
@@ -122,10 +125,12 @@ class Dataset:
     This just contains its results.
     """
 
-    def __init__(self, description: str, data, name: str = ""):
+    def __init__(self, description: str, data, name: str = "", num_items: int = None):
         """@param description: A description that load() would lift from the underlying data.
         @param data: A reference to the main data, that load() would load from the underlying data.
         @param name: a name that would be printed into str() representation. Usually set by load().
+        @param num_items: the amount of items in data, if known (load() takes it from the index).
+        If not given, we ask len(data), which for some data is slow.
         """
         # for key in self.data:
         #    setattr(self, key, self.data[key])
@@ -133,7 +138,9 @@ class Dataset:
         self.data = data
         self.description = description
         self.name = name
-        self.num_items = len(self.data)  # TODO: don't rely on that being possible.
+        if num_items is None:
+            num_items = len(self.data)  # TODO: don't rely on that being possible.
+        self.num_items = num_items
 
     def __str__(self):
         "String representation that mentions the name and the number of items"
@@ -148,6 +155,9 @@ class Dataset:
         Mostly useful when the dataset actually _does_ store one file (bytes object) per item.
         For other underlying types we might do some conversion, e.g. dict becomes JSON.
         We estimate the file extension it should have.
+
+        When the data is a LocalKV with bytes values, those are streamed (see LocalKV.open_value()),
+        so that large documents are not read into memory whole.
         """
 
         if to_zipfile_path is not None:
@@ -167,14 +177,37 @@ class Dataset:
         if in_dir_path is None and to_zipfile_path is None:
             raise ValueError("Specify either in_dir_path or to_zipfile_path.")
 
+        # values we can stream are fetched below, the rest comes in here
+        streamable = isinstance(
+            self.data, wetsuite.helpers.localdata.LocalKV
+        ) and not isinstance(self.data, wetsuite.helpers.localdata.MsgpackKV)
+        if streamable:
+            items = ((key, None) for key in self.data.iterkeys())
+        else:
+            items = self.data.items()
+
         i = 0
-        for key, value in self.data.items():
+        for key, value in items:
             i += 1
             # if i > 200:
             #    break
 
+            # a streamed value is opened once: we sniff its start, then write that and copy the rest (see below)
+            head, value_f = None, None
+            if streamable:
+                try:
+                    value_f = self.data.open_value(key)
+                    head = value_f.read(50)
+                except TypeError:  # not bytes, so not streamable
+                    value = self.data.get(key)
+
             ## figure out bytes to store,    also estimate decent file extension from the content
-            if isinstance(value, bytes):
+            if head is not None:
+                if b"<?xml" in head:
+                    typ = "xml"
+                else:
+                    typ = "bin"
+            elif isinstance(value, bytes):
                 if b"<?xml" in value[:50]:
                     typ = "xml"
                 else:
@@ -203,32 +236,204 @@ class Dataset:
             )
 
             ## write out
-            if in_dir_path is not None:
-                ffn = os.path.join(in_dir_path, safe_fn)
+            try:
+                ffn = None
+                if in_dir_path is not None:
+                    ffn = os.path.join(in_dir_path, safe_fn)
+
+                    if os.path.exists(ffn):
+                        raise IOError(
+                            "You probably did not mean to overwrite %r, please remove anything existing before retrying. "
+                            % ffn
+                        )
+                    # implied else: either it doesn't exist, or overwrite==True
+
+                    with open(ffn, "wb") as f:
+                        if head is not None:
+                            f.write(head)
+                            shutil.copyfileobj(value_f, f)
+                        else:
+                            f.write(value)
+
+                if to_zipfile_path is not None:
+                    # note: for content you know won't compress well,
+                    # you can save some time with compress_type=zipfile.ZIP_STORED
+                    if head is not None and ffn is not None:  # we already read the value, so take it from that file
+                        zob.write(ffn, safe_fn)
+                    elif head is not None:
+                        with zob.open(safe_fn, "w", force_zip64=True) as zf:
+                            zf.write(head)
+                            shutil.copyfileobj(value_f, zf)
+                    else:
+                        zob.writestr(safe_fn, value)
+            finally:
+                if value_f is not None:
+                    value_f.close()
 
-                if os.path.exists(ffn):
-                    raise IOError(
-                        "You probably did not mean to overwrite %r, please remove anything existing before retrying. "
-                        % ffn
-                    )
-                # implied else: either it doesn't exist, or overwrite==True
+        if to_zipfile_path is not None:
+            zob.close()
 
-                with open(ffn, "wb") as f:
-                    f.write(value)
 
-            if to_zipfile_path is not None:
-                # note: for content you know won't compress well,
-                # you can save some time with compress_type=zipfile.ZIP_STORED
-                zob.writestr(safe_fn, value)
+class _IncrementalJSONReader:
+    """For internal use by _iter_json_dataset(): reads JSON from a (binary) file object a token or value at a time,
+    keeping only a buffer of what it has not yet consumed.
+    """
 
-        if to_zipfile_path is not None:
-            zob.close()
+    def __init__(self, f, read_size: int = 1048576):
+        self.f = f
+        self.read_size = read_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self._utf8 = codecs.getincrementaldecoder("utf8")()
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        "Reads more into the buffer (dropping what was consumed).  Returns False if we were already at the end of the file."
+        if self.eof:
+            return False
+        # read at least as much as we have, so that retrying a large value that spans many reads is not quadratic
+        data = self.f.read(max(self.read_size, len(self.buf) - self.pos))
+        self.eof = len(data) == 0
+        self.buf = self.buf[self.pos :] + self._utf8.decode(data, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        "Returns the next non-whitespace character without consuming it, or '' at the end of the file"
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        "Consumes the next non-whitespace character, which must be one of those given (raises ValueError otherwise), and returns it"
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError("Expected one of %r in the JSON here, found %r" % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        "Consumes and returns the next complete JSON value"
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+                # a number (or true/false/null) that ends where our buffer ends may continue in what we have not read yet
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def _iter_json_dataset(data_path, read_size: int = 1048576):
+    """Reads a JSON dataset file, of the form C{{"description": ..., "data": {key: value, ...}}},
+    a piece at a time, so that unlike json.loads() it needs memory for about one item at a time, not for the whole file.
+
+    Yields (top_key, data_key, value) tuples, in the order they are in the file:
+      - for each item in 'data' (if it is an object): ('data', key, value)
+      - for each other top-level key, e.g. the description: (top_key, None, value)
+    """
+    with open(data_path, "rb") as f:
+        reader = _IncrementalJSONReader(f, read_size=read_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            top_key = reader.value()
+            reader.expect(":")
+            if top_key == "data" and reader.peek() == "{":
+                reader.expect("{")
+                if reader.peek() == "}":
+                    reader.expect("}")
+                else:
+                    while True:
+                        key = reader.value()
+                        reader.expect(":")
+                        yield ("data", key, reader.value())
+                        if reader.expect(",}") == "}":
+                            break
+            else:
+                yield (top_key, None, reader.value())
+            if reader.expect(",}") == "}":
+                break
+
+
+def _convert_json_dataset(data_path, verbose: bool = False):
+    """One-time conversion of a JSON dataset file to a MsgpackKV, which then replaces it (so later loads open that instead).
+    Reads the JSON a piece at a time (see _iter_json_dataset), so this does not need memory for all of it.
+
+    If 'data' is not an object (so not something we can make a store of), we leave the file alone,
+    and return the data as it is.
+
+    @return: (data, description), like _data_from_path()
+    """
+    tmp_path = "%s.converting%d" % (data_path, os.getpid())
+    store = wetsuite.helpers.localdata.MsgpackKV(tmp_path, str, None, commit_every=10000)
+    others = {}
+    converted = 0
+    try:
+        for top_key, key, value in _iter_json_dataset(data_path):
+            if key is None:
+                others[top_key] = value
+            else:
+                store.put(key, value)
+                converted += 1
+                if verbose and converted % 10000 == 0:
+                    print("\rConverting to a store... %d items   " % converted, end="", file=sys.stderr)
+        if verbose:
+            print("", file=sys.stderr)
+
+        if "description" not in others:
+            raise ValueError("This JSON does not have the structure we expect.")
+        if "data" in others:  # not an object
+            store.close()
+            os.unlink(tmp_path)
+            return others["data"], others["description"]
+
+        store._put_meta("description", others["description"])  # pylint: disable=protected-access
+        store.close()
+        os.replace(tmp_path, data_path)
+    except BaseException:
+        store.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    if os.path.exists(_verified_path(data_path)):  # we changed it ourselves, so this is what later loads should expect
+        _record_verified(data_path, "sha256:%s" % wetsuite.helpers.util.hash_file(data_path))
+    return _data_from_path(data_path)
+
+
+def _read_json_dataset(data_path):
+    """Reads a JSON dataset file into memory (a piece at a time, see _iter_json_dataset) - for when we cannot convert it, see _data_from_path().
+    @return: (data, description), like _data_from_path()
+    """
+    data, others = {}, {}
+    for top_key, key, value in _iter_json_dataset(data_path):
+        if key is None:
+            others[top_key] = value
+        else:
+            data[key] = value
+    if "description" not in others:
+        raise ValueError("This JSON does not have the structure we expect.")
+    return others.get("data", data), others["description"]
 
 
-def _data_from_path(data_path):
+def _data_from_path(data_path, verbose: bool = False):
     """Given a path to a data file,
     return the data in python-object form -- and and description (based on contents).
     This wraps opening and dealing with file type, and separates that from the download phase.
+
+    JSON files are converted (once, in place) to a MsgpackKV store, see _convert_json_dataset().
+    If we cannot write there (e.g. a read-only datasets directory), we read the JSON into memory instead,
+    so then data is a dict (which is also what it was before we converted).
     """
     f = open(data_path, "rb")
     first_bytes = f.read(15)
@@ -240,32 +445,34 @@ def _data_from_path(data_path):
         # the type enforcement is irrelevant when opened read-only
         data = wetsuite.helpers.localdata.LocalKV(data_path, None, None, read_only=True)
 
-        ret_description = data._get_meta(
-            "description", missing_as_none=True
-        )  # pylint: disable=protected-access
+        ret_description = data._get_meta("description", missing_as_none=True)  # pylint: disable=protected-access
         # This seems very hackish - TODO: avoid this
-        if (
-            data._get_meta("valtype", missing_as_none=True) == "msgpack"
-        ):  # pylint: disable=protected-access
+        if data._get_meta("valtype", missing_as_none=True) == "msgpack":  # pylint: disable=protected-access
             data.close()
             data = wetsuite.helpers.localdata.MsgpackKV(
                 data_path, None, None, read_only=True
             )
 
+    elif first_bytes.startswith(
+        wetsuite.helpers.localdata.MmapKV._MAGIC  # pylint: disable=protected-access
+    ):
+        f.close()
+        data = wetsuite.helpers.localdata.MmapKV(data_path)
+        ret_description = data._get_meta("description", missing_as_none=True)  # pylint: disable=protected-access
+
     elif first_bytes.strip().startswith(
         b"{"
     ):  # Assume that's a decent indicator of JSON (given that our downloads aren't a lot of different things)
         # expected to be a dict with two main keys, 'data' and 'description'
-        loaded = json.loads(f.read())
         f.close()
 
         # TODO: remove the need for JSON, or at least make this alternative go away
         #       ...by being more consistent in dataset generation
-        if "description" in loaded:
-            data = loaded.get("data")
-            ret_description = loaded.get("description")
-        else:
-            raise ValueError("This JSON does not have the structure we expect.")
+        # Until then, we convert it to a store the first time it is loaded.
+        try:
+            data, ret_description = _convert_json_dataset(data_path, verbose=verbose)
+        except (OSError, sqlite3.Error):  # e.g. not allowed to write next to it
+            data, ret_description = _read_json_dataset(data_path)
     else:
         f.close()
         raise ValueError(
@@ -277,7 +484,7 @@ def _data_from_path(data_path):
 
 
 def _load_bare(
-    dataset_name: str, verbose=None, force_refetch=False, check_free_space=True
+    dataset_name: str, verbose=None, force_refetch=False, check_free_space=True, resume=False
 ):
     """Takes a dataset name (that you learned of from the index),
     Downloads it if necessary - after the first time it's cached in your home directory
@@ -288,6 +495,7 @@ def _load_bare(
     Note: You normally would use load(),
     which takes the same name but gives you a usable object, instead of just a filename.
 
+    @param resume: see load()
     @return: the filename we fetched to
     """
     global _index_data
@@ -302,7 +510,6 @@ def _load_bare(
         raise ValueError("Do not know dataset name %r" % dataset_name)
 
     dir_dict = wetsuite.helpers.util.wetsuite_dir()
-    ws_dir = dir_dict["wetsuite_dir"]
     datasets_dir = dir_dict["datasets_dir"]
 
     ## figure out path in that directory
@@ -316,15 +523,23 @@ def _load_bare(
     # right now the data_path is a single file per dataset, expected to be a JSON file.
     # TODO: decide on whether that is our standard, or needs changing
 
+    # If we have it in our cache, check that it is still what we verified when we downloaded it
+    if not force_refetch and os.path.exists(data_path) and not _check_verified(data_path, verbose=verbose):
+        if verbose:
+            print("Cached copy of %r seems damaged, fetching it again" % dataset_name, file=sys.stderr)
+        force_refetch = True
+
+    decompress = None
+    for extension, kind in ((".xz", "xz"), (".bz2", "bz2"), (".gz", "gz"), (".zst", "zstd")):
+        if data_url.endswith(extension):  # CONSIDER: file magic, e.g. b'\xfd7zXZ\x00\x00'
+            decompress = kind
+
     if check_free_space:
-        ds = dataset_details["download_size"]
-        rs = dataset_details["real_size"]
-        if (
-            ds != rs
-        ):  # assume that we will need to store both the compressed and uncompressed size, if only for a moment
-            needed_space_byteamt = ds + rs
-        else:  # assume ds==rs means it's not compressed, and we download it into place
-            needed_space_byteamt = ds
+        if resume and decompress is not None:
+            # we decompress while downloading, but keep the compressed data until we are done, so that an interrupted download can resume
+            needed_space_byteamt = dataset_details["download_size"] + dataset_details["real_size"]
+        else:  # we decompress while downloading, so only ever store the decompressed data
+            needed_space_byteamt = max(dataset_details["download_size"], dataset_details["real_size"])
         free_space_byteamt = wetsuite.helpers.util.free_space(path=datasets_dir)
         if needed_space_byteamt > free_space_byteamt:
             mebibyte = 1024 * 1024
@@ -342,69 +557,92 @@ def _load_bare(
         if verbose:
             print("Downloading %r to %r" % (data_url, data_path), file=sys.stderr)
 
-        # CONSIDER: using context manager variant if that's cleaner
-        tmp_handle, tmp_path = tempfile.mkstemp(
-            prefix="tmp_dataset_download", dir=ws_dir
-        )
-        os.close(
-            tmp_handle
-        )  # the open file handle is fairly secure, but here we only care about a non-clashing filename
-
-        # download it to that temporary filename
+        # This decompresses as it downloads (if applicable), into a temporary file next to data_path,
+        # which is renamed into place only when complete - so there is never a partial file at data_path.
+        # With resume, if interrupted, the next load() continues where this one left off (see download()'s resume).
+        # The download is checked against the index's Content-Length, and its digest, if it mentions one.
+        # CONSIDER: it may be preferable to store it compressed, and decompress every load. Or at least make this a parameter
         wetsuite.helpers.net.download(
-            data_url, tofile_path=tmp_path, show_progress=verbose
+            data_url,
+            tofile_path=data_path,
+            show_progress=verbose,
+            decompress=decompress,
+            total_size=dataset_details.get("real_size") if decompress is not None else None,
+            resume=resume,
+            checksum=_index_checksum(dataset_details),
         )
 
-        ## if it was compressed, decompress it in the cache -
-        # as part of the download, not the load compressed into its fina place.
-        # There is a race condition in multiple loads() of the same thing. CONSIDER: fixing that via a second temporary file
-        # CONSIDER: it may be preferable to store it compressed, and decompress every load. Or at least make this a parameter
-        def decompress_stream(instream, outstream):
-            # TODO: allowing a "we know the output size" argument to decompress_stream so we can show a percentage
-            uncompressed_data_bytes = 0
-            while True:
-                data = instream.read(2 * 1048576)
-                if len(data) == 0:
-                    break
-                outstream.write(data)
-                uncompressed_data_bytes += len(data)
-                if verbose:
-                    print(
-                        "\rDecompressing... %3sB    "
-                        % (
-                            wetsuite.helpers.format.kmgtp(
-                                uncompressed_data_bytes, kilo=1024
-                            ),
-                        ),
-                        end="",
-                        file=sys.stderr,
-                    )
+        # Remember the digest of what we stored, so that later loads can tell whether it changed since.
+        # Without decompression that is the digest that download() just checked; otherwise we need a pass over the file.
+        checksum = _index_checksum(dataset_details)
+        if checksum is None or decompress is not None:
+            algorithm = "sha256" if checksum is None else checksum.split(":", 1)[0]
             if verbose:
-                print("", file=sys.stderr)
+                print("Hashing %r" % data_path, file=sys.stderr)
+            checksum = "%s:%s" % (algorithm, wetsuite.helpers.util.hash_file(data_path, algorithm))
+        _record_verified(data_path, checksum)
 
-        if data_url.endswith(".xz"):  # or file magic, b'\xfd7zXZ\x00\x00'
-            with lzma.open(tmp_path) as compressed_file_object:
-                with open(data_path, "wb") as write_file_object:
-                    decompress_stream(compressed_file_object, write_file_object)
-            os.unlink(tmp_path)
+    return data_path
 
-        elif data_url.endswith(".bz2"):
-            # print('Decompressing...', file=sys.stderr)
-            with bz2.BZ2File(tmp_path, "rb") as compressed_file_object:
-                with open(data_path, "wb") as write_file_object:
-                    decompress_stream(compressed_file_object, write_file_object)
-            print("  done.", file=sys.stderr)
-            os.unlink(tmp_path)
 
-        # CONSIDER: add gz and zip cases, because they're standard library anyway
+def _index_checksum(dataset_details: dict):
+    """For internal use: the digest that the index mentions for a dataset's download,
+    in the 'algorithm:hexdigest' form that download()'s checksum takes, or None if it mentions none.
+    """
+    for algorithm in ("sha256", "blake2b"):
+        if dataset_details.get(algorithm):
+            return "%s:%s" % (algorithm, dataset_details[algorithm].lower())
+    return None
 
-        else:  # assume it was uncompressed, just move it into place
-            os.rename(tmp_path, data_path)
 
-    return data_path
+def _verified_path(data_path: str):
+    "For internal use: where we record the digest of a cached dataset file"
+    return data_path + ".verified.json"
+
+
+def _record_verified(data_path: str, checksum: str):
+    """For internal use: record the digest of a cached dataset file (as 'algorithm:hexdigest'),
+    along with the size and modification time it had, so that _check_verified() can skip hashing when neither changed.
+    """
+    stat = os.stat(data_path)
+    with open(_verified_path(data_path), "w", encoding="utf8") as f:
+        json.dump({"checksum": checksum, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, f)
 
 
-def load(dataset_name: str, verbose=None, force_refetch=False, check_free_space=True):
+def _check_verified(data_path: str, verbose=False) -> bool:
+    """For internal use: is a cached dataset file still what we recorded when we downloaded it?
+
+    If its size and modification time are as recorded, we assume so, without reading it.
+    If not, we hash it again, and compare with the recorded digest (and if it matches, record the new modification time).
+
+    Files cached before we started recording digests have no record; we hash them and record that (so trust them this once).
+
+    @return: False if the contents changed, True otherwise.
+    """
+    stat = os.stat(data_path)
+    try:
+        with open(_verified_path(data_path), encoding="utf8") as f:
+            record = json.load(f)
+        algorithm, digest = record["checksum"].split(":", 1)
+    except (OSError, ValueError, KeyError, AttributeError):
+        record = None
+        algorithm, digest = "sha256", None
+
+    if record is not None and record.get("size") == stat.st_size and record.get("mtime_ns") == stat.st_mtime_ns:
+        return True
+    if record is not None and record.get("size") != stat.st_size:
+        return False  # (no need to hash to know that it changed)
+
+    if verbose:
+        print("Checking %r" % data_path, file=sys.stderr)
+    current_digest = wetsuite.helpers.util.hash_file(data_path, algorithm)
+    if digest is not None and current_digest != digest:
+        return False
+    _record_verified(data_path, "%s:%s" % (algorithm, current_digest))
+    return True
+
+
+def load(dataset_name: str, verbose=None, force_refetch=False, check_free_space=True, resume=False):
     """Takes a dataset name (that you learned of from the index),
     downloads it if necessary - after the first time it's cached in your home directory
 
@@ -420,11 +658,22 @@ def load(dataset_name: str, verbose=None, force_refetch=False, check_free_space=
     @param force_refetch: whether to remove the current contents before fetching
     dataset naming should prevent the need for this (except if you're the wetsuite programmer)
 
+    @param resume: whether to keep what we downloaded when the download is interrupted,
+    so that calling load() again continues where it left off, instead of starting over.
+    For compressed datasets this keeps the compressed data until the download is done,
+    so it needs disk space for both that and the decompressed data. Without it (the default) we need only the latter.
+
     @return: a Dataset object - which is a container object with little more than
       - a C{.description} (a string)
       - a C{.data} member, some kind of iterable of items.
         The .description should mention what .data will contain
         and should give an example of how to use it.
+
+    Note that datasets that are distributed as JSON are converted to a store the first time you load them
+    (so that later loads need not read all of it into memory), so their .data is a read-only MsgpackKV, not a dict:
+    you can still get items, iterate over keys/values/items, and ask its len(), but not assign into it,
+    and you may want to dict() it before e.g. json.dumps().
+    (If that conversion is not possible, e.g. because the datasets directory is read-only, .data is a dict as before)
     """
     # CONSIDER: have load('datasetname-*') automatically merge_datasets,
     # one for each matched datasets, with an attribute named for the last bit of the dataset name.
@@ -456,10 +705,16 @@ def load(dataset_name: str, verbose=None, force_refetch=False, check_free_space=
             verbose=verbose,
             force_refetch=force_refetch,
             check_free_space=check_free_space,
+            resume=resume,
         )
-        data, description = _data_from_path(data_path)
+        data, description = _data_from_path(data_path, verbose=verbose)
         # data_path = _load_bare( dataset_name=dataname_matches[0] )
-        return Dataset(data=data, description=description, name=dataname_matches[0])
+        return Dataset(
+            data=data,
+            description=description,
+            name=dataname_matches[0],
+            num_items=_index_data[dataname_matches[0]].get("num_items"),
+        )
 
     else:  # implied  >=1
         raise ValueError(
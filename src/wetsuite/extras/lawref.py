@@ -12,9 +12,9 @@ and to steal fragments of code for if you want to refine its functionality.
 
 """
 
-import requests
 import bs4
 
+import wetsuite.helpers.net
 import wetsuite.helpers.localdata
 
 
@@ -52,7 +52,7 @@ def resolve_deeplink_bwbid(url, use_cache=True):
         return retval
     else:
         #print("FETCHING %r"%url)
-        resp = requests.get(url, allow_redirects=True, timeout=60)  # this redirect service can be SLOW
+        resp = wetsuite.helpers.net.session().get(url, allow_redirects=True, timeout=60)  # this redirect service can be SLOW
         # we can record the URL it sent us to, which can help resolve article references too
         _deeplink_resolved_redirections.put( url, resp.url ) # TODO: double check that this we understand this and resp.history
 
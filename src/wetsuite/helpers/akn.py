@@ -8,8 +8,6 @@
 
 # import re
 
-import requests
-
 import wetsuite.helpers.net
 import wetsuite.helpers.etree
 import wetsuite.helpers.localdata
@@ -47,7 +45,7 @@ def resolve(akn, timeout=10):
         raise ValueError("The AKN should start with /akn/nl")
 
     # CONSIDER: think about escaping against injection issues
-    resp = requests.get(
+    resp = wetsuite.helpers.net.session().get(
         "https://identifier.overheid.nl/" + akn.lstrip("/"),
         allow_redirects=True,
         timeout=timeout,
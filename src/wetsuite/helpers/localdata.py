@@ -10,16 +10,34 @@ This is used e.g. by various data collection, and by distributed datasets.
 
 There are a lot of general notes in LocalKV's docstring (and a lot of it also applies to MsgpackKV)
 
-CONSIDER: writing a ExpiringLocalKV that cleans up old entries
+For stores too large to comfortably be a single file, see ShardedLocalKV.
+
+For caches whose entries should go stale after a while, see ExpiringLocalKV.
+
+For fetching URLs into a store, see cached_fetch(), and for many of them at a time, cached_fetch_many().
+(with an ExpiringLocalKV, those refresh what they have with conditional requests, see revalidation_counts())
+
+For distributing and reading large read-only datasets, see MmapKV (and write_mmapkv() to make one from a store).
+
 CONSIDER: writing variants that do convert specific data, letting you e.g. set/fetch dicts, or anything else you could pickle
 """
 
 import os
 import os.path
+import io
+import re
+import json
+import mmap
+import struct
 import time
 import pathlib
 import random
 import collections.abc
+import concurrent.futures
+import itertools
+import bisect
+import functools
+import zlib
 from typing import Tuple
 
 import sqlite3
@@ -58,6 +76,17 @@ class LocalKV:
         use put() with commit=False, and
         do an explicit commit() afterwards
         ...BUT if a script borks in the middle of something uncommited, you will need to do manual cleanup.
+        If you already have a batch of items (or keys) in hand, put_many(), get_many() and delete_many()
+        do that in a single transaction for you, and are faster still.
+        If you don't, but do a long series of writes (e.g. crawling), consider the commit_every / commit_interval
+        constructor arguments, which make the store batch writes into transactions for you.
+
+      - If you get() the same keys a lot, consider the cache_items / cache_bytes constructor arguments,
+        which keep recently used (decoded) values around in this process.
+
+      - Stores of bytes values (e.g. fetched XML/HTML, and MsgpackKV) can be compressed, see the compression constructor argument.
+        Like MsgpackKV's valtype, this is recorded in the meta table, so later opens (including those in wetsuite.datasets)
+        decompress transparently without you having to say so again.
 
       - On typing:
           - SQLite will just store what it gets, which makes it easy to store mixed types.
@@ -89,7 +118,10 @@ class LocalKV:
         So
           - when you leave a writer with uncommited data for nontrivial amounts of time, readers are likely to time out
             - If you leave it on autocommit this should be a little rarer
-          - and a very slow read through the database might time out a write.
+          - and a very slow read through the database might time out a write
+            (see the page_size argument on iterkeys(), itervalues() and iteritems() to avoid that).
+        If you have a writer (e.g. a crawler) and readers (e.g. a notebook) on the same store at the same time,
+        consider use_wal=True, which lets readers continue while one writer is active (see the constructor).
 
       - It wouldn't be hard to also make it act largely like a dict,
         implementing __getitem__, __setitem__, and __delitem__
@@ -122,7 +154,26 @@ class LocalKV:
     @ivar read_only: whether we have told ourselves to treat this as read-only
     """
 
-    def __init__(self, path, key_type, value_type, read_only=False):
+    def __init__(
+        self,
+        path,
+        key_type,
+        value_type,
+        read_only=False,
+        use_wal=False,
+        busy_timeout=None,
+        mmap_size=None,
+        commit_every=None,
+        commit_interval=None,
+        compression=None,
+        compression_level=None,
+        cache_items=None,
+        cache_bytes=None,
+        vacuum_every=None,
+        vacuum_pages=1000,
+        vacuum_min_waste=0,
+        vacuum_on_close=False,
+    ):
         """Specify the path to the database file to open.
 
         key_type and value_type do not have defaults,
@@ -136,6 +187,49 @@ class LocalKV:
         @param key_type:
         @param value_type:
         @param read_only: is only enforced in this wrapper to give slightly more useful errors. (we also give SQLite a PRAGMA)
+
+        @param use_wal: if True, switch the database to write-ahead logging, and use synchronous=NORMAL with it.
+        This lets readers keep reading while a writer is active (a writer still excludes other writers),
+        and makes commits cheaper.
+        Notes:
+          - this persists in the database file, so later opens will use WAL even if they don't ask for it
+          - it needs shared memory between processes, so does not work on network filesystems
+          - it is ignored for ':memory:' and when read_only
+        @param busy_timeout: how many seconds a statement waits on a lock held by someone else before it fails with "database is locked".
+        None means the default, which is the open timeout (3 seconds).
+        @param mmap_size: if given, the amount of bytes of the database file that SQLite may access via memory mapping,
+        which can make reads of large stores faster (and share pages between processes via the OS page cache).
+
+        @param commit_every: if given, a commit policy: writes that do not say otherwise (commit=None, the default)
+        are collected in a transaction that is committed after this many written rows...
+        @param commit_interval: ...and/or once the oldest uncommitted write is this many seconds old, whichever comes first.
+        This is only checked when you write, so also see close(), which commits what is still pending when you have a policy.
+        Without either (the default), every write is committed individually, as before.
+
+        @param compression: None, 'zlib', or 'zstd' (the latter needs the zstandard module installed).
+        Compresses each value on put(), and decompresses transparently in get() and iteration.
+        Only for stores of bytes values (which includes MsgpackKV).
+        This is recorded in the store, so you only need to say this when creating it
+        (and it can only be enabled on a new/empty store). Also see train_compression_dictionary().
+        @param compression_level: the compression level handed to zlib/zstd; None means their default.
+
+        @param cache_items: if given, keep up to this many recently used values in memory, so that get()ting them again
+        costs neither a query nor decoding (decompression, and for MsgpackKV, unpacking). See also cache_info().
+        @param cache_bytes: like cache_items, but a budget of (approximately) this many bytes of values.
+        You can give both.
+        Notes:
+          - Our own put(), delete() and such keep the cache correct, but we cannot know about writes from other processes,
+            so this makes most sense for stores that only this process writes to, or that do not change (e.g. datasets).
+          - you get the same object every time, so if it is mutable (e.g. a dict from a MsgpackKV), do not alter it.
+
+        @param vacuum_every: if given, a space reclamation policy: after this many written rows (puts and deletes),
+        at the next commit, we check estimate_waste() and, if it is at least vacuum_min_waste bytes,
+        do an incremental_vacuum() of at most vacuum_pages pages.
+        This keeps stores that see a lot of replacing and deleting (e.g. caches) from growing without bound,
+        in small steps, rather than needing an occasional vacuum() that rewrites the whole file.
+        @param vacuum_pages: the page budget of each such step (pages are typically 4KB), to bound how long one takes.
+        @param vacuum_min_waste: only bother when there are at least this many bytes to reclaim.
+        @param vacuum_on_close: whether close() should also do such a step.
         """
         self.path = path
         self.path = resolve_path(
@@ -143,8 +237,17 @@ class LocalKV:
         )  # tries to centralize the absolute/relative path handling code logic
 
         self.read_only = read_only
-        # self.use_wal = use_wal
-
+        self.use_wal = use_wal
+        self.busy_timeout = busy_timeout
+        self.mmap_size = mmap_size
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.vacuum_every = vacuum_every
+        self.vacuum_pages = vacuum_pages
+        self.vacuum_min_waste = vacuum_min_waste
+        self.vacuum_on_close = vacuum_on_close
+
+        self._item_count_maintained = False  # (set by _setup_item_count(), which _open() calls)
         self._open()
         # here in part to remind us that we _could_ be using converters  https://docs.python.org/3/library/sqlite3.html#sqlite3-converters
         if key_type not in (str, bytes, int, None):
@@ -162,6 +265,20 @@ class LocalKV:
         self.value_type = value_type
 
         self._in_transaction = False
+        self._transaction_started = None
+        self._uncommitted_writes = 0
+        self._writes_since_vacuum = 0
+
+        # (set by _setup_compression() and _make_codec())
+        self.compression = None
+        self.compression_level = None
+        self._compression_dict = None
+        self._zstd_compressor, self._zstd_decompressor = None, None
+        self._setup_compression(compression, compression_level)
+
+        self._cache = None
+        if cache_items is not None or cache_bytes is not None:
+            self._cache = _LRUCache(max_items=cache_items, max_bytes=cache_bytes)
 
     def _open(self, timeout=3.0):
         """Open the path previously set by init.
@@ -169,7 +286,7 @@ class LocalKV:
 
         timeout: how long wait on opening.
         Lowered from the default just to avoid a lot of waiting half a minte when it was usually just accidentally left locked.
-        (note that this is different from busy_timeout)
+        (python's sqlite3 implements this as a busy timeout; the busy_timeout constructor argument replaces it once we are open)
         """
         # make_tables = (self.path==':memory:')  or  ( not os.path.exists( self.path ) )
         #    will be creating that file, or are using an in-memory database ?  Also how to combine with read_only?
@@ -182,7 +299,9 @@ class LocalKV:
                 )  # https://www.sqlite.org/pragma.html#pragma_query_only
                 # if read-only, we assume you are opening something that was aleady created before, so we don't do...
             else:
-                # TODO: see that the auto_vacuum pragma does what I think it does    https://www.sqlite.org/pragma.html#pragma_auto_vacuum
+                # This only takes effect when the file is new (before the tables are created), or at the next vacuum(),
+                # so stores created without it are converted by doing one vacuum().  See also incremental_vacuum().
+                # https://www.sqlite.org/pragma.html#pragma_auto_vacuum
                 self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
 
                 self.conn.execute(
@@ -192,12 +311,210 @@ class LocalKV:
                     "CREATE TABLE IF NOT EXISTS kv   (key text unique NOT NULL, value text)"
                 )
 
-                # if self.use_wal:
-                #     self.conn.execute("pragma journal_mode=WAL")
-                #     # notes
-                #     # - if not possible (we know we can't get the necessary shm due to the VFS) this is effectively just ignroed
-                #     # - using use_wal once persists with a database, in that future opens will use it even if you don't ask for it
-                #     # - WAL requires sqlite >=3.7.0, but this seems fine because python's sqlite3 requires >=3.7.15
+                if self.use_wal:
+                    self.conn.execute("PRAGMA journal_mode=WAL")
+                    # notes
+                    # - if not possible (we know we can't get the necessary shm due to the VFS) this is effectively just ignored
+                    # - using use_wal once persists with a database, in that future opens will use it even if you don't ask for it
+                    # - WAL requires sqlite >=3.7.0, but this seems fine because python's sqlite3 requires >=3.7.15
+                    # - in WAL mode, NORMAL is still safe against corruption; a power loss may only lose the last few commits
+                    self.conn.execute("PRAGMA synchronous=NORMAL")
+
+            # these are per-connection, so apply regardless of read_only
+            if self.busy_timeout is not None:
+                self.conn.execute(
+                    "PRAGMA busy_timeout = %d" % int(self.busy_timeout * 1000)
+                )
+            if self.mmap_size is not None:
+                self.conn.execute("PRAGMA mmap_size = %d" % int(self.mmap_size))
+
+        self._setup_item_count()
+
+    def _setup_item_count(self):
+        """For internal use: makes len() cheap, by having SQLite triggers keep an item count in the meta table.
+
+        Since the triggers live in the database file, the count stays correct no matter who writes
+        (also older versions of this code, or you with the sqlite3 command line tool),
+        and since they are part of each write's transaction, it is never stale.
+
+        Stores created before we did this get the triggers, and a one-time COUNT, the first time they are opened writeable.
+        Stores without them (e.g. when opened read-only) fall back to counting in len().
+        """
+        trigger_names = set(
+            row[0]
+            for row in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='trigger' AND name IN ('kv_count_insert', 'kv_count_delete')"
+            )
+        )
+        if len(trigger_names) < 2 and not self.read_only:
+            self.conn.execute("BEGIN IMMEDIATE")  # so that no one writes between our counting and the triggers existing
+            try:
+                self.conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS kv_count_insert AFTER INSERT ON kv BEGIN "
+                    "  UPDATE meta SET value = value + 1 WHERE key = 'num_items'; END"
+                )
+                self.conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS kv_count_delete AFTER DELETE ON kv BEGIN "
+                    "  UPDATE meta SET value = value - 1 WHERE key = 'num_items'; END"
+                )
+                # (the WHERE true is needed to avoid a parsing ambiguity between a SELECT's join and an upsert's ON)
+                self.conn.execute(
+                    "INSERT INTO meta (key, value) SELECT 'num_items', COUNT(*) FROM kv WHERE true  ON CONFLICT (key) DO UPDATE SET value=excluded.value"
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            trigger_names = {"kv_count_insert", "kv_count_delete"}
+        self._item_count_maintained = len(trigger_names) == 2
+
+    # First byte of each stored value in a compressed store, saying how the rest of it is stored.
+    # (per value rather than per store, so that e.g. values from before a dictionary was trained stay readable)
+    _VALUE_RAW = b"\x00"  # too small, or did not compress
+    _VALUE_ZLIB = b"\x01"
+    _VALUE_ZLIB_DICT = b"\x02"
+    _VALUE_ZSTD = b"\x03"
+    _VALUE_ZSTD_DICT = b"\x04"
+    _COMPRESS_MIN_SIZE = 64
+
+    def _setup_compression(self, compression, compression_level):
+        """For internal use: figure out whether this store compresses values, checking what you asked for against what the meta table says.
+        Called by the constructor.
+        """
+        if compression not in (None, "zlib", "zstd"):
+            raise ValueError(
+                "compression should be None, 'zlib', or 'zstd', not %r" % compression
+            )
+        try:
+            stored_compression = self._get_meta("compression", missing_as_none=True)
+        except sqlite3.OperationalError:  # no meta table, e.g. read-only on something we never created
+            stored_compression = None
+        if compression is None:
+            compression = stored_compression
+        elif stored_compression is None:
+            if self.value_type not in (bytes, None):
+                raise TypeError(
+                    "compression only applies to bytes values, not %s"
+                    % self.value_type.__name__
+                )
+            if len(self) > 0:
+                raise ValueError(
+                    "Cannot enable compression on a store that already has %d uncompressed values - consider creating a new store and put_many()ing into that"
+                    % len(self)
+                )
+            self._put_meta("compression", compression)
+        elif compression != stored_compression:
+            raise ValueError(
+                "This store was created with compression=%r, you asked for %r"
+                % (stored_compression, compression)
+            )
+
+        self.compression = compression
+        self.compression_level = compression_level
+        self._compression_dict = None
+        if compression is not None:
+            self._compression_dict = self._get_meta(
+                "compression_dict", missing_as_none=True
+            )
+        self._make_codec()
+
+    def _make_codec(self):
+        "For internal use: (re)creates the zstd (de)compressor objects, which are worth keeping around, particularly with a dictionary"
+        self._zstd_compressor, self._zstd_decompressor = None, None
+        if self.compression == "zstd":
+            import zstandard  # if this fails, you may need a    pip install zstandard
+
+            dict_data = None
+            if self._compression_dict is not None:
+                dict_data = zstandard.ZstdCompressionDict(self._compression_dict)
+            level = 3 if self.compression_level is None else self.compression_level
+            self._zstd_compressor = zstandard.ZstdCompressor(
+                level=level, dict_data=dict_data
+            )
+            self._zstd_decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def _encode_value(self, value):
+        "For internal use: value as we hand it to SQLite - that is, compressed if this store does that, otherwise as-is"
+        if self.compression is None:
+            return value
+        if not isinstance(value, bytes):
+            raise TypeError(
+                "A compressed store only takes bytes values, not %s" % type(value).__name__
+            )
+        if len(value) < self._COMPRESS_MIN_SIZE:
+            return self._VALUE_RAW + value
+
+        if self.compression == "zlib":
+            level = -1 if self.compression_level is None else self.compression_level
+            if self._compression_dict is not None:
+                compressor = zlib.compressobj(level, zdict=self._compression_dict)
+                header, data = self._VALUE_ZLIB_DICT, compressor.compress(value) + compressor.flush()
+            else:
+                header, data = self._VALUE_ZLIB, zlib.compress(value, level)
+        else:
+            header = self._VALUE_ZSTD if self._compression_dict is None else self._VALUE_ZSTD_DICT
+            data = self._zstd_compressor.compress(value)
+
+        if len(data) >= len(value):
+            return self._VALUE_RAW + value
+        return header + data
+
+    def _decode_value(self, stored):
+        "For internal use: the reverse of _encode_value()"
+        if self.compression is None or stored is None:
+            return stored
+        header, data = stored[:1], memoryview(stored)[1:]
+        if header == self._VALUE_RAW:
+            return bytes(data)
+        elif header == self._VALUE_ZLIB:
+            return zlib.decompress(data)
+        elif header == self._VALUE_ZLIB_DICT:
+            decompressor = zlib.decompressobj(zdict=self._compression_dict)
+            return decompressor.decompress(data) + decompressor.flush()
+        elif header in (self._VALUE_ZSTD, self._VALUE_ZSTD_DICT):
+            if self._zstd_decompressor is None:
+                raise ValueError("Value was compressed with zstd, but this store is not set up for it")
+            return self._zstd_decompressor.decompress(data)
+        else:
+            raise ValueError("Do not know how to decompress value with header %r" % header)
+
+    def train_compression_dictionary(self, sample_amount: int = 2000, dict_size: int = 112640):
+        """Trains a compression dictionary on a random sample of the values currently in the store,
+        and uses it for values you put() from now on.
+
+        For stores of many smallish, similar values (e.g. XML documents with the same schema)
+        this can compress quite a bit better than compressing each value on its own,
+        because the shared markup no longer has to be in each compressed value.
+
+        The dictionary is stored in the meta table. Values stored before this stay readable (each value says how it was stored).
+        You can do this only once per store, because replacing it would make the values that used it unreadable.
+
+        For zstd this uses its dictionary training; zlib has no such thing,
+        so we use the starts of the sampled values as its (at most 32KB) preset dictionary.
+
+        @param sample_amount: how many values to train on.
+        @param dict_size: the size of dictionary zstd should aim for.
+        """
+        if self.compression is None:
+            raise ValueError("This store does not use compression, so has no use for a dictionary")
+        if self._compression_dict is not None:
+            raise ValueError("This store already has a compression dictionary")
+
+        # (the values as they go into compression, so e.g. still msgpacked for MsgpackKV)
+        samples = list(
+            self._decode_value(row[0])
+            for row in self._rows_by_rowid(self._random_rowids(sample_amount), "value")
+        )
+        if self.compression == "zstd":
+            import zstandard  # if this fails, you may need a    pip install zstandard
+
+            dict_data = zstandard.train_dictionary(dict_size, samples).as_bytes()
+        else:  # zlib looks back at most 32KB, and matches towards the end of the dictionary are cheapest
+            dict_data = b"".join(sample[:1024] for sample in samples)[-32768:]
+
+        self._put_meta("compression_dict", dict_data)
+        self._compression_dict = dict_data
+        self._make_codec()
 
     def _checktype_key(self, val):
         "checks a value according to the key_type you handed into the constructor"
@@ -224,6 +541,11 @@ class LocalKV:
         (this is unlike a dict.get, which has a default=None)
         """
         self._checktype_key(key)
+        if self._cache is not None:
+            found, value = self._cache.get(key)
+            if found:
+                return value
+
         curs = self.conn.cursor()
         curs.execute("SELECT value FROM kv WHERE key=?", (key,))
         row = curs.fetchone()
@@ -233,9 +555,91 @@ class LocalKV:
             else:
                 raise KeyError("Key %r not found" % key)
         else:
-            return row[0]
+            return self._unpack_and_cache(key, self._decode_value(row[0]))
+
+    def _unpack_value(self, value):
+        "For internal use: turns a stored (and decompressed) value into what get() hands you.  Here that's the value itself, MsgpackKV unpacks it."
+        return value
+
+    def _unpack_and_cache(self, key, value):
+        "For internal use: _unpack_value(), and remember the result if we have a cache"
+        unpacked = self._unpack_value(value)
+        if self._cache is not None:
+            size = len(value) if isinstance(value, (bytes, str)) else 8
+            self._cache.put(key, unpacked, size)
+        return unpacked
+
+    def cache_info(self):
+        """If you enabled the cache (see the constructor), reports how well it is doing.
+        @return: None if there is no cache, otherwise a dict like::
+            {'hits': 9120, 'misses': 880, 'hit_rate': 0.912,
+             'items': 880, 'bytes': 2153312, 'max_items': 1000, 'max_bytes': None}
+        """
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def open_value(self, key, chunk_size: int = 1048576):
+        """Opens the value for a key as a read-only binary file object, so that you can read it a piece at a time
+        (e.g. shutil.copyfileobj() it to a file or socket) instead of get()ting it into memory whole
+        - which matters for values of dozens or hundreds of megabytes, such as PDFs.
+
+        For example: ::
+            with store.open_value(url) as f, open('doc.pdf', 'wb') as out:
+                shutil.copyfileobj(f, out)
+
+        On python 3.11 and later this reads from the database file as you go (via sqlite3's blobopen).
+        Before that, it falls back to fetching the value whole into a BytesIO (so it works, but saves no memory).
+        In a compressed store, values are decompressed as you read.
+
+        Notes:
+          - only for bytes values (and not for MsgpackKV, where the stored bytes are not what get() gives you)
+          - the file object is only valid as long as that value is not changed or deleted; reading after that raises an error
+          - close it when you are done (or use it in a with statement, as above)
+
+        @param key: the key whose value to open. Raises KeyError if not present.
+        @param chunk_size: how much to read from the database (or to decompress) at a time.
+        @return: a file object, which you can read() (and, if uncompressed, seek())
+        """
+        if type(self)._unpack_value is not LocalKV._unpack_value:
+            raise TypeError(
+                "open_value() gives the stored bytes, which for a %s are not what get() gives you"
+                % type(self).__name__
+            )
+        row = self.conn.execute("SELECT rowid, typeof(value) FROM kv WHERE key=?", (key,)).fetchone()
+        if row is None:
+            raise KeyError("Key %r not found" % key)
+        rowid, value_sqltype = row
+        if value_sqltype != "blob":
+            raise TypeError(
+                "open_value() only works on bytes values, the value for %r is a %s" % (key, value_sqltype)
+            )
+
+        if not hasattr(self.conn, "blobopen"):  # before python 3.11
+            stored = self.conn.execute("SELECT value FROM kv WHERE rowid=?", (rowid,)).fetchone()[0]
+            return io.BytesIO(self._decode_value(stored))
+
+        blob = self.conn.blobopen("kv", "value", rowid, readonly=True)
+        if self.compression is None:
+            return io.BufferedReader(_BlobReader(blob), buffer_size=chunk_size)
+
+        header = blob.read(1)
+        raw = _BlobReader(blob, start=1)
+        if header == self._VALUE_RAW:
+            return io.BufferedReader(raw, buffer_size=chunk_size)
+        elif header in (self._VALUE_ZLIB, self._VALUE_ZLIB_DICT):
+            zdict = self._compression_dict if header == self._VALUE_ZLIB_DICT else None
+            return io.BufferedReader(_ZlibReader(raw, zdict=zdict, read_size=chunk_size), buffer_size=chunk_size)
+        elif header in (self._VALUE_ZSTD, self._VALUE_ZSTD_DICT):
+            if self._zstd_decompressor is None:
+                raw.close()
+                raise ValueError("Value was compressed with zstd, but this store is not set up for it")
+            return self._zstd_decompressor.stream_reader(raw, read_size=chunk_size)
+        else:
+            raw.close()
+            raise ValueError("Do not know how to decompress value with header %r" % header)
 
-    def put(self, key, value, commit: bool = True):
+    def put(self, key, value, commit: bool = None):
         """Sets/updates value for a key.
 
         Types will be checked according to what you inited this class with.
@@ -243,7 +647,8 @@ class LocalKV:
         commit=False lets us do bulk commits, mostly when you want to a load of small changes without becoming IOPS bound.
         If you care less about speed, and/or more about parallel access, you can ignore this.
 
-        CONSIDER: making commit take an integer as well, meaning 'commit every X operations'
+        commit=None (the default) means 'follow the store's commit policy' (see commit_every and commit_interval in the constructor),
+        which without a policy means commit immediately, same as commit=True.
         """
         if self.read_only:
             raise RuntimeError(
@@ -253,22 +658,25 @@ class LocalKV:
         self._checktype_key(key)
         self._checktype_value(value)
 
-        curs = self.conn.cursor()
-        if not commit and not self._in_transaction:
-            curs.execute("BEGIN")
-            self._in_transaction = True
+        value = self._encode_value(value)
+        if self._cache is not None:
+            self._cache.discard(key)
 
+        commit_now = self._begin_write(commit)
+        curs = self.conn.cursor()
         curs.execute(
             "INSERT INTO kv (key, value) VALUES (?, ?)  ON CONFLICT (key) DO UPDATE SET value=?",
             (key, value, value),
         )
-        if commit:
-            self.commit()
+        self._end_write(commit, commit_now)
 
-    def delete(self, key, commit: bool = True):
+    def delete(self, key, commit: bool = None):
         """delete item by key.
 
-        Note that you should not expect the file to shrink until you do a vacuum()  (which will need to rewrite the file).
+        commit works as in put().
+
+        Note that you should not expect the file to shrink until you do a vacuum()  (which will need to rewrite the file),
+        or an incremental_vacuum()  (see also the vacuum_every policy in the constructor).
         """
         if self.read_only:
             raise RuntimeError(
@@ -276,14 +684,213 @@ class LocalKV:
             )
 
         self._checktype_key(key)
+        if self._cache is not None:
+            self._cache.discard(key)
 
-        curs = self.conn.cursor()  # TODO: check that's correct when commit==False
-        if not commit and not self._in_transaction:
-            curs.execute("BEGIN")
-            self._in_transaction = True
+        commit_now = self._begin_write(commit)
+        curs = self.conn.cursor()
         curs.execute("DELETE FROM kv where key=?", (key,))
-        if commit:
+        self._end_write(commit, commit_now)
+
+    def _commit_policy_now(self, commit) -> bool:
+        "For internal use: resolve a commit argument to whether to commit right after the write (None follows the commit policy)"
+        if commit is None:
+            return self.commit_every is None and self.commit_interval is None
+        return bool(commit)
+
+    def _begin_write(self, commit) -> bool:
+        """For internal use: called before a write, with the commit argument that was handed to put(), delete(), and such.
+
+        Starts a transaction if the write should not be committed immediately and we are not already in one.
+        @return: whether to commit right after the write
+        """
+        commit_now = self._commit_policy_now(commit)
+        if not commit_now and not self._in_transaction:
+            self.conn.execute("BEGIN")
+            self._in_transaction = True
+            self._transaction_started = time.time()
+        return commit_now
+
+    def _end_write(self, commit, commit_now: bool, amount: int = 1):
+        """For internal use: called after a write, with the commit argument as handed in, and what _begin_write() returned.
+
+        Commits if asked to, or if commit=None and the commit policy says it is time.
+        @param amount: how many rows the write touched, which counts towards commit_every (and vacuum_every)
+        """
+        self._writes_since_vacuum += amount
+        if commit_now:
             self.commit()
+        elif commit is None:
+            self._uncommitted_writes += amount
+            if (
+                self.commit_every is not None
+                and self._uncommitted_writes >= self.commit_every
+            ) or (
+                self.commit_interval is not None
+                and time.time() - self._transaction_started >= self.commit_interval
+            ):
+                self.commit()
+
+    def get_many(self, keys, missing_as_none: bool = False, chunk_size: int = 500):
+        """Gets values for many keys at once.
+
+        Is faster than calling get() for each key, in that it asks for a chunk of keys at a time
+        (via C{WHERE key IN (...)}) rather than doing a query per key,
+        and it does all of that in a single (read) transaction so you see a consistent state.
+
+        @param keys: an iterable of keys. Each is type-checked like get() does.
+        @param missing_as_none: like get()'s: if False (default), a key that is not present raises KeyError;
+        if True, its value in the returned dict will be None.
+        @param chunk_size: how many keys to ask for per query.
+        (SQLite's limit on the amount of variables in a query can be as low as 999, so keep it under that)
+        @return: a dict from key to value, in the order you gave the keys
+        """
+        keys = list(keys)
+        for key in keys:
+            self._checktype_key(key)
+
+        found = {}
+        to_fetch = keys
+        if self._cache is not None:
+            to_fetch = []
+            for key in keys:
+                in_cache, value = self._cache.get(key)
+                if in_cache:
+                    found[key] = value
+                else:
+                    to_fetch.append(key)
+
+        curs = self.conn.cursor()
+        started_transaction = not self._in_transaction
+        if started_transaction:
+            curs.execute("BEGIN")
+        try:
+            for offset in range(0, len(to_fetch), chunk_size):
+                chunk = to_fetch[offset : offset + chunk_size]
+                curs.execute(
+                    "SELECT key, value FROM kv WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                for key, value in curs.fetchall():
+                    found[key] = self._unpack_and_cache(key, self._decode_value(value))
+        finally:
+            if started_transaction:  # just ends the read transaction; we did not change anything
+                self.conn.commit()
+            curs.close()
+
+        ret = {}
+        for key in keys:
+            if key in found:
+                ret[key] = found[key]
+            elif missing_as_none:
+                ret[key] = None
+            else:
+                raise KeyError("Key %r not found" % key)
+        return ret
+
+    def present_keys(self, keys, chunk_size: int = 500) -> set:
+        """Which of the given keys are in the store - without fetching their values.
+
+        Like get_many(), this asks for a chunk of keys per query, rather than doing a query per key,
+        which makes it a cheap way to filter out what you already have (see e.g. cached_fetch_many()).
+
+        @param keys: an iterable of keys.
+        @param chunk_size: how many keys to ask for per query (see get_many()).
+        @return: a set of the keys that are present.
+        """
+        keys = list(keys)
+        for key in keys:
+            self._checktype_key(key)
+        ret = set()
+        curs = self.conn.cursor()
+        try:
+            for offset in range(0, len(keys), chunk_size):
+                chunk = keys[offset : offset + chunk_size]
+                curs.execute("SELECT key FROM kv WHERE key IN (%s)" % ",".join("?" * len(chunk)), chunk)
+                ret.update(row[0] for row in curs.fetchall())
+        finally:
+            curs.close()
+        return ret
+
+    def put_many(self, items, commit: bool = None):
+        """Sets/updates values for many keys at once, in a single transaction.
+
+        Is much faster than calling put() for each item,
+        in that it hands everything to a single executemany(), and commits (if asked to) only once at the end.
+
+        Types are checked like put() does.
+        If one of them fails that check, the items we had already inserted are rolled back
+        (...unless you were already in a transaction from an earlier commit=False, in which case we leave that to you).
+
+        @param items: an iterable of (key, value) pairs, e.g. a list of tuples, or a dict's .items()
+        @param commit: like put()'s: False lets you do more in the same transaction, and commit() yourself later,
+        None follows the commit policy (which counts each item).
+        """
+        if self.read_only:
+            raise RuntimeError(
+                "Attempted put_many() on a store that was opened read-only.  (you can subvert that but may not want to)"
+            )
+
+        def checked_rows():
+            for key, value in items:
+                self._checktype_key(key)
+                self._checktype_value(value)
+                value = self._encode_value(value)
+                if self._cache is not None:
+                    self._cache.discard(key)
+                yield key, value, value
+
+        self._executemany_in_transaction(
+            "INSERT INTO kv (key, value) VALUES (?, ?)  ON CONFLICT (key) DO UPDATE SET value=?",
+            checked_rows(),
+            commit=commit,
+        )
+
+    def delete_many(self, keys, commit: bool = None):
+        """Deletes items for many keys at once, in a single transaction.
+        Keys that are not present are ignored (like delete() does).
+
+        @param keys: an iterable of keys
+        @param commit: like delete()'s: False lets you do more in the same transaction, and commit() yourself later,
+        None follows the commit policy.
+        """
+        if self.read_only:
+            raise RuntimeError(
+                "Attempted delete_many() on a store that was opened read-only.  (you can subvert that but may not want to)"
+            )
+
+        def checked_rows():
+            for key in keys:
+                self._checktype_key(key)
+                if self._cache is not None:
+                    self._cache.discard(key)
+                yield (key,)
+
+        self._executemany_in_transaction(
+            "DELETE FROM kv where key=?", checked_rows(), commit=commit
+        )
+
+    def _executemany_in_transaction(self, query: str, rows, commit: bool = None):
+        """For internal use: run an executemany() inside a transaction, the way put_many() and delete_many() want it.
+
+        If we started the transaction here and something fails halfway, we roll back.
+        @return: the amount of rows affected
+        """
+        started_transaction = not self._in_transaction
+        self._begin_write(False)  # the executemany itself always goes into a single transaction
+        curs = self.conn.cursor()
+        try:
+            curs.executemany(query, rows)
+            amount = max(curs.rowcount, 0)
+        except Exception:
+            if started_transaction:
+                self.rollback()
+            raise
+        finally:
+            curs.close()
+        self._end_write(commit, self._commit_policy_now(commit), amount=amount)
+        return amount
 
     def _get_meta(self, key: str, missing_as_none=False):
         """For internal use, preferably don't use.
@@ -308,86 +915,211 @@ class LocalKV:
             return row[0]
 
     def _put_meta(self, key: str, value: str):
-        """For internal use, preferably don't use.   See also _get_meta(), _delete_meta().   Note this does an implicit commit()"""
+        """For internal use, preferably don't use.   See also _get_meta(), _delete_meta().
+        Note this does an implicit commit() - unless a transaction was already open (e.g. from put(commit=False)),
+        in which case it becomes part of that transaction, and is committed or rolled back along with it."""
         if self.read_only:
             raise RuntimeError(
                 "Attempted _put_meta() on a store that was opened read-only.  (you can subvert that but may not want to)"
             )
         curs = self.conn.cursor()
-        curs.execute("BEGIN")
+        started = not self._in_transaction
+        if started:
+            curs.execute("BEGIN")
         curs.execute(
             "INSERT INTO meta (key, value) VALUES (?, ?)  ON CONFLICT (key) DO UPDATE SET value=?",
             (key, value, value),
         )
-        self.commit()
+        if started:
+            self.commit()
         curs.close()
 
     def _delete_meta(self, key: str):
-        """For internal use, preferably don't use.   See also _get_meta(), _delete_meta().   Note this does an implicit commit()"""
+        """For internal use, preferably don't use.   See also _get_meta(), _delete_meta().
+        Like _put_meta(), this commits unless a transaction was already open."""
         if self.read_only:
             raise RuntimeError(
                 "Attempted _put_meta() on a store that was opened read-only.  (you can subvert that but may not want to)"
             )
-        curs = self.conn.cursor()  # TODO: check that's correct when commit==False
+        curs = self.conn.cursor()
         curs.execute("DELETE FROM meta where key=?", (key,))
-        self.commit()
+        if not self._in_transaction:
+            self.commit()
         curs.close()
 
     def commit(self):
         "commit changes - for when you use put() or delete() with commit=False to do things in a larger transaction"
         self.conn.commit()
         self._in_transaction = False
+        self._uncommitted_writes = 0
+        if self.vacuum_every is not None and self._writes_since_vacuum >= self.vacuum_every:
+            self._reclaim_space()
 
     def rollback(self):
         "roll back changes"
         # maybe only if _in_transaction?
         self.conn.rollback()
         self._in_transaction = False
+        self._uncommitted_writes = 0
+        if self._cache is not None:  # it may have picked up values that no longer exist
+            self._cache.clear()
 
     def close(self):
-        "Closes file if still open. Note that if there was a transaction still open, it will be rolled back, not committed."
+        """Closes file if still open.
+        Note that if there was a transaction still open, it will be rolled back, not committed
+        - unless you gave the store a commit policy (commit_every and/or commit_interval), in which case we commit what is pending.
+        If you asked for vacuum_on_close, we then do a step of incremental_vacuum() (if there is enough waste, see the constructor).
+        """
         if self._in_transaction:
-            self.rollback()
+            if self.commit_every is None and self.commit_interval is None:
+                self.rollback()
+            else:
+                self.commit()
+        if self.vacuum_on_close:
+            self._reclaim_space()
         self.conn.close()
 
     # TODO: see if the view's semantics in keys(), values(), and items() are actually correct.
     #      Note there's a bunch of implied heavy lifting in hnading self to those view classes,
     #         which require that that relies on __iter__ and __getitem__ to be there
 
-    def iterkeys(self):
+    def _key_range_where(self, prefix=None, start=None, stop=None, after=None):
+        """For internal use: the WHERE part of a query that selects keys by prefix and/or range, and its parameters.
+
+        These are written as comparisons on key (a prefix becomes a range too), so that SQLite can use the index
+        that comes with the UNIQUE constraint on key, and only visits the rows in that range.
+        @return: (sql_string, params_list), or ('', []) if all are None
+        """
+        conditions, params = [], []
+        if prefix is not None:
+            if not isinstance(prefix, (str, bytes)):
+                raise TypeError("prefix should be str or bytes, not %s" % type(prefix).__name__)
+            conditions.append("key >= ?")
+            params.append(prefix)
+            after_prefix = _prefix_upper_bound(prefix)
+            if after_prefix is not None:
+                conditions.append("key < ?")
+                params.append(after_prefix)
+        if start is not None:
+            conditions.append("key >= ?")
+            params.append(start)
+        if stop is not None:
+            conditions.append("key < ?")
+            params.append(stop)
+        if after is not None:
+            conditions.append("key > ?")
+            params.append(after)
+        if len(conditions) == 0:
+            return "", []
+        return " WHERE %s" % " AND ".join(conditions), params
+
+    def _iter_rows(
+        self, columns: str, prefix=None, start=None, stop=None, after=None, batch_size=None, page_size=None
+    ):
+        """For internal use: yields rows (tuples of the given columns) for iterkeys(), itervalues(), and iteritems().  See iterkeys() for the arguments.
+
+        Without page_size, this is one query, so one cursor, which keeps a read lock for as long as you take to go through it all.
+        With page_size, this is a series of queries that each fetch up to that many rows,
+        continuing from the last key of the previous one ('keyset pagination'), so we hold no lock between pages.
+        """
+        if page_size is None:
+            where, params = self._key_range_where(prefix, start, stop, after)
+            curs = self.conn.cursor()
+            try:
+                curs.execute(
+                    "SELECT %s FROM kv%s%s" % (columns, where, " ORDER BY key" if where else ""),
+                    params,
+                )
+                if batch_size is None:
+                    yield from curs
+                else:
+                    while True:
+                        rows = curs.fetchmany(batch_size)
+                        if len(rows) == 0:
+                            break
+                        yield from rows
+            finally:
+                curs.close()
+        else:
+            while True:
+                where, params = self._key_range_where(prefix, start, stop, after)
+                # fetchall() completes the statement, which is what releases the read lock
+                rows = self.conn.execute(
+                    "SELECT key, %s FROM kv%s ORDER BY key LIMIT ?" % (columns, where),
+                    params + [page_size],
+                ).fetchall()
+                for row in rows:
+                    yield row[1:]
+                if len(rows) < page_size:
+                    break
+                after = rows[-1][0]
+
+    def iterkeys(
+        self, prefix=None, start=None, stop=None, after=None, batch_size=None, page_size=None
+    ):
         """Returns a generator that yields all keus
         If you wanted a list with all keys, use list( store.keys() )
+
+        You can ask for only some of them (which is much faster than filtering all keys yourself, because this uses the index):
+        @param prefix: only keys that start with this (str or bytes), e.g. 'https://repository.overheid.nl/frbr/cvdr/' or 'ECLI:NL:HR:'
+        @param start: only keys that sort at or after this
+        @param stop: only keys that sort before this
+        @param after: only keys that sort after this - mostly meant to resume an earlier iteration from the last key you saw.
+        If you use any of these, keys come in sorted order (by bytes, so e.g. uppercase before lowercase).
+
+        And you can say how to fetch them:
+        @param batch_size: fetch this many rows from SQLite at a time, rather than one at a time, which is a little faster.
+        @param page_size: fetch this many rows per query, and do not keep a query (and so a read lock) open in between.
+        This is what you want for long passes over a store that something else may want to write to,
+        because a single long read would make those writers time out - and it also means you can alter the store while iterating.
+        Implies sorted order, and sees changes made between pages.
         """
-        curs = self.conn.cursor()
-        for row in curs.execute("SELECT key FROM kv"):
+        for row in self._iter_rows("key", prefix, start, stop, after, batch_size, page_size):
             yield row[0]
-        curs.close()
+
+    def count(self, prefix=None, start=None, stop=None) -> int:
+        """Count the keys that iterkeys() with the same arguments would give you,
+        but without fetching them, and without going through the whole table.
+        Without arguments this is the same as len().
+        """
+        where, params = self._key_range_where(prefix, start, stop)
+        if where == "":
+            return len(self)
+        return self.conn.execute("SELECT COUNT(*) FROM kv" + where, params).fetchone()[0]
 
     def keys(self):
         """Returns an iterable of all keys.  (a view with a len, rather than just a generator)"""
         return collections.abc.KeysView(self)  # TODO: check that this is enough
 
-    def itervalues(self):
+    def itervalues(
+        self, prefix=None, start=None, stop=None, after=None, batch_size=None, page_size=None
+    ):
         """Returns a generator that yields all values.
         If you wanted a list with all the values, use list( store.values )
+
+        prefix, start, stop, and after select by key, batch_size and page_size say how to fetch, see iterkeys()
+        (note that to be able to resume, you need to know keys, so you may prefer iteritems())
         """
-        curs = self.conn.cursor()
-        for row in curs.execute("SELECT value FROM kv"):
-            yield row[0]
-        curs.close()
+        for row in self._iter_rows("value", prefix, start, stop, after, batch_size, page_size):
+            yield self._unpack_value(self._decode_value(row[0]))
 
     def values(self):
         """Returns an iterable of all values.  (a view with a len, rather than just a generator)"""
         return collections.abc.ValuesView(self)
 
-    def iteritems(self):
-        """Returns a generator that yields all items"""
-        curs = self.conn.cursor()
-        try:  # TODO: figure out whether this is necessary
-            for row in curs.execute("SELECT key, value FROM kv"):
-                yield row[0], row[1]
-        finally:
-            curs.close()
+    def iteritems(
+        self, prefix=None, start=None, stop=None, after=None, batch_size=None, page_size=None
+    ):
+        """Returns a generator that yields all items
+
+        prefix, start, stop, and after select by key, batch_size and page_size say how to fetch, see iterkeys().
+        For example, a long analysis pass that does not block collectors writing to the same store,
+        and that you can pick up where you left off: ::
+            for key, value in store.iteritems(page_size=1000, after=last_key_done):
+                ...
+        """
+        for row in self._iter_rows("key, value", prefix, start, stop, after, batch_size, page_size):
+            yield row[0], self._unpack_value(self._decode_value(row[1]))
 
     def items(self):
         """Returns an iteralble of all items.    (a view with a len, rather than just a generator)"""
@@ -400,10 +1132,18 @@ class LocalKV:
         return "<LocalKV(%r)>" % (os.path.basename(self.path),)
 
     def __len__(self):
-        "Return the amount of entries in this store"
-        return self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()[
-            0
-        ]  # TODO: double check
+        """Return the amount of entries in this store.
+
+        Usually this is a single lookup of the count we maintain in the meta table (see _setup_item_count),
+        only if that isn't there (e.g. an old store opened read-only) do we fall back to a COUNT, which has to go through the whole table.
+        """
+        if self._item_count_maintained:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key='num_items'"
+            ).fetchone()
+            if row is not None:
+                return int(row[0])
+        return self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
 
     # Choice not to actually have it behave like a dict - this seems like a leaky abstraction,
     # so we make you write out the .get and .put to make you realize it's different behaviour not like a real dict
@@ -439,7 +1179,7 @@ class LocalKV:
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        "supports use as a context manager - close()s on exit"
+        "supports use as a context manager - close()s on exit (which also commits pending writes if you have a commit policy)"
         self.close()
 
     ### Convenience functions, not core functionality
@@ -450,15 +1190,43 @@ class LocalKV:
             "SELECT (freelist_count*page_size) as FreeSizeEstimate  FROM pragma_freelist_count, pragma_page_size"
         ).fetchone()[0]
 
-    # def incremental_vacuum(self):
-    #     ''' assuming we created with "PRAGMA auto_vacuum = INCREMENTAL" we can do cleanup.
-    #         deally you do with some interval when you remove/update things
-    #         CONSIDER our own logic to that?  Maybe purely per interpreter (after X puts/deletes),  and maybe do it on close?
-    #     '''
-    #     # https://www.sqlite.org/pragma.html#pragma_auto_vacuum
-    #     if self._in_transaction:
-    #         self.commit()
-    #     self.conn.execute('PRAGMA schema.incremental_vacuum')
+    def incremental_vacuum(self, max_pages: int = None) -> int:
+        """Gives free pages back to the filesystem, by moving pages from the end of the file into free spots and truncating it.
+        Unlike vacuum() this does not rewrite the file, and you can bound how much work it does,
+        so you can do it often, in small steps (see also the vacuum_every policy in the constructor).
+
+        This only works on stores that have auto_vacuum=INCREMENTAL, which we set when we create a store.
+        Stores created before that (or by other code) can be converted by doing one vacuum().
+        Until then, this does nothing, and returns 0.
+
+        NOTE: if we were left in a transaction (due to commit=False), ths is commit()ed first.
+        @param max_pages: the most pages to free in this call; None means all free pages.
+        @return: approximately how many bytes were given back.
+        """
+        if self.read_only:
+            raise RuntimeError(
+                "Attempted incremental_vacuum() on a store that was opened read-only.  (you can subvert that but may not want to)"
+            )
+        if self._in_transaction:
+            self.commit()
+        self._writes_since_vacuum = 0
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:  # 2 means INCREMENTAL
+            return 0
+        waste_before = self.estimate_waste()
+        # executescript rather than execute, because the latter steps the statement only once, which frees only one page
+        if max_pages is None:
+            self.conn.executescript("PRAGMA incremental_vacuum")
+        else:
+            self.conn.executescript("PRAGMA incremental_vacuum(%d)" % max(int(max_pages), 1))
+        return waste_before - self.estimate_waste()
+
+    def _reclaim_space(self):
+        "For internal use: the vacuum_every / vacuum_on_close policy - an incremental_vacuum() step, if estimate_waste() says it is worth it"
+        self._writes_since_vacuum = 0
+        if self.read_only or self._in_transaction:
+            return
+        if self.estimate_waste() >= max(self.vacuum_min_waste, 1):
+            self.incremental_vacuum(max_pages=self.vacuum_pages)
 
     def bytesize(self) -> int:
         """Returns the approximate amount of the contained data, in bytes
@@ -482,8 +1250,9 @@ class LocalKV:
         have altered/removed without doing a vacuum().
 
         @param get_num_items: Also find the amount of items, and calculate average size.
-        Is slower than not doing this (proportionally slower with underlying size),
-        adds entries like: ::
+        This is cheap when the store maintains its item count (see len()),
+        and slower, proportionally with underlying size, for older stores opened read-only.
+        Adds entries like: ::
             'num_items':     856716,
             'avgsize_bytes': 63585,
             'avgsize_readable': '62K',
@@ -492,12 +1261,8 @@ class LocalKV:
             {'size_bytes':     54474244096,
              'size_readable': '54G'}
         """
-        # CONSIDER: a fast get_num_items via and-sqlite_stat1 if it exists
-        # (and considering ANALYZE if it does not)
-        # which after ANALYZE should always have a row like
-        # tbl='kv',idx='sqlite_autoindex_kv_1', stat='1234 1'
-        # (because our structure has a UNIQUE constraint on kv's key)
-        # this would be more valid for unchanging datasets
+        # Note: we considered sqlite_stat1 (after ANALYZE), but that goes stale as soon as anyone writes,
+        # while the count that triggers maintain in the meta table does not.
         ret = {}
         bytesize = self.bytesize()
         ret["size_bytes"] = bytesize
@@ -539,6 +1304,7 @@ class LocalKV:
     def vacuum(self):
         """After a lot of deletes you could compact the store with vacuum().
         WARNING: rewrites the entire file, so the more data you store, the longer this takes.
+        See also incremental_vacuum(), which only gives back free space, but is cheaper and can be done in steps.
         NOTE: if we were left in a transaction (due to commit=False), ths is commit()ed first.
         """
         if self._in_transaction:
@@ -554,18 +1320,75 @@ class LocalKV:
             self.rollback()
         curs.execute( "DELETE FROM kv" )  # https://www.techonthenet.com/sqlite/truncate.php
         self.commit()
+        if self._cache is not None:
+            self._cache.clear()
         if vacuum:
             self.vacuum()
 
+    def _random_rowids(self, n: int, max_rounds: int = 10):
+        """For internal use: pick up to n distinct rowids of existing rows, randomly, without a scan through the table.
+
+        We pick random rowids between the lowest and highest rowid (both cheap to ask for), and check which exist.
+        Gaps (from deletes) are simply retried, so each existing row is equally likely to be picked.
+
+        If that does not give us enough, because you asked for a good part of the store, or it has a lot of gaps,
+        we fall back to reading all rowids (which is still cheaper than reading all keys).
+        @return: a list of rowids, in random order
+        """
+        # (as separate subqueries, because SQLite only optimizes a lone MIN() or MAX() into an index lookup)
+        lo, hi = self.conn.execute(
+            "SELECT (SELECT MIN(rowid) FROM kv), (SELECT MAX(rowid) FROM kv)"
+        ).fetchone()
+        if lo is None or n <= 0:
+            return []
+        span = hi - lo + 1
+
+        chosen, tried = set(), set()
+        if n <= span // 4:
+            for _ in range(max_rounds):
+                missing = n - len(chosen)
+                if missing <= 0:
+                    break
+                candidates = set()
+                amount = min(2 * missing + 10, span // 2 - len(tried))
+                if amount <= 0:
+                    break
+                while len(candidates) < amount:
+                    rowid = random.randint(lo, hi)
+                    if rowid not in tried:
+                        candidates.add(rowid)
+                tried.update(candidates)
+                for row in self._rows_by_rowid(candidates, "rowid"):
+                    chosen.add(row[0])
+
+        if len(chosen) < n:  # fall back to looking at all of them
+            all_rowids = list(row[0] for row in self.conn.execute("SELECT rowid FROM kv"))
+            return random.sample(all_rowids, min(n, len(all_rowids)))
+        return random.sample(list(chosen), n)
+
+    def _rows_by_rowid(self, rowids, columns: str, chunk_size: int = 500):
+        """For internal use: yields rows (with the given columns) for the given rowids, in no particular order"""
+        rowids = list(rowids)
+        for offset in range(0, len(rowids), chunk_size):
+            chunk = rowids[offset : offset + chunk_size]
+            yield from self.conn.execute(
+                "SELECT %s FROM kv WHERE rowid IN (%s)" % (columns, ",".join("?" * len(chunk))),
+                chunk,
+            ).fetchall()
+
     def random_choice(self):
         """Returns a single (key, value) item from the store, selected randomly.
 
         A convenience function, because doing this properly yourself takes two or three lines
         (you can't random.choice/random.sample a view, so to do it properly you basically have to materialize all keys - and not accidentally all values)
-        BUT assume this is slower than working on the keys yourself.
+
+        Picks via SQLite's rowids, so does not need to go through all keys.
+        Like random.choice, raises IndexError if the store is empty.
         """
-        all_keys = list(self.keys())
-        chosen_key = random.choice(all_keys)
+        chosen_keys = self.random_keys(1)
+        if len(chosen_keys) == 0:
+            raise IndexError("Cannot choose from an empty store")
+        chosen_key = chosen_keys[0]
         return chosen_key, self.get(chosen_key)
 
     def random_sample(self, n):
@@ -579,28 +1402,26 @@ class LocalKV:
 
         Convenience function, because you can do this yourself, though it takes two or three lines of code;
         while you can't random.choice/random.sample a view,
-        to do it properly you basically have to materialize all keys (and probably not accidentally all values)
-        BUT
-            - assume this is slower than cleverly working on the keys yourself,
-            - assume this is is unnecessarily RAM intensive / extra work when you want a _lot_ of items anyway.
-        """
-        all_keys = list(self.keys())
-        n = min(n, len(all_keys))
-        #if amount > len(all_keys): # doing this would be consistent with random.sample?
-        #    raise ValueError(f"Sample larger than population (you asked for {amount}, we have {len(all_keys)})")
-        chosen_keys = random.sample(all_keys, n)
-        return list((chosen_key, self.get(chosen_key)) for chosen_key in chosen_keys)
+        to do it properly you basically have to materialize all keys (and probably not accidentally all values).
+        We avoid that by picking via SQLite's rowids (see random_keys),
+        BUT assume this is is unnecessarily RAM intensive / extra work when you want a _lot_ of items anyway.
+        """
+        chosen_keys = self.random_keys(n)
+        # (not self.get_many(), which in ExpiringLocalKV would refuse stale entries - which, as in iteration, we pick from too)
+        fetched = LocalKV.get_many(self, chosen_keys)
+        return list((chosen_key, fetched[chosen_key]) for chosen_key in chosen_keys)
 
     def random_keys(self, n=10):
         """Returns a amount of keys in a list, selected randomly.
         Can be faster/cheaper to do than random_sample When the values are large
 
-        On very large stores (tens of millions of items and/or hundred of gbytes)
-        this still ends up being dozens of seconds, because we still skip through a bunch of that data.
+        This picks random rowids and looks up their keys, so is fast even on very large stores
+        (tens of millions of items and/or hundred of gbytes) - unless you ask for a good part of the store,
+        in which case we go through all rowids.
         """
-        all_keys = list(self.keys())
-        chosen_keys = random.sample(all_keys, min(n, len(all_keys)))
-        return chosen_keys
+        chosen_rowids = self._random_rowids(n)
+        key_by_rowid = dict(self._rows_by_rowid(chosen_rowids, "rowid, key"))
+        return list(key_by_rowid[rowid] for rowid in chosen_rowids)
 
     def random_values(self, n=10):
         """Returns a amount of values in a list, selected randomly.
@@ -614,6 +1435,292 @@ class LocalKV:
             ret.append(value)
         return ret
 
+    def parallel_map(
+        self,
+        func,
+        processes: int = None,
+        chunk_by_rowid: bool = True,
+        chunk_size: int = 1000,
+        target=None,
+        ordered: bool = True,
+    ):
+        """Calls func(key, value) for every item in the store, spread over multiple processes,
+        for CPU-heavy work (e.g. parsing every document in a dataset) that would otherwise use only one core.
+
+        Each worker process opens its own read-only connection to this store's file, and is handed chunks of the table to do.
+        Workers see what was committed when they read, so commit() first if you just wrote things.
+
+        For example: ::
+            for key, result in store.parallel_map(parse_document, processes=8):
+                ...
+        or, to put the results into another store (more efficiently than doing that yourself in that loop): ::
+            store.parallel_map(parse_document, processes=8, target=parsed_store)
+
+        @param func: a function taking (key, value), returning something.
+        On platforms that start processes by spawning rather than forking (Windows, OSX), it needs to be picklable,
+        which means e.g. a function defined at module level, not a lambda.
+        @param processes: how many worker processes; None means as many as there are CPUs.
+        @param chunk_by_rowid: if True (default), chunks are rowid ranges, which the workers can read without any coordination.
+        If False, chunks are lists of keys, which we read here (in key order, all of them before we start) and hand to workers.
+        Rowid ranges are cheaper, but keys make chunks more evenly sized in stores with a lot of deleted rows.
+        @param chunk_size: how many rows (or with rowids: how large a rowid range) each chunk is
+        @param target: if None, this returns a generator that yields (key, func_result) as results come in.
+        If a store, we put() (key, func_result) into it (skipping results that are None) in a transaction per chunk,
+        and return the number of items we wrote.
+        @param ordered: whether to yield results in the store's order (rowid order, or key order); False can be a little faster.
+        """
+        if self.path == ":memory:":
+            raise ValueError(
+                "parallel_map() needs other processes to open the same store, which is not possible for ':memory:'"
+            )
+        results = self._parallel_map_results(
+            func, processes, chunk_by_rowid, chunk_size, ordered
+        )
+        if target is None:
+            return (pair for chunk_results in results for pair in chunk_results)
+
+        written = 0
+        for chunk_results in results:
+            to_write = list((key, result) for key, result in chunk_results if result is not None)
+            target.put_many(to_write)
+            written += len(to_write)
+        return written
+
+    def _parallel_map_results(self, func, processes, chunk_by_rowid, chunk_size, ordered):
+        """For internal use by parallel_map(): a generator that yields a list of (key, result) pairs per chunk."""
+        import multiprocessing
+
+        if chunk_by_rowid:
+            # (as separate subqueries, because SQLite only optimizes a lone MIN() or MAX() into an index lookup)
+            lo, hi = self.conn.execute(
+                "SELECT (SELECT MIN(rowid) FROM kv), (SELECT MAX(rowid) FROM kv)"
+            ).fetchone()
+            if lo is None:
+                chunks = []
+            else:
+                chunks = list(("rowid", (start, start + chunk_size)) for start in range(lo, hi + 1, chunk_size))
+        else:  # materialized, because the pool consumes this from another thread, and our connection is not to be used from there
+            chunks = list(_chunked_pages(self.iterkeys(page_size=chunk_size), chunk_size))
+
+        with multiprocessing.Pool(
+            processes=processes,
+            initializer=_parallel_map_init,
+            initargs=(type(self), self.path, func),
+        ) as pool:
+            mapper = pool.imap if ordered else pool.imap_unordered
+            for chunk_results in mapper(_parallel_map_chunk, chunks):
+                yield chunk_results
+
+
+_parallel_map_store = None
+_parallel_map_func = None
+
+
+def _parallel_map_init(store_class, path, func):
+    "For internal use: the initializer of LocalKV.parallel_map()'s worker processes, which opens the store (once per process)"
+    global _parallel_map_store, _parallel_map_func
+    _parallel_map_store = store_class(path, key_type=None, value_type=None, read_only=True)
+    _parallel_map_func = func
+
+
+def _parallel_map_chunk(chunk):
+    """For internal use: what LocalKV.parallel_map()'s worker processes do with each chunk.
+    @param chunk: either ('rowid', (start, stop)) or ('keys', [key, ...])
+    @return: a list of (key, func_result)
+    """
+    store = _parallel_map_store
+    how, what = chunk
+    if how == "rowid":
+        rows = store.conn.execute(
+            "SELECT key, value FROM kv WHERE rowid >= ? AND rowid < ?", what
+        ).fetchall()
+    else:
+        rows = store.conn.execute(
+            "SELECT key, value FROM kv WHERE key IN (%s)" % ",".join("?" * len(what)), what
+        ).fetchall()
+        order = {key: i for i, key in enumerate(what)}
+        rows.sort(key=lambda row: order[row[0]])
+    ret = []
+    for key, value in rows:
+        value = store._unpack_value(store._decode_value(value))  # pylint: disable=protected-access
+        ret.append((key, _parallel_map_func(key, value)))
+    return ret
+
+
+def _chunked_pages(iterable, chunk_size: int):
+    "For internal use: groups an iterable of keys into ('keys', [key, ...]) chunks, for parallel_map"
+    chunk = []
+    for key in iterable:
+        chunk.append(key)
+        if len(chunk) >= chunk_size:
+            yield ("keys", chunk)
+            chunk = []
+    if len(chunk) > 0:
+        yield ("keys", chunk)
+
+
+def _prefix_upper_bound(prefix):
+    """For internal use: the smallest string (or bytes) that sorts after everything that starts with prefix,
+    so that a prefix can be asked for as a range that an index can serve.
+
+    SQLite compares text as UTF-8 bytes, which sorts the same as comparing codepoints, so we can increment the last codepoint.
+    @return: that bound, or None if there is none (e.g. an empty prefix)
+    """
+    if isinstance(prefix, bytes):
+        stripped = prefix.rstrip(b"\xff")
+        if len(stripped) == 0:
+            return None
+        return stripped[:-1] + bytes([stripped[-1] + 1])
+
+    stripped = prefix.rstrip("\U0010ffff")
+    if len(stripped) == 0:
+        return None
+    next_codepoint = ord(stripped[-1]) + 1
+    if 0xD800 <= next_codepoint <= 0xDFFF:  # surrogates can't be encoded as UTF-8, skip past them
+        next_codepoint = 0xE000
+    return stripped[:-1] + chr(next_codepoint)
+
+
+class _BlobReader(io.RawIOBase):
+    """For internal use by LocalKV.open_value(): a file object on a sqlite3.Blob, optionally skipping the first few bytes.
+    (a Blob already has read(), seek() and tell(), this makes it something that io.BufferedReader and such accept)
+    """
+
+    def __init__(self, blob, start: int = 0):
+        super().__init__()
+        self._blob = blob
+        self._start = start
+        self._blob.seek(start)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._blob.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = self._start + offset
+        elif whence == io.SEEK_CUR:
+            position = self._blob.tell() + offset
+        else:
+            position = len(self._blob) + offset
+        self._blob.seek(min(max(position, self._start), len(self._blob)))
+        return self.tell()
+
+    def tell(self):
+        return self._blob.tell() - self._start
+
+    def close(self):
+        if not self.closed:
+            self._blob.close()
+        super().close()
+
+
+class _ZlibReader(io.RawIOBase):
+    "For internal use by LocalKV.open_value(): decompresses zlib data from another file object as it is read"
+
+    def __init__(self, raw, zdict: bytes = None, read_size: int = 131072):
+        super().__init__()
+        self._raw = raw
+        if zdict is None:
+            self._decompressor = zlib.decompressobj()
+        else:
+            self._decompressor = zlib.decompressobj(zdict=zdict)
+        self._read_size = read_size
+        self._pending = b""
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self._pending) == 0:
+            if self._finished:
+                return 0
+            compressed = self._raw.read(self._read_size)
+            if len(compressed) > 0:
+                self._pending = self._decompressor.decompress(compressed)
+            else:
+                self._pending = self._decompressor.flush()
+                self._finished = True
+        amount = min(len(buffer), len(self._pending))
+        buffer[:amount] = self._pending[:amount]
+        self._pending = self._pending[amount:]
+        return amount
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+
+class _LRUCache:
+    """For internal use by LocalKV: a least-recently-used cache, bounded by item count and/or (approximate) byte size.
+
+    Remembers hits and misses, so that you can tell whether it is worth it.
+    """
+
+    def __init__(self, max_items: int = None, max_bytes: int = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._data = collections.OrderedDict()  # key -> (value, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        "@return: a (found:bool, value) tuple"
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self._data.move_to_end(key)
+        return True, entry[0]
+
+    def put(self, key, value, size: int):
+        "remember a value, evicting the least recently used ones if that takes us over a limit"
+        self.discard(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # would evict everything else and still not fit
+        self._data[key] = (value, size)
+        self.bytes += size
+        while (self.max_items is not None and len(self._data) > self.max_items) or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            _, (_, evicted_size) = self._data.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def discard(self, key):
+        "forget a key, if we had it"
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        "forget everything (but not the hit/miss counts)"
+        self._data.clear()
+        self.bytes = 0
+
+    def info(self):
+        "see LocalKV.cache_info()"
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups > 0 else 0.0,
+            "items": len(self._data),
+            "bytes": self.bytes,
+            "max_items": self.max_items,
+            "max_bytes": self.max_bytes,
+        }
+
 
 class MsgpackKV(LocalKV):
     """Like localKV but the value can be a nested python type (serialized via msgpack)
@@ -630,9 +1737,10 @@ class MsgpackKV(LocalKV):
     Note that this does _not_ change how the meta table works.
     """
 
-    def __init__(self, path, key_type=str, value_type=None, read_only=False):
-        """value_type is ignored; I need to restructure this"""
-        super().__init__( path, key_type=key_type, value_type=value_type, read_only=read_only )
+    def __init__(self, path, key_type=str, value_type=None, read_only=False, **kwargs):
+        """value_type is ignored; I need to restructure this.
+        Further keyword arguments (e.g. use_wal) are handed to LocalKV."""
+        super().__init__( path, key_type=key_type, value_type=value_type, read_only=read_only, **kwargs )
 
         # this is meant to be able to detect/signal incorrect interpretation, not fully used yet
         if self._get_meta("valtype", missing_as_none=True) is None:
@@ -645,31 +1753,1008 @@ class MsgpackKV(LocalKV):
         and/or never use missing_as_none,
         unless you like ambiguity.
         """
-        if missing_as_none:
-            value = super().get(key, missing_as_none=True)
-            if value is None:
-                return None
-            # else value is a still-packed value
-        else:
-            value = super().get(key, missing_as_none=False)  # may raise
+        return super().get(key, missing_as_none=missing_as_none)  # which unpacks via our _unpack_value()
 
-        unpacked = msgpack.loads(value)
-        return unpacked
+    def _unpack_value(self, value):
+        "For internal use: unpacks a stored value (see LocalKV._unpack_value)"
+        return msgpack.loads(value, strict_map_key=False)
 
-    def put(self, key: str, value, commit: bool = True):
+    def put(self, key: str, value, commit: bool = None):
         "See LocalKV.put().   Unlike that, value is not checked for type, just serialized. Which can fail with an exception."
         packed = msgpack.dumps(value)
         super().put(key, packed, commit)
 
-    def itervalues(self):
+    def put_many(self, items, commit: bool = None):
+        "See LocalKV.put_many().   Like put(), values are not checked for type, just serialized."
+        super().put_many(
+            ((key, msgpack.dumps(value)) for key, value in items), commit=commit
+        )
+
+
+class ExpiringLocalKV(LocalKV):
+    """Like LocalKV, but remembers when each entry was stored, so that it can be treated as stale after a while
+    - meant for caches of things that change, like search results and listings fetched from a server (see also cached_fetch()).
+
+    Given: ::
+        cache = ExpiringLocalKV('fetch_cache', str, bytes, max_age=86400)
+    then get() considers entries older than a day to be missing,
+    and an occasional: ::
+        cache.evict_expired()
+    actually removes them.
+
+    Each entry can also have an ETag and/or Last-Modified value (as the server sent them, see put()),
+    so that a stale entry can be revalidated with a conditional request (see revalidation_headers() and touch())
+    instead of fetching it all again.
+
+    Timestamps are kept in a separate table, by triggers, so any write updates them,
+    including put_many() and writes from other processes.
+    Iteration, len() and such do not consider age.
+    """
+
+    # seconds since the epoch, in SQL, since the triggers set timestamps themselves
+    _NOW_SQL = "((julianday('now') - 2440587.5) * 86400.0)"
+
+    def __init__(self, path, key_type, value_type, max_age: float = None, read_only=False, **kwargs):
+        """See LocalKV's constructor; further keyword arguments are handed to it.
+        @param max_age: the default for get()'s max_age, in seconds: entries older than this are treated as not there.
+        None means entries never go stale (unless you ask get() for a max_age).
+        """
+        super().__init__(path, key_type=key_type, value_type=value_type, read_only=read_only, **kwargs)
+        self.max_age = max_age
+        self._expiry_maintained = False  # whether there is an expiry table (set by _setup_expiry)
+        self._setup_expiry()
+
+    def _setup_expiry(self):
+        """For internal use: creates the table with per-entry timestamps and validators, its index, and the triggers that maintain it.
+        Entries that were already in the store (e.g. when you open a plain LocalKV as an ExpiringLocalKV) count as stored now.
+
+        Like _setup_item_count(), this only takes the write lock when something is missing.
+        A store without the table that is opened read-only has no expiry information, so its entries never go stale.
+        """
+        expected = {"expiry", "expiry_stored_at", "kv_expiry_insert", "kv_expiry_update", "kv_expiry_delete"}
+        existing = set(
+            row[0]
+            for row in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE name IN (%s)" % ",".join("?" * len(expected)), sorted(expected)
+            )
+        )
+        if existing != expected and not self.read_only:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS expiry (key text unique NOT NULL, stored_at real NOT NULL, etag text, last_modified text)"
+                )
+                # so that eviction only visits the expired rows
+                self.conn.execute("CREATE INDEX IF NOT EXISTS expiry_stored_at ON expiry (stored_at)")
+                if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='kv_expiry_insert'").fetchone() is None:
+                    # This also clears the validators, which belonged to the old value (put() sets new ones).
+                    # (not INSERT OR REPLACE, because the upsert in put() would override that conflict clause)
+                    for event in ("INSERT", "UPDATE OF value"):
+                        self.conn.execute(
+                            "CREATE TRIGGER IF NOT EXISTS kv_expiry_%s AFTER %s ON kv BEGIN "
+                            "  DELETE FROM expiry WHERE key = new.key;"
+                            "  INSERT INTO expiry (key, stored_at) VALUES (new.key, %s); END"
+                            % (event.split()[0].lower(), event, self._NOW_SQL)
+                        )
+                    self.conn.execute(
+                        "CREATE TRIGGER IF NOT EXISTS kv_expiry_delete AFTER DELETE ON kv BEGIN "
+                        "  DELETE FROM expiry WHERE key = old.key; END"
+                    )
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO expiry (key, stored_at) SELECT key, %s FROM kv" % self._NOW_SQL
+                    )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            existing = expected
+        self._expiry_maintained = "expiry" in existing
+
+    def get(self, key, missing_as_none: bool = False, max_age: float = None):
+        """Gets value for key, like LocalKV.get(), except that entries older than max_age are treated as missing.
+        @param max_age: in seconds. None means the store's default (see the constructor).
+        """
+        if max_age is None:
+            max_age = self.max_age
+        if max_age is not None:
+            stored_at = self.stored_at(key, missing_as_none=True)
+            if stored_at is not None and time.time() - stored_at > max_age:
+                if missing_as_none:
+                    return None
+                raise KeyError("Key %r is older than %s seconds" % (key, max_age))
+        return super().get(key, missing_as_none=missing_as_none)
+
+    def get_many(self, keys, missing_as_none: bool = False, chunk_size: int = 500, max_age: float = None):
+        """Gets values for many keys at once, like LocalKV.get_many(), except that, like get(), entries older than max_age are treated as missing.
+        @param max_age: in seconds. None means the store's default (see the constructor).
+        """
+        if max_age is None:
+            max_age = self.max_age
+        if max_age is None:
+            return super().get_many(keys, missing_as_none=missing_as_none, chunk_size=chunk_size)
+        keys = list(keys)
+        fresh = self.present_keys(keys, chunk_size=chunk_size, max_age=max_age)
+        found = super().get_many([key for key in keys if key in fresh], missing_as_none=True, chunk_size=chunk_size)
+        ret = {}
+        for key in keys:
+            value = found.get(key)
+            if value is None and not missing_as_none:
+                raise KeyError("Key %r not found, or older than %s seconds" % (key, max_age))
+            ret[key] = value
+        return ret
+
+    def __contains__(self, key):
+        "will return whether the store contains a key that is not older than the store's max_age"
+        if self.max_age is None or not self._expiry_maintained:
+            return super().__contains__(key)
+        return (
+            self.conn.execute(
+                "SELECT 1 FROM kv LEFT JOIN expiry ON expiry.key = kv.key"
+                " WHERE kv.key = ? AND (expiry.stored_at IS NULL OR expiry.stored_at >= ?)",
+                (key, time.time() - self.max_age),
+            ).fetchone()
+            is not None
+        )
+
+    def present_keys(self, keys, chunk_size: int = 500, max_age: float = None) -> set:
+        """Which of the given keys are in the store, like LocalKV.present_keys(),
+        except that, like get(), entries older than max_age are treated as missing.
+        @param max_age: in seconds. None means the store's default (see the constructor).
+        """
+        if max_age is None:
+            max_age = self.max_age
+        if max_age is None or not self._expiry_maintained:
+            return super().present_keys(keys, chunk_size=chunk_size)
+        keys = list(keys)
+        for key in keys:
+            self._checktype_key(key)
+        ret = set()
         curs = self.conn.cursor()
-        for row in curs.execute("SELECT value FROM kv"):
-            yield msgpack.loads(row[0], strict_map_key=False)
+        try:
+            for offset in range(0, len(keys), chunk_size):
+                chunk = keys[offset : offset + chunk_size]
+                curs.execute(
+                    "SELECT kv.key FROM kv LEFT JOIN expiry ON expiry.key = kv.key"
+                    " WHERE kv.key IN (%s) AND (expiry.stored_at IS NULL OR expiry.stored_at >= ?)"
+                    % ",".join("?" * len(chunk)),
+                    chunk + [time.time() - max_age],
+                )
+                ret.update(row[0] for row in curs.fetchall())
+        finally:
+            curs.close()
+        return ret
+
+    def put(self, key, value, commit: bool = None, etag: str = None, last_modified: str = None):
+        """Sets/updates value for a key, like LocalKV.put(), which also marks it as stored now.
+        @param etag: the ETag header the server sent along with this value, if any
+        @param last_modified: the Last-Modified header the server sent along with this value, if any
+        (both are kept as-is, to be handed back in revalidation_headers())
+        """
+        if etag is None and last_modified is None:
+            super().put(key, value, commit=commit)
+            return
+        # the value and its validators go into the same transaction
+        commit_now = self._begin_write(commit)
+        super().put(key, value, commit=False)
+        # (the trigger just created the row in expiry)
+        self.conn.execute("UPDATE expiry SET etag=?, last_modified=? WHERE key=?", (etag, last_modified, key))
+        self._end_write(commit, commit_now)
+
+    def stored_at(self, key, missing_as_none: bool = False) -> float:
+        """When the value for key was last stored (or touch()ed), in seconds since the epoch (like time.time()).
+        Raises KeyError if not present, unless missing_as_none is True.
+        """
+        row = None
+        if self._expiry_maintained:
+            row = self.conn.execute("SELECT stored_at FROM expiry WHERE key=?", (key,)).fetchone()
+        if row is None:
+            if missing_as_none:
+                return None
+            raise KeyError("Key %r not found" % key)
+        return row[0]
+
+    def get_info(self, key, missing_as_none: bool = False):
+        """What we know about an entry, apart from its value.
+        @return: a dict like: ::
+            {'stored_at': 1718000000.5, 'age': 3600.2, 'etag': '"abc123"', 'last_modified': 'Mon, 10 Jun 2024 06:13:20 GMT'}
+        (etag and last_modified are None when not known). Raises KeyError if not present, unless missing_as_none is True.
+        """
+        row = None
+        if self._expiry_maintained:
+            row = self.conn.execute(
+                "SELECT stored_at, etag, last_modified FROM expiry WHERE key=?", (key,)
+            ).fetchone()
+        if row is None:
+            if missing_as_none:
+                return None
+            raise KeyError("Key %r not found" % key)
+        stored_at, etag, last_modified = row
+        return {
+            "stored_at": stored_at,
+            "age": time.time() - stored_at,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+
+    def revalidation_headers(self, key) -> dict:
+        """The headers for a conditional request for this entry - If-None-Match and/or If-Modified-Since,
+        from the ETag and Last-Modified we were given in put().
+        If the server then answers 304 Not Modified, what we have is still good, and you can touch() it.
+        @return: a dict, which is empty if we have no validators for this key (or do not have the key at all)
+        """
+        info = self.get_info(key, missing_as_none=True)
+        ret = {}
+        if info is not None:
+            if info["etag"] is not None:
+                ret["If-None-Match"] = info["etag"]
+            if info["last_modified"] is not None:
+                ret["If-Modified-Since"] = info["last_modified"]
+        return ret
 
-    def iteritems(self):
+    def touch(self, key, commit: bool = None, etag: str = None, last_modified: str = None):
+        """Marks an entry as stored now, without changing its value - e.g. after the server told us it has not changed.
+        @param etag: if given, replaces the stored ETag (servers may send a new one with a 304)
+        @param last_modified: if given, replaces the stored Last-Modified
+        Raises KeyError if not present.
+        """
+        if self.read_only:
+            raise RuntimeError(
+                "Attempted touch() on a store that was opened read-only.  (you can subvert that but may not want to)"
+            )
+        commit_now = self._begin_write(commit)
         curs = self.conn.cursor()
-        for row in curs.execute("SELECT key, value FROM kv"):
-            yield row[0], msgpack.loads(row[1], strict_map_key=False)
+        curs.execute(
+            "UPDATE expiry SET stored_at=%s, etag=coalesce(?, etag), last_modified=coalesce(?, last_modified) WHERE key=?"
+            % self._NOW_SQL,
+            (etag, last_modified, key),
+        )
+        found = curs.rowcount > 0
+        curs.close()
+        self._end_write(commit, commit_now)
+        if not found:
+            raise KeyError("Key %r not found" % key)
+
+    def evict_expired(self, max_age: float = None, commit: bool = None) -> int:
+        """Removes all entries older than max_age.
+        This uses an index on the timestamps, so costs time proportional to how much there is to remove, not to the size of the store.
+        (Note that this leaves free space in the file; see incremental_vacuum(), and the vacuum_every policy in LocalKV's constructor)
+        @param max_age: in seconds; None means the store's default (see the constructor), and if that is also None we raise ValueError.
+        @param commit: like LocalKV.delete_many()'s
+        @return: the amount of entries removed
+        """
+        if max_age is None:
+            max_age = self.max_age
+        if max_age is None:
+            raise ValueError("evict_expired() needs a max_age, either here or in the constructor")
+        if self.read_only:
+            raise RuntimeError(
+                "Attempted evict_expired() on a store that was opened read-only.  (you can subvert that but may not want to)"
+            )
+        evicted = self._executemany_in_transaction(
+            "DELETE FROM kv WHERE key IN (SELECT key FROM expiry WHERE stored_at < ?)",
+            [(time.time() - max_age,)],
+            commit=commit,
+        )
+        if evicted > 0 and self._cache is not None:
+            self._cache.clear()
+        return evicted
+
+
+class ShardedLocalKV:
+    """A key-value store spread over a number of LocalKV (or MsgpackKV) files, each key going to one of them by hash.
+
+    For stores that would be uncomfortably large as a single SQLite file:
+      - vacuum() works on one shard at a time, so each takes a fraction of the time and of the temporary space
+      - writers to different shards do not block each other, so e.g. put_many(..., processes=4) writes in parallel,
+        and separate processes can each take care of their own shard (see shard_index())
+
+    Given: ::
+        db = ShardedLocalKV('bigstore', str, bytes, num_shards=8)
+    it is used much like LocalKV: get(), put(), delete(), their _many variants, keys(), values(), items() and such.
+
+    On disk it is a directory (path resolved like LocalKV's, see resolve_path) of files named like C{shard-0003-of-0008.db},
+    each of which is a normal store you could open on its own.
+    The amount of shards is fixed once created, because changing it would move most keys to another shard.
+
+    Iteration goes through the shards one after the other, so is not in key order.
+
+    @ivar path: the directory we opened (after resolving)
+    @ivar shards: the list of underlying stores
+    """
+
+    def __init__(
+        self,
+        path,
+        key_type,
+        value_type,
+        num_shards: int = None,
+        read_only: bool = False,
+        store_class=LocalKV,
+        **kwargs
+    ):
+        """
+        @param path: the directory name/path. Will be created if it does not yet exist.
+        @param key_type: handed to each shard, see LocalKV
+        @param value_type: handed to each shard, see LocalKV
+        @param num_shards: the amount of shards. Required when creating; when opening an existing one, None means 'however many it has'.
+        @param read_only: handed to each shard, see LocalKV
+        @param store_class: LocalKV or MsgpackKV
+        @param kwargs: further keyword arguments are handed to each shard (e.g. use_wal, commit_every, compression)
+        """
+        self.path = resolve_path(path)
+        self.key_type = key_type
+        self.value_type = value_type
+        self.read_only = read_only
+        self.store_class = store_class
+        self._store_kwargs = kwargs
+
+        existing = sharded_store_paths(self.path)
+        if existing is not None:
+            if num_shards is not None and num_shards != len(existing):
+                raise ValueError(
+                    "%r has %d shards, you asked for %d"
+                    % (self.path, len(existing), num_shards)
+                )
+            num_shards = len(existing)
+        else:
+            if num_shards is None:
+                raise ValueError(
+                    "%r is not an existing sharded store, so we need num_shards to create it" % self.path
+                )
+            if read_only:
+                raise RuntimeError(
+                    "Attempted to create a sharded store (%r) while asking for read-only." % self.path
+                )
+            if num_shards < 1:
+                raise ValueError("num_shards should be at least 1")
+            os.makedirs(self.path, exist_ok=True)
+        self.num_shards = num_shards
+
+        self.shards = list(self._open_shard(i) for i in range(num_shards))
+
+    def _shard_path(self, i: int):
+        "For internal use: the file path of the i-th shard"
+        return os.path.join(self.path, "shard-%04d-of-%04d.db" % (i, self.num_shards))
+
+    def _open_shard(self, i: int):
+        "For internal use: open the i-th shard as the store class we were given"
+        return self.store_class(
+            self._shard_path(i),
+            key_type=self.key_type,
+            value_type=self.value_type,
+            read_only=self.read_only,
+            **self._store_kwargs
+        )
+
+    def shard_index(self, key) -> int:
+        """Which shard a key goes to.
+        This is a stable hash (not python's hash(), which differs between processes), so any process can figure this out.
+        """
+        if isinstance(key, str):
+            key = key.encode("utf8")
+        elif isinstance(key, int):
+            key = str(key).encode("utf8")
+        return zlib.crc32(key) % self.num_shards
+
+    def shard_for(self, key):
+        "The shard store that a key goes to"
+        return self.shards[self.shard_index(key)]
+
+    def _group_by_shard(self, things, key_of=lambda thing: thing):
+        "For internal use: {shard_index: [thing, ...]}"
+        ret = {}
+        for thing in things:
+            ret.setdefault(self.shard_index(key_of(thing)), []).append(thing)
+        return ret
+
+    def get(self, key, missing_as_none: bool = False):
+        "See LocalKV.get()"
+        return self.shard_for(key).get(key, missing_as_none=missing_as_none)
+
+    def put(self, key, value, commit: bool = None):
+        "See LocalKV.put()"
+        self.shard_for(key).put(key, value, commit=commit)
+
+    def delete(self, key, commit: bool = None):
+        "See LocalKV.delete()"
+        self.shard_for(key).delete(key, commit=commit)
+
+    def open_value(self, key, chunk_size: int = 1048576):
+        "See LocalKV.open_value()"
+        return self.shard_for(key).open_value(key, chunk_size=chunk_size)
+
+    def get_many(self, keys, missing_as_none: bool = False):
+        "See LocalKV.get_many().  Asks each shard for its part.  Returns a dict in the order you gave the keys."
+        keys = list(keys)
+        found = {}
+        for i, shard_keys in self._group_by_shard(keys).items():
+            found.update(self.shards[i].get_many(shard_keys, missing_as_none=missing_as_none))
+        return {key: found[key] for key in keys}
+
+    def present_keys(self, keys, chunk_size: int = 500) -> set:
+        "See LocalKV.present_keys().  Asks each shard for its part."
+        ret = set()
+        for i, shard_keys in self._group_by_shard(keys).items():
+            ret.update(self.shards[i].present_keys(shard_keys, chunk_size=chunk_size))
+        return ret
+
+    def put_many(self, items, commit: bool = None, processes: int = 1):
+        """See LocalKV.put_many().  Each shard's part is done in a transaction of its own.
+
+        @param processes: if more than 1, write to that many shards at a time, each from a separate process
+        (each opening its own connection to its shard, so they do not wait on each other).
+        This implies committing, and the items (and store arguments) need to be picklable.
+        """
+        grouped = self._group_by_shard(items, key_of=lambda item: item[0])
+        if processes <= 1:
+            for i, shard_items in grouped.items():
+                self.shards[i].put_many(shard_items, commit=commit)
+            return
+
+        if self.read_only:
+            raise RuntimeError(
+                "Attempted put_many() on a store that was opened read-only.  (you can subvert that but may not want to)"
+            )
+        import multiprocessing
+
+        self.commit()  # anything our own connections still have pending would block the workers
+        jobs = list(
+            (self.store_class, self._shard_path(i), self.key_type, self.value_type, self._store_kwargs, shard_items)
+            for i, shard_items in grouped.items()
+        )
+        with multiprocessing.Pool(processes=min(processes, len(jobs) or 1)) as pool:
+            pool.map(_sharded_put_many_worker, jobs)
+        for i in grouped:  # forget things our own connections may have cached
+            if self.shards[i]._cache is not None:  # pylint: disable=protected-access
+                self.shards[i]._cache.clear()  # pylint: disable=protected-access
+
+    def delete_many(self, keys, commit: bool = None):
+        "See LocalKV.delete_many()"
+        for i, shard_keys in self._group_by_shard(keys).items():
+            self.shards[i].delete_many(shard_keys, commit=commit)
+
+    def commit(self):
+        "commit all shards"
+        for shard in self.shards:
+            shard.commit()
+
+    def rollback(self):
+        "roll back all shards"
+        for shard in self.shards:
+            shard.rollback()
+
+    def close(self):
+        "close all shards (see LocalKV.close() for what happens to uncommitted writes)"
+        for shard in self.shards:
+            shard.close()
+
+    def iterkeys(self, prefix=None, start=None, stop=None, batch_size=None, page_size=None):
+        """yields all keys, shard by shard.
+        The arguments work as in LocalKV.iterkeys(), but since we go shard by shard, the result is only sorted within each shard
+        (which is also why there is no after=).
+        """
+        for shard in self.shards:
+            yield from shard.iterkeys(
+                prefix=prefix, start=start, stop=stop, batch_size=batch_size, page_size=page_size
+            )
+
+    def count(self, prefix=None, start=None, stop=None) -> int:
+        "See LocalKV.count()"
+        return sum(shard.count(prefix=prefix, start=start, stop=stop) for shard in self.shards)
+
+    def keys(self):
+        """Returns an iterable of all keys.  (a view with a len, rather than just a generator)"""
+        return collections.abc.KeysView(self)
+
+    def itervalues(self, prefix=None, start=None, stop=None, batch_size=None, page_size=None):
+        "yields all values, shard by shard (see iterkeys())"
+        for shard in self.shards:
+            yield from shard.itervalues(
+                prefix=prefix, start=start, stop=stop, batch_size=batch_size, page_size=page_size
+            )
+
+    def values(self):
+        """Returns an iterable of all values.  (a view with a len, rather than just a generator)"""
+        return collections.abc.ValuesView(self)
+
+    def iteritems(self, prefix=None, start=None, stop=None, batch_size=None, page_size=None):
+        "yields all (key, value) items, shard by shard (see iterkeys())"
+        for shard in self.shards:
+            yield from shard.iteritems(
+                prefix=prefix, start=start, stop=stop, batch_size=batch_size, page_size=page_size
+            )
+
+    def items(self):
+        """Returns an iterable of all items.    (a view with a len, rather than just a generator)"""
+        return collections.abc.ItemsView(self)
+
+    def __repr__(self):
+        "show useful representation"
+        return "<ShardedLocalKV(%r, %d shards)>" % (os.path.basename(self.path), self.num_shards)
+
+    def __len__(self):
+        "Return the amount of entries in all shards"
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self):
+        "Using this object as an iterator yields its keys (equivalent to .iterkeys())"
+        return self.iterkeys()
+
+    def __getitem__(self, key):
+        "(only meant to support ValuesView and Itemsview)"
+        return self.get(key)
+
+    def __contains__(self, key):
+        "will return whether the store contains a key"
+        return key in self.shard_for(key)
+
+    def __enter__(self):
+        "supports use as a context manager"
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        "supports use as a context manager - close()s on exit"
+        self.close()
+
+    def _get_meta(self, key: str, missing_as_none=False):
+        "For internal use: the meta table of the first shard is considered the one for the whole set.  See LocalKV._get_meta()"
+        return self.shards[0]._get_meta(key, missing_as_none=missing_as_none)  # pylint: disable=protected-access
+
+    def _put_meta(self, key: str, value: str):
+        "For internal use: see _get_meta()"
+        self.shards[0]._put_meta(key, value)  # pylint: disable=protected-access
+
+    def estimate_waste(self):
+        "Estimate how many bytes might be cleaned by a .vacuum(), summed over shards"
+        return sum(shard.estimate_waste() for shard in self.shards)
+
+    def bytesize(self) -> int:
+        "Returns the approximate amount of the contained data, in bytes, summed over shards"
+        return sum(shard.bytesize() for shard in self.shards)
+
+    def summary(self, get_num_items: bool = False):
+        "See LocalKV.summary().  Also mentions 'num_shards'."
+        ret = {"num_shards": self.num_shards}
+        bytesize = self.bytesize()
+        ret["size_bytes"] = bytesize
+        ret["size_readable"] = wetsuite.helpers.format.kmgtp(bytesize, kilo=1024) + "B"
+        if get_num_items:
+            ret["num_items"] = len(self)
+            ret["avgsize_bytes"] = round(float(bytesize) / ret["num_items"]) if ret["num_items"] > 0 else 0
+            ret["avgsize_readable"] = (
+                wetsuite.helpers.format.kmgtp(ret["avgsize_bytes"], kilo=1024) + "B"
+            )
+        return ret
+
+    def incremental_vacuum(self, max_pages: int = None) -> int:
+        """See LocalKV.incremental_vacuum(); max_pages applies to each shard.
+        @return: approximately how many bytes were given back, summed over shards
+        """
+        return sum(shard.incremental_vacuum(max_pages=max_pages) for shard in self.shards)
+
+    def vacuum(self, shard: int = None):
+        """Vacuum the shards, one at a time - or only the one you say.
+        Each needs temporary space for only its own size, and you can spread the work out by doing one shard at a time.
+        @param shard: the index of a shard to vacuum, or None for all of them.
+        """
+        if shard is not None:
+            self.shards[shard].vacuum()
+        else:
+            for each_shard in self.shards:
+                each_shard.vacuum()
+
+    def truncate(self, vacuum=True):
+        "remove all entries from all shards (see LocalKV.truncate())"
+        for shard in self.shards:
+            shard.truncate(vacuum=vacuum)
+
+    def random_keys(self, n=10):
+        """Returns a amount of keys in a list, selected randomly (from each shard in proportion to its size).
+        See LocalKV.random_keys()
+        """
+        # pick positions in the (virtual) concatenation of all shards, then see which shard each falls in
+        cumulative_sizes = list(itertools.accumulate(len(shard) for shard in self.shards))
+        total = cumulative_sizes[-1]
+        per_shard = collections.Counter(
+            bisect.bisect_right(cumulative_sizes, position)
+            for position in random.sample(range(total), min(n, total))
+        )
+        ret = []
+        for i, amount in per_shard.items():
+            ret.extend(self.shards[i].random_keys(amount))
+        random.shuffle(ret)
+        return ret
+
+    def random_sample(self, n):
+        "Returns an amount of [(key, value), ...] list, selected randomly.   See LocalKV.random_sample()"
+        chosen_keys = self.random_keys(n)
+        fetched = self.get_many(chosen_keys)
+        return list((chosen_key, fetched[chosen_key]) for chosen_key in chosen_keys)
+
+    def random_choice(self):
+        "Returns a single (key, value) item, selected randomly.  See LocalKV.random_choice()"
+        sample = self.random_sample(1)
+        if len(sample) == 0:
+            raise IndexError("Cannot choose from an empty store")
+        return sample[0]
+
+    def random_values(self, n=10):
+        "Returns a amount of values in a list, selected randomly.  See LocalKV.random_values()"
+        return list(value for _key, value in self.random_sample(n))
+
+
+def _sharded_put_many_worker(job):
+    "For internal use: what ShardedLocalKV.put_many has each process do.  At module level so that multiprocessing can find it."
+    store_class, path, key_type, value_type, store_kwargs, items = job
+    store = store_class(path, key_type=key_type, value_type=value_type, **store_kwargs)
+    try:
+        store.put_many(items, commit=True)
+    finally:
+        store.close()
+
+
+_SHARD_FILENAME_RE = re.compile(r"^shard-([0-9]{4,})-of-([0-9]{4,})\.db$")
+
+
+def sharded_store_paths(path):
+    """If the given path is a directory that holds a sharded store (see ShardedLocalKV), returns the paths of its shard files, in order.
+    @return: a list of paths, or None if this does not look like a sharded store
+    """
+    if not os.path.isdir(path):
+        return None
+    by_index = {}
+    num_shards = None
+    for basename in os.listdir(path):
+        match = _SHARD_FILENAME_RE.match(basename)
+        if match is None:
+            continue
+        index, of = int(match.group(1)), int(match.group(2))
+        if num_shards is not None and of != num_shards:
+            return None  # mixed shard counts, not something we made
+        num_shards = of
+        by_index[index] = os.path.join(path, basename)
+    if num_shards is None or sorted(by_index) != list(range(num_shards)):
+        return None
+    return list(by_index[i] for i in range(num_shards))
+
+
+# (the same per-value headers as LocalKV's, for the compressed variant of the format)
+_VALUE_RAW, _VALUE_ZLIB, _VALUE_ZSTD = LocalKV._VALUE_RAW, LocalKV._VALUE_ZLIB, LocalKV._VALUE_ZSTD  # pylint: disable=protected-access
+_COMPRESS_MIN_SIZE = LocalKV._COMPRESS_MIN_SIZE  # pylint: disable=protected-access
+
+
+class MmapKV:
+    """A read-only key-value store in a single file that we memory-map, meant for distributing and using datasets.
+
+    Compared to a LocalKV:
+      - opening is cheap regardless of size (we read a small header, not the data)
+      - lookups are a binary search over a sorted index, so need no database engine,
+        and the pages they touch are shared with other processes using the same file, via the OS page cache
+      - it cannot be changed - you make one from an existing store with write_mmapkv()
+
+    Given: ::
+        write_mmapkv(store, 'dataset.mmkv')
+        data = MmapKV('dataset.mmkv')
+    use is dict-like: ::
+        data.get('foo')
+        data['foo']
+        for key, value in data.items():
+            ...
+
+    The file consists of:
+      - a fixed-size header (see _HEADER)
+      - the values, one after the other, each optionally compressed (with the same per-value headers LocalKV uses)
+      - the keys (UTF-8), one after the other
+      - an index of fixed-size records (see _INDEX_RECORD), sorted by key, saying where each key and value is
+      - a bit of JSON with metadata, such as the description and the type of the values
+    """
+
+    _MAGIC = b"WSMMAPKV"
+    _VERSION = 1
+    # magic, version, compression, (reserved), count, keys_offset, index_offset, meta_offset, meta_length
+    _HEADER = struct.Struct("<8sHBxIQQQQQ")
+    # key_offset, key_length, value_offset, value_length  (all absolute, in bytes)
+    _INDEX_RECORD = struct.Struct("<QQQQ")
+    _COMPRESSIONS = {0: None, 1: "zlib", 2: "zstd"}
+
+    def __init__(self, path):
+        """Opens (and memory-maps) the file.
+        @param path: the path to a file made by write_mmapkv(). Unlike LocalKV, this is used as-is.
+        """
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        if len(self._mm) < self._HEADER.size or self._mm[: len(self._MAGIC)] != self._MAGIC:
+            self.close()
+            raise ValueError("%r does not look like a file made by write_mmapkv()" % path)
+        (
+            _, version, compression_code, _,
+            self._count, self._keys_offset, self._index_offset, meta_offset, meta_length,
+        ) = self._HEADER.unpack_from(self._mm, 0)
+        if version > self._VERSION:
+            self.close()
+            raise ValueError("%r is in a newer version of this format (%d) than we understand" % (path, version))
+
+        self.compression = self._COMPRESSIONS[compression_code]
+        self._zstd_decompressor = None
+        if self.compression == "zstd":
+            import zstandard  # if this fails, you may need a    pip install zstandard
+
+            self._zstd_decompressor = zstandard.ZstdDecompressor()
+
+        self._meta = json.loads(self._mm[meta_offset : meta_offset + meta_length].decode("utf8"))
+        self.value_type = self._meta.get("value_type")
+
+    def _record(self, i: int):
+        "For internal use: the i-th index record, as (key_offset, key_length, value_offset, value_length)"
+        return self._INDEX_RECORD.unpack_from(self._mm, self._index_offset + i * self._INDEX_RECORD.size)
+
+    def _key_bytes(self, i: int) -> bytes:
+        "For internal use: the i-th key in sorted order, as UTF-8 bytes"
+        key_offset, key_length, _, _ = self._record(i)
+        return self._mm[key_offset : key_offset + key_length]
+
+    def _lower_bound(self, key_bytes: bytes) -> int:
+        "For internal use: the index of the first key that sorts at or after the given one (binary search)"
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_bytes(mid) < key_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _value(self, i: int):
+        "For internal use: the i-th value, decompressed and converted to what get() gives you"
+        _, _, value_offset, value_length = self._record(i)
+        data = self._mm[value_offset : value_offset + value_length]
+        if self.compression is not None:
+            header, data = data[:1], data[1:]
+            if header == _VALUE_ZLIB:
+                data = zlib.decompress(data)
+            elif header == _VALUE_ZSTD:
+                data = self._zstd_decompressor.decompress(data)
+            elif header != _VALUE_RAW:
+                raise ValueError("Do not know how to decompress value with header %r" % header)
+        if self.value_type == "str":
+            return data.decode("utf8")
+        elif self.value_type == "msgpack":
+            return msgpack.loads(data, strict_map_key=False)
+        return data
+
+    def get(self, key: str, missing_as_none: bool = False):
+        """Gets value for key.
+
+        @param key: the key to look up
+        @param missing_as_none: if the key is not present, return None instead of raising a KeyError
+        """
+        if not isinstance(key, str):
+            raise TypeError("Keys in an MmapKV are str, not %s" % type(key).__name__)
+        key_bytes = key.encode("utf8")
+        i = self._lower_bound(key_bytes)
+        if i < self._count and self._key_bytes(i) == key_bytes:
+            return self._value(i)
+        if missing_as_none:
+            return None
+        raise KeyError("Key %r not found" % key)
+
+    def _iter_indices(self, prefix: str = None):
+        "For internal use: the indices of all keys, or of those with a prefix, in key order"
+        if prefix is None:
+            yield from range(self._count)
+        else:
+            prefix_bytes = prefix.encode("utf8")
+            i = self._lower_bound(prefix_bytes)
+            while i < self._count and self._key_bytes(i).startswith(prefix_bytes):
+                yield i
+                i += 1
+
+    def iterkeys(self, prefix: str = None):
+        """Yields all keys, in sorted order.
+        @param prefix: if given, only keys that start with this (which is a binary search and then a walk, not a scan)
+        """
+        for i in self._iter_indices(prefix):
+            yield self._key_bytes(i).decode("utf8")
+
+    def itervalues(self, prefix: str = None):
+        "Yields all values, in the order of their keys (see iterkeys())"
+        for i in self._iter_indices(prefix):
+            yield self._value(i)
+
+    def iteritems(self, prefix: str = None):
+        "Yields all (key, value) items, in key order (see iterkeys())"
+        for i in self._iter_indices(prefix):
+            yield self._key_bytes(i).decode("utf8"), self._value(i)
+
+    def keys(self):
+        """Returns an iterable of all keys.  (a view with a len, rather than just a generator)"""
+        return collections.abc.KeysView(self)
+
+    def values(self):
+        """Returns an iterable of all values.  (a view with a len, rather than just a generator)"""
+        return collections.abc.ValuesView(self)
+
+    def items(self):
+        """Returns an iterable of all items.    (a view with a len, rather than just a generator)"""
+        return collections.abc.ItemsView(self)
+
+    def _get_meta(self, key: str, missing_as_none=False):
+        "For internal use: metadata copied from the store this was made from (e.g. 'description'), see LocalKV._get_meta()"
+        if key in self._meta.get("meta", {}):
+            return self._meta["meta"][key]
+        if missing_as_none:
+            return None
+        raise KeyError("Key %r not found" % key)
+
+    def bytesize(self) -> int:
+        "Returns the size of the file, in bytes"
+        return len(self._mm)
+
+    def close(self):
+        "Closes the memory map and file"
+        self._mm.close()
+        self._file.close()
+
+    def __repr__(self):
+        "show useful representation"
+        return "<MmapKV(%r)>" % (os.path.basename(self.path),)
+
+    def __len__(self):
+        "Return the amount of entries in this store (which is in the header, so cheap)"
+        return self._count
+
+    def __iter__(self):
+        "Using this object as an iterator yields its keys (equivalent to .iterkeys())"
+        return self.iterkeys()
+
+    def __getitem__(self, key):
+        "(only meant to support ValuesView and Itemsview)"
+        return self.get(key)
+
+    def __contains__(self, key):
+        "will return whether the store contains a key"
+        if not isinstance(key, str):
+            return False
+        key_bytes = key.encode("utf8")
+        i = self._lower_bound(key_bytes)
+        return i < self._count and self._key_bytes(i) == key_bytes
+
+    def __enter__(self):
+        "supports use as a context manager"
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        "supports use as a context manager - close()s on exit"
+        self.close()
+
+
+def write_mmapkv(store, path, compression: str = None, compression_level: int = None, description: str = None):
+    """Writes the contents of a store to a file that MmapKV can open.
+
+    Values must all be bytes, or all be str, or (e.g. from a MsgpackKV) things that msgpack can serialize.
+    Keys must be str.
+
+    We write to a temporary file next to the target, and rename it into place when done,
+    so that no one opens a half-written file.
+
+    @param store: a LocalKV, MsgpackKV, ShardedLocalKV - or anything with an items(), like a dict.
+    Metadata such as the description is copied from a LocalKV's meta table.
+    @param path: the file to write
+    @param compression: None, 'zlib', or 'zstd' (the latter needs the zstandard module installed), to compress each value.
+    @param compression_level: the compression level handed to zlib/zstd; None means their default.
+    @param description: if given, the description to store (instead of the one from the source store)
+    @return: the amount of items written
+    """
+    header_struct, index_struct = MmapKV._HEADER, MmapKV._INDEX_RECORD  # pylint: disable=protected-access
+    compression_code = {v: k for k, v in MmapKV._COMPRESSIONS.items()}.get(compression)  # pylint: disable=protected-access
+    if compression_code is None and compression is not None:
+        raise ValueError("compression should be None, 'zlib', or 'zstd', not %r" % compression)
+    zstd_compressor = None
+    if compression == "zstd":
+        import zstandard  # if this fails, you may need a    pip install zstandard
+
+        zstd_compressor = zstandard.ZstdCompressor(level=3 if compression_level is None else compression_level)
+
+    meta = {}
+    meta_store = store.shards[0] if isinstance(store, ShardedLocalKV) else store
+    if isinstance(meta_store, LocalKV):
+        for meta_key, meta_value in meta_store.conn.execute("SELECT key, value FROM meta"):
+            if meta_key not in ("num_items", "compression", "compression_dict", "valtype") and isinstance(meta_value, str):
+                meta[meta_key] = meta_value
+    if description is not None:
+        meta["description"] = description
+
+    if hasattr(store, "iteritems"):
+        items = store.iteritems()
+    else:
+        items = store.items()
+
+    value_type = "msgpack" if isinstance(meta_store, MsgpackKV) else None
+    records = []  # (key_bytes, value_offset, value_length)
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(b"\x00" * header_struct.size)  # (filled in at the end)
+            for key, value in items:
+                if not isinstance(key, str):
+                    raise TypeError("Keys in an MmapKV are str, not %s" % type(key).__name__)
+
+                if isinstance(value, bytes):
+                    this_type, data = "bytes", value
+                elif isinstance(value, str):
+                    this_type, data = "str", value.encode("utf8")
+                else:
+                    this_type, data = "msgpack", msgpack.dumps(value)
+                if value_type is None:
+                    value_type = this_type
+                elif this_type != value_type and value_type != "msgpack":
+                    raise TypeError(
+                        "Values should all be the same type, found a %s after %s values (at key %r)"
+                        % (type(value).__name__, value_type, key)
+                    )
+                elif value_type == "msgpack" and this_type != "msgpack":
+                    data = msgpack.dumps(value)
+
+                if compression is not None:
+                    compressed = None
+                    if len(data) >= _COMPRESS_MIN_SIZE:
+                        if compression == "zlib":
+                            level = -1 if compression_level is None else compression_level
+                            compressed = _VALUE_ZLIB + zlib.compress(data, level)
+                        else:
+                            compressed = _VALUE_ZSTD + zstd_compressor.compress(data)
+                    if compressed is None or len(compressed) > len(data):
+                        compressed = _VALUE_RAW + data
+                    data = compressed
+
+                records.append((key.encode("utf8"), f.tell(), len(data)))
+                f.write(data)
+
+            # same order as SQLite's (binary) collation, and python's str comparison, since UTF-8 bytes sort by codepoint
+            records.sort(key=lambda record: record[0])
+            for i in range(1, len(records)):
+                if records[i][0] == records[i - 1][0]:
+                    raise ValueError("Duplicate key %r" % records[i][0].decode("utf8"))
+
+            keys_offset = f.tell()
+            key_offsets = []
+            for key_bytes, _, _ in records:
+                key_offsets.append(f.tell())
+                f.write(key_bytes)
+
+            index_offset = f.tell()
+            for (key_bytes, value_offset, value_length), key_offset in zip(records, key_offsets):
+                f.write(index_struct.pack(key_offset, len(key_bytes), value_offset, value_length))
+
+            meta_offset = f.tell()
+            meta_bytes = json.dumps({"value_type": value_type, "meta": meta}).encode("utf8")
+            f.write(meta_bytes)
+
+            f.seek(0)
+            f.write(
+                header_struct.pack(
+                    MmapKV._MAGIC,  # pylint: disable=protected-access
+                    MmapKV._VERSION,  # pylint: disable=protected-access
+                    compression_code,
+                    0,
+                    len(records),
+                    keys_offset,
+                    index_offset,
+                    meta_offset,
+                    len(meta_bytes),
+                )
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(records)
 
 
 def cached_fetch(
@@ -678,7 +2763,9 @@ def cached_fetch(
     force_refetch: bool = False,
     sleep_sec: float = None,
     timeout: float = 20,
-    commit: bool = True,
+    commit: bool = None,
+    max_age: float = None,
+    attempts: int = None,
 ) -> Tuple[bytes, bool]:
     """Helper to fetch URL contents into str-to-bytes (url-to-content) LocalKV store:
       - if URL is a key in the given store,
@@ -691,14 +2778,27 @@ def cached_fetch(
 
     Arguably belongs in a mixin or such, but for now its usefulness puts it here.
 
+    With an ExpiringLocalKV, we also keep the ETag and Last-Modified the server sends,
+    and when we fetch again (because what we have is stale, or because of force_refetch), we make that a conditional request,
+    so that if it has not changed, the server need not send it again (we keep what we have, and mark it as fresh).
+    That can make refreshing a store a lot cheaper for both sides.  See also revalidation_counts().
+    (To get this for an existing LocalKV, open it as an ExpiringLocalKV instead)
+
     @param store:         a store to get/put data from
     @param url:           an URL string to fetch
     @param force_refetch: fetch even if we had it already
     @param sleep_sec:     sleep this long whenever we did an actual fetch (and not when we return data from cache), 
     so that when you use this in scraping, we can easily be nicer to a server.
     @param timeout:       timeout of te fetch
-    @param commit:        whether to put() with an immediate commit (False can help some faster bulk updates)
+    @param commit:        whether to put() with an immediate commit (False can help some faster bulk updates).
+    The default, None, follows the store's commit policy, so opening the store with e.g. commit_every=100
+    gets you batched writes without having to think about it here.
+    @param max_age:       only for an ExpiringLocalKV store: refetch if what we have is older than this many seconds.
+    None means the store's own default max_age - so with an ExpiringLocalKV, cached data goes stale without you having to ask.
+    @param attempts:      how many times to try the fetch when failures look temporary (see wetsuite.helpers.net.download()).
+    None means the default from wetsuite.helpers.net.configure_retries().
     @return:              (data:bytes, whether_it_came_from_cache:bool)
+    (after a conditional request that said what we had was still good, that is True)
 
     May raise
       - whatever requests.get may raise (e.g. "timeout waiting for store" type things)
@@ -706,9 +2806,9 @@ def cached_fetch(
         (which is behaviour from wetsuite.helpers.net.download())
         ...to force us to deal with issues and not store error pages.
     """
-    if not isinstance(store, LocalKV):
+    if not isinstance(store, (LocalKV, ShardedLocalKV)):
         raise TypeError(
-            "the store parameter should be a LocalKV or descendant, not %r"
+            "the store parameter should be a LocalKV or descendant (or a ShardedLocalKV), not %r"
             % (type(store))
         )
 
@@ -717,29 +2817,223 @@ def cached_fetch(
             "cached_fetch() expects a str:bytes store (or for you to disable checks with None,None),  not a %r:%r"
             % (store.key_type.__name__, store.value_type.__name__)
         )
+    if max_age is not None and not isinstance(store, ExpiringLocalKV):
+        raise TypeError("max_age only makes sense with an ExpiringLocalKV store, not a %r" % type(store))
+
     # yes, the following could be a few lines shorter, but this is arguably a little more readable
     if force_refetch is False:
         try:  # use cache?
-            ret = store.get(url)
+            if isinstance(store, ExpiringLocalKV):
+                ret = store.get(url, max_age=max_age)  # raises KeyError also when it is too old
+            else:
+                ret = store.get(url)
             return ret, True
-        except KeyError:  # get() notices it's not there, so fetch it ourselves
-            data = wetsuite.helpers.net.download(
-                url,
-                timeout=timeout
-            )  # note that this can error out, which we don't handle
-            store.put(url, data, commit=commit)
-            if sleep_sec is not None:
-                time.sleep(sleep_sec)
-            return data, False
+        except KeyError:  # get() notices it's not there (or too old), so fetch it ourselves
+            return _fetch_and_store(store, url, timeout=timeout, commit=commit, sleep_sec=sleep_sec, attempts=attempts)
     else:  # force_refetch is True
+        return _fetch_and_store(store, url, timeout=timeout, commit=commit, sleep_sec=sleep_sec, attempts=attempts)
+
+
+# counts for revalidation_counts()
+_revalidation_counts = {"not_modified": 0, "modified": 0, "bytes_saved": 0}
+
+
+def revalidation_counts(reset: bool = False) -> dict:
+    """How cached_fetch() and cached_fetch_many() fared with conditional requests (see cached_fetch()),
+    since the start (or the last reset):
+      - C{not_modified}: how often the server said what we had was still good (so we did not download it again)
+      - C{modified}: how often it sent new data instead
+      - C{bytes_saved}: the size of the data we did not have to download again, added up
+    @param reset: whether to set the counts back to zero (after returning them)
+    @return: a dict with those three keys.
+    """
+    ret = dict(_revalidation_counts)
+    if reset:
+        for key in _revalidation_counts:
+            _revalidation_counts[key] = 0
+    return ret
+
+
+def _fetch_and_store(store, url: str, timeout: float, commit: bool, sleep_sec: float, attempts: int = None):
+    """For internal use by cached_fetch(): fetch an URL and store it.
+    With an ExpiringLocalKV, this is a conditional request if we have validators for what we have,
+    and if that is still good, we keep it (and return it).
+    @return: (data, whether_it_came_from_cache)
+    """
+    if isinstance(store, ExpiringLocalKV):
+        info = store.get_info(url, missing_as_none=True) or {}
+        data, etag, last_modified = wetsuite.helpers.net.conditional_download(
+            url, etag=info.get("etag"), last_modified=info.get("last_modified"), timeout=timeout, attempts=attempts
+        )  # note that this can error out, which we don't handle
+        from_cache = data is None
+        if from_cache:  # not modified
+            data = LocalKV.get(store, url)  # (regardless of age, we just learned it is good)
+            store.touch(url, commit=commit, etag=etag, last_modified=last_modified)
+        else:
+            store.put(url, data, commit=commit, etag=etag, last_modified=last_modified)
+        _count_revalidation(info, from_cache, data)
+    else:
         data = wetsuite.helpers.net.download(
             url,
-            timeout=timeout
-        )
+            timeout=timeout,
+            attempts=attempts,
+        )  # note that this can error out, which we don't handle
+        from_cache = False
         store.put(url, data, commit=commit)
-        if sleep_sec is not None:
-            time.sleep(sleep_sec)
-        return data, False
+    if sleep_sec is not None:
+        time.sleep(sleep_sec)
+    return data, from_cache
+
+
+def _count_revalidation(info: dict, not_modified: bool, data: bytes):
+    "For internal use: counts the outcome of a fetch for revalidation_counts(), if it was a conditional request (info has validators)"
+    if info.get("etag") is None and info.get("last_modified") is None:
+        return
+    if not_modified:
+        _revalidation_counts["not_modified"] += 1
+        _revalidation_counts["bytes_saved"] += len(data)
+    else:
+        _revalidation_counts["modified"] += 1
+
+
+def cached_fetch_many(
+    store: LocalKV,
+    urls,
+    workers: int = 4,
+    per_host: int = 2,
+    rate: float = None,
+    force_refetch: bool = False,
+    max_age: float = None,
+    timeout: float = 20,
+    batch_size: int = 100,
+    chunk_size: int = 500,
+    yield_cached: bool = True,
+    errors: str = "raise",
+):
+    """Like cached_fetch() for many URLs: yields C{(url, data, whether_it_came_from_cache)} for each,
+    but is a lot faster when many of them are already in the store (as is typical when you re-crawl),
+    and when many are not:
+      - which URLs we have is checked a chunk at a time (see LocalKV.present_keys()), rather than with a query per URL
+      - the URLs we do not have are fetched concurrently (with a wetsuite.helpers.net.FetchEngine),
+        politely: at most per_host at a time per host, and optionally at most rate per second per host.
+      - what we fetched is written in batched transactions, rather than committing each.
+
+    Results come as they complete, so not in the order given.
+    Store access all happens in your thread, so you can use the store in the loop.
+
+    With an ExpiringLocalKV, refetches are conditional requests, as in cached_fetch()
+    (and what the server says is still good is yielded as from_cache).
+
+    @param store:         a str-to-bytes store to get/put data from, like cached_fetch()'s
+    @param urls:          an iterable of URL strings (can be a generator; we take from it a chunk at a time)
+    @param workers:       the most fetches underway at the same time (in total)
+    @param per_host:      the most fetches underway at the same time to the same host
+    @param rate:          if not None, the most fetches per second to the same host (on average)
+    @param force_refetch: fetch even if we had it already
+    @param max_age:       only for an ExpiringLocalKV store: refetch if what we have is older than this many seconds (see cached_fetch())
+    @param timeout:       timeout of each fetch
+    @param batch_size:    how many fetched items to write per transaction.
+    Anything fetched but not yet written is written when you stop iterating (including when you break out early).
+    @param chunk_size:    how many URLs to check for presence per query
+    @param yield_cached:  if False, we do not yield what we already had (nor read it from the store), only what we fetched.
+    Handy when you only want to fill the store.
+    @param errors:        what to do when a fetch fails (e.g. a 404):
+      - 'raise' (default): raise that error (after writing what we fetched so far)
+      - 'skip': leave it out (it is not stored, and not yielded)
+    @return: a generator of (url:str, data:bytes, from_cache:bool) tuples
+    """
+    if not isinstance(store, (LocalKV, ShardedLocalKV)):
+        raise TypeError(
+            "the store parameter should be a LocalKV or descendant (or a ShardedLocalKV), not %r"
+            % (type(store))
+        )
+    if store.key_type not in (str, None) or store.value_type not in (bytes, None):
+        raise TypeError(
+            "cached_fetch_many() expects a str:bytes store (or for you to disable checks with None,None),  not a %r:%r"
+            % (store.key_type.__name__, store.value_type.__name__)
+        )
+    if max_age is not None and not isinstance(store, ExpiringLocalKV):
+        raise TypeError("max_age only makes sense with an ExpiringLocalKV store, not a %r" % type(store))
+    if errors not in ("raise", "skip"):
+        raise ValueError("errors should be 'raise' or 'skip', not %r" % errors)
+
+    expiring = isinstance(store, ExpiringLocalKV)
+    urls = iter(urls)
+    exhausted = False
+    pending = {}  # future -> (url, info), where info is get_info() for a conditional request (with ExpiringLocalKV)
+    batch = []  # (url, data, etag, last_modified, not_modified)
+
+    def write_batch():
+        if expiring:  # (put_many would not keep the validators)
+            for url, data, etag, last_modified, not_modified in batch:
+                if not_modified:
+                    store.touch(url, commit=False, etag=etag, last_modified=last_modified)
+                else:
+                    store.put(url, data, commit=False, etag=etag, last_modified=last_modified)
+            store.commit()
+        else:
+            store.put_many(((url, data) for url, data, _, _, _ in batch), commit=True)
+        batch.clear()
+    with wetsuite.helpers.net.FetchEngine(per_host=per_host, rate=rate, concurrency=workers, timeout=timeout) as engine:
+        try:
+            while True:
+                # take another chunk of URLs when there is room for more fetches
+                while not exhausted and len(pending) < 4 * workers:
+                    chunk = list(itertools.islice(urls, chunk_size))
+                    if len(chunk) == 0:
+                        exhausted = True
+                        break
+                    if force_refetch:
+                        present = set()
+                    elif max_age is not None:
+                        present = store.present_keys(chunk, chunk_size=chunk_size, max_age=max_age)
+                    else:
+                        present = store.present_keys(chunk, chunk_size=chunk_size)
+                    for url in chunk:
+                        if url not in present:
+                            if expiring:
+                                info = store.get_info(url, missing_as_none=True) or {}
+                                fetcher = functools.partial(
+                                    wetsuite.helpers.net.conditional_download,
+                                    etag=info.get("etag"),
+                                    last_modified=info.get("last_modified"),
+                                )
+                                pending[engine.submit(url, fetcher=fetcher)] = (url, info)
+                            else:
+                                pending[engine.submit(url)] = (url, None)
+                    if yield_cached and len(present) > 0:
+                        for url, data in store.get_many(url for url in chunk if url in present).items():
+                            yield url, data, True
+
+                if len(pending) == 0:
+                    break
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    url, info = pending.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        if errors == "raise":
+                            raise exception
+                        continue
+                    etag, last_modified, not_modified = None, None, False
+                    if expiring:
+                        data, etag, last_modified = future.result()
+                        not_modified = data is None
+                        if not_modified:
+                            data = LocalKV.get(store, url)  # (regardless of age, we just learned it is good)
+                        _count_revalidation(info, not_modified, data)
+                    else:
+                        data = future.result()
+                    batch.append((url, data, etag, last_modified, not_modified))
+                    if len(batch) >= batch_size:
+                        write_batch()
+                    yield url, data, not_modified
+        finally:
+            for future in pending:
+                future.cancel()
+            if len(batch) > 0:
+                write_batch()
 
 
 def resolve_path(name: str):
@@ -813,7 +3107,8 @@ def list_stores(
     By default look in the directory that (everything that uses) resolve_path() puts things in,
     you can give it another directory to look in.
 
-    Will only look at direct contents of that directory.
+    Will only look at direct contents of that directory
+    (a sharded store, which is a directory of shard files, is listed as one entry, with a 'num_shards').
 
     @param skip_table_check: if true, only tests whether it's a sqlite file, not whether it contains the table we expect.
     because when it's in the stores directory, chances are we put it there, and we can avoid IO and locking.
@@ -839,7 +3134,24 @@ def list_stores(
 
     for basename in os.listdir(look_under):
         abspath = os.path.join(look_under, basename)
-        if os.path.isfile(abspath):
+        if sharded_store_paths(abspath) is not None:
+            kv = ShardedLocalKV(abspath, key_type=None, value_type=None, read_only=True)
+            itemdict = {
+                "path": abspath,
+                "basename": basename,
+            }
+            itemdict.update(kv.summary(get_num_items=get_num_items))
+            valtype = kv._get_meta("valtype", True)  # pylint: disable=protected-access
+            if valtype is not None:
+                itemdict["valtype"] = valtype
+            if kv.shards[0].compression is not None:
+                itemdict["compression"] = kv.shards[0].compression
+            itemdict["description"] = kv._get_meta( # pylint: disable=protected-access
+                "description", True
+            )
+            ret.append(itemdict)
+            kv.close()
+        elif os.path.isfile(abspath):
             if is_file_a_store(abspath, skip_table_check=skip_table_check):
                 kv = LocalKV(abspath, key_type=None, value_type=None, read_only=True)
                 itemdict = {
@@ -855,6 +3167,9 @@ def list_stores(
                 except KeyError:
                     pass
 
+                if kv.compression is not None:
+                    itemdict["compression"] = kv.compression
+
                 itemdict["description"] = kv._get_meta( # pylint: disable=protected-access
                     "description", True
                 )
@@ -869,10 +3184,19 @@ def is_file_a_store(path, skip_table_check: bool = False):
 
     You can skip the latter test. It avoids opening the file, so avoids a possible timeout on someone else having the store open for writing.
 
+    Also says True for a directory that is a sharded store (see ShardedLocalKV) - if each of its shards passes the same test.
+
     @param path: the filesystem path to test
     @param skip_table_check: don't check for the right table name, e.g. to make it faster or avoid opening a store
     @return: Whether it seems like a store we could open
     """
+    shard_paths = sharded_store_paths(path)
+    if shard_paths is not None:
+        return all(
+            is_file_a_store(shard_path, skip_table_check=skip_table_check)
+            for shard_path in shard_paths
+        )
+
     if not os.path.isfile(path):
         return False
 
@@ -1,16 +1,252 @@
 #!/usr/bin/python3
 " network related helper functions, such as fetching from URLs "
 import sys
+import os
+import re
+import json
+import time
+import random
+import datetime
+import email.utils
+import asyncio
+import hashlib
+import secrets
+import functools
+import threading
+import urllib.parse
+import concurrent.futures
+import zlib
+import lzma
+import bz2
 
 import requests
+import requests.adapters
 
 import wetsuite.helpers.format
+import wetsuite.helpers.util
+
+
+class HTTPStatusError(ValueError):
+    """Raised by download() when the server responds with an error status (e.g. 404, 503).
+    A ValueError, as download() raised before this existed.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: float = None):
+        """
+        @param status_code: the HTTP status
+        @param retry_after: how many seconds the server asked us to wait before trying again (its Retry-After header), if it did.
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class IncompleteDownloadError(ValueError):
+    "Raised by download() when the connection ended before we received all the server said it would send."
+
+
+# The defaults for download()'s retries, see configure_retries()
+_retry_config = {
+    "attempts": 3,
+    "backoff": 1.0,
+    "max_backoff": 60.0,
+    "max_retry_after": 300.0,
+}
+_RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+_retry_counts = {}  # (what, reason) -> count, see retry_counts()
+_retry_counts_lock = threading.Lock()
+
+
+def configure_retries(attempts: int = 3, backoff: float = 1.0, max_backoff: float = 60.0, max_retry_after: float = 300.0):
+    """Changes the defaults for how download() (and so everything that uses it) retries fetches that failed in a way that may be temporary.
+    @param attempts: how many times to try in total (1 means no retries)
+    @param backoff: the wait before the first retry is up to this many seconds; it doubles with every next retry...
+    @param max_backoff: ...up to this many seconds.
+    @param max_retry_after: when a server asks us (with Retry-After) to wait longer than this many seconds, we give up instead.
+    """
+    _retry_config.update(
+        {"attempts": attempts, "backoff": backoff, "max_backoff": max_backoff, "max_retry_after": max_retry_after}
+    )
+
+
+def retry_counts(reset: bool = False) -> dict:
+    """How often download() (and conditional_download()) retried, and gave up, since the start (or the last reset), per reason.
+    Meant for long-running crawls, to see whether a server is struggling (and you should slow down).
+    @param reset: whether to set the counts back to zero (after returning them)
+    @return: a dict like C{ {'retried': {'status 503': 4, 'ConnectionError': 1}, 'gave_up': {'status 503': 1}} }
+    """
+    ret = {"retried": {}, "gave_up": {}}
+    with _retry_counts_lock:
+        for (what, reason), count in _retry_counts.items():
+            ret[what][reason] = count
+        if reset:
+            _retry_counts.clear()
+    return ret
+
+
+def _count_retry(what: str, reason: str):
+    "For internal use by download(): counts a retry or giving up, for retry_counts()"
+    with _retry_counts_lock:
+        _retry_counts[(what, reason)] = _retry_counts.get((what, reason), 0) + 1
+
+
+def _retry_reason(exception: Exception):
+    """For internal use by download(): whether an exception is worth retrying for.
+    @return: a short description of why we would retry (e.g. 'status 503', 'ConnectionError'), or None if we should not.
+    """
+    if isinstance(exception, HTTPStatusError):
+        if exception.status_code in _RETRY_STATUSES:
+            return "status %d" % exception.status_code
+        return None
+    if isinstance(exception, requests.exceptions.SSLError):  # (a ConnectionError, but trying again will not help)
+        return None
+    if isinstance(
+        exception,
+        (
+            requests.exceptions.ConnectionError,  # includes ConnectTimeout
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,  # what a connection breaking partway often looks like
+            IncompleteDownloadError,
+        ),
+    ):
+        return type(exception).__name__
+    return None
+
+
+def _retry_delay(exception: Exception, attempt: int, backoff: float):
+    """For internal use by download(): how long to wait before the next attempt, after the given attempt (counting from 1) failed.
+    @return: seconds, or None if the server asked us to wait longer than we are willing to.
+    """
+    retry_after = getattr(exception, "retry_after", None)
+    if retry_after is not None and getattr(exception, "status_code", None) in (429, 503):
+        if retry_after > _retry_config["max_retry_after"]:
+            return None
+        return retry_after
+    # 'full jitter': anywhere between nothing and the exponential backoff, so that clients that failed together do not return together
+    return random.uniform(0, min(_retry_config["max_backoff"], backoff * 2 ** (attempt - 1)))
+
+
+def _parse_retry_after(value: str):
+    "For internal use: a Retry-After header's value (seconds, or a HTTP date) as seconds from now, or None if absent or unparseable"
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+# The session that our fetching shares, so that repeated fetches from the same host reuse connections
+# (which saves a TCP and TLS handshake per fetch).  Created on first use, see session() and configure_session().
+_session = None
+_session_lock = threading.Lock()
+_session_config = {
+    "pool_connections": 10,  # how many hosts we keep connections for
+    "pool_maxsize": 10,  # how many connections we keep per host
+    "pool_block": False,
+    "keep_alive": True,
+    "headers": None,
+}
+
+
+def session() -> requests.Session:
+    """The requests.Session that wetsuite's fetching code shares (download(), and e.g. the SRU, AKN and lawref code),
+    so that many fetches to the same few hosts keep reusing connections (HTTP keep-alive),
+    rather than each paying for a new connection (and TLS handshake).
+
+    You can use it for your own fetches too.
+    This module uses it from multiple threads (e.g. FetchEngine, and segmented downloads), but only for plain requests,
+    which is fine because urllib3's connection pools are thread-safe - requests.Session itself makes no such promise,
+    so do not change it (its headers, cookies, adapters) while it may be in use; use configure_session() before you start instead.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _make_session(**_session_config)
+        return _session
+
+
+def configure_session(
+    pool_connections: int = 10,
+    pool_maxsize: int = 10,
+    pool_block: bool = False,
+    keep_alive: bool = True,
+    headers: dict = None,
+):
+    """Changes how the shared session (see session()) pools connections.
+    This replaces the session (closing the connections of the old one), so is best done before fetching anything.
+
+    @param pool_connections: for how many different hosts we keep connections around.
+    @param pool_maxsize: how many connections to one host we keep around (more can be opened at the same time, see pool_block).
+    @param pool_block: if True, pool_maxsize is a hard limit on connections per host: more concurrent fetches wait for a free connection.
+    If False (the default), they open an extra connection that is closed after use.
+    @param keep_alive: if False, we ask servers to close connections after each fetch (which mostly makes sense for testing).
+    @param headers: headers to send with every request (e.g. a User-Agent), in addition to those of requests itself.
+    """
+    global _session
+    with _session_lock:
+        _session_config.update(
+            {
+                "pool_connections": pool_connections,
+                "pool_maxsize": pool_maxsize,
+                "pool_block": pool_block,
+                "keep_alive": keep_alive,
+                "headers": headers,
+            }
+        )
+        if _session is not None:
+            _session.close()
+        _session = _make_session(**_session_config)
+
+
+def _make_session(pool_connections, pool_maxsize, pool_block, keep_alive, headers) -> requests.Session:
+    "For internal use by session() and configure_session(): makes a requests.Session with the given pooling configuration"
+    ret = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block
+    )
+    ret.mount("http://", adapter)
+    ret.mount("https://", adapter)
+    if not keep_alive:
+        ret.headers["Connection"] = "close"
+    if headers is not None:
+        ret.headers.update(headers)
+    return ret
+
+
+# The headers that all of our fetches send (on top of the session's)
+_DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0"
+}
+
+
+def _request_headers() -> dict:
+    "For internal use by download() and conditional_download(): a new dict with the headers we send with every fetch, to add request-specific ones to"
+    return dict(_DEFAULT_HEADERS)
 
 
 def download(
-    url: str, tofile_path: str = None, show_progress=None, chunk_size=131072, params=None, timeout=10
+    url: str,
+    tofile_path: str = None,
+    show_progress=None,
+    chunk_size=131072,
+    params=None,
+    timeout=10,
+    decompress: str = None,
+    total_size: int = None,
+    resume: bool = False,
+    checksum: str = None,
+    segments: int = None,
+    attempts: int = None,
+    backoff: float = None,
 ):
-    """Mostly just requests.get(), for byte-data download, 
+    """Mostly just requests.get() (on our shared session, see session()), for byte-data download, 
     with some options that make it a little more specifically useful for downloading.
 
     The main addition is the option to stream-download to filesystem:
@@ -18,71 +254,364 @@ def download(
       - if tofile is None      we return the data as a bytes object (which means we kept it in RAM, which may not be wise for huge downloads)
     uses requests's stream=True, which seems chunked HTTP transfer, or just a TCP window? TOCHECK
 
+    When streaming to a file, we write to a temporary file next to it, and rename that into place only once the download completed,
+    so that the path never has a partial download (and if the download fails, it is left as it was).
+
     @param tofile_path: If this is non-None, we open it as a filename and _stream_ the download to that if we can.
     @param show_progress: whether to print/show output on stderr while downloading.
     @param url: the URL to fetch data from
     @param chunk_size: chunk byte size when trying to stream.
     @param params: passed through to requests.get(): a dictionary, list of tuples or bytes to send as a query string.
     @param timeout: timeout to pass on to requests.get
+    @param decompress: if not None, decompress the data as it comes in, so that you get (or we write) the decompressed data
+    without needing the space for the compressed file as well, or a second pass over it.
+    One of 'xz', 'bz2', 'gz', or 'zstd' (the latter needs the zstandard module installed).
+    @param total_size: what size to show progress against. By default this is the Content-Length the server mentions,
+    but when decompressing that is not what we count, so you may want to give the decompressed size, if you know it.
+    @param resume: only when downloading to a file: if the download is interrupted, keep what we got,
+    so that calling this again with the same arguments continues where it left off (using a HTTP Range request)
+    instead of starting over. What we got so far is kept in tofile_path+'.part', and a sidecar file tofile_path+'.part.json'
+    that remembers the URL, length, and ETag/Last-Modified (so that if the file on the server changed, we start over).
+    Notes:
+      - this needs the server to support Range requests; if it does not, we start over (as we would without resume)
+      - when also decompressing, the .part file is the data as transferred (compressed), which we need to keep until we are done,
+        so you need space for both that and the decompressed result.
+    @param checksum: if given, the expected hash of the data as transferred (before any decompression),
+    as a hex digest, optionally prefixed with the hashlib algorithm name, e.g. 'blake2b:1f3a...'. Without a prefix we assume sha256.
+    We hash while downloading, and raise ValueError if it does not match (and not keep the file).
+    @param segments: only when downloading to a file: if more than 1, download this many byte ranges of the file concurrently,
+    each over its own connection, which can be faster than one connection when that one does not fill your link.
+    Each segment is retried by itself (continuing where it was) a few times when it fails in a way that may be temporary (see Retries, below).
+    Only applies if the server says it supports Range requests (and the file is not tiny), and when not decompressing
+    (which needs the data in order, and is best done while streaming); otherwise we silently do the usual single download.
+    Works together with resume (the sidecar then remembers how far each segment got)
+    and with checksum (which then happens in a pass over the downloaded file, after downloading).
+    @param attempts: how many times to try, when a fetch fails in a way that may be temporary (see below). None means the default (see configure_retries()).
+    Without resume, each attempt starts over; with resume, each continues where the last got.
+    @param backoff: the base of the wait between attempts, in seconds. None means the default (see configure_retries()).
+
+    Retries: connection errors, timeouts, connections that break partway, and the HTTP statuses that say 'try again later'
+    (408, 429, 500, 502, 503, 504) are considered temporary. We wait before trying again: exponentially longer
+    (backoff, 2*backoff, 4*backoff...; up to a maximum), randomized (so that many clients do not come back at the same moment).
+    If a 429 or 503 response says how long to wait (Retry-After), we wait that long instead.
+    Other errors (e.g. a 404, or a checksum mismatch) are raised right away.
+    How often each of that happened is counted, see retry_counts().
 
     @return: byte
-    if the HTTP response code is >=400 (actually if !response.ok, see requests's documentation), we raise a ValueError
+    if the HTTP response code is >=400 (actually if !response.ok, see requests's documentation), we raise a HTTPStatusError (a ValueError)
+    Also raises ValueError when we received less (IncompleteDownloadError) or more than the server said it would send,
+    and whatever requests raises when the connection fails (all of those after retrying, if applicable).
     """
-    if tofile_path is not None:
-        f = open(tofile_path, "wb")
+    return _with_retries(
+        functools.partial(
+            _download_attempt,
+            url, tofile_path=tofile_path, show_progress=show_progress, chunk_size=chunk_size, params=params,
+            timeout=timeout, decompress=decompress, total_size=total_size, resume=resume, checksum=checksum, segments=segments,
+        ),
+        url, attempts=attempts, backoff=backoff, show_progress=show_progress,
+    )
 
-        def handle_chunk(data):
-            f.write(data)
 
-    else:
-        ret = []
+def conditional_download(
+    url: str,
+    etag: str = None,
+    last_modified: str = None,
+    timeout=10,
+    attempts: int = None,
+    backoff: float = None,
+):
+    """Fetches an URL unless it has not changed since we last fetched it - a HTTP conditional request.
 
-        def handle_chunk(data):
-            ret.append(data)  # CONSIDER: using bytesIO to collect that
+    Hand in the ETag and/or Last-Modified that the server sent last time (e.g. as kept by an ExpiringLocalKV),
+    and if the server says it has not changed (304 Not Modified), it does not send the data again.
+
+    Meant for smaller documents: this keeps the data in memory, like download() without tofile_path.
+    Retries like download() does.
+
+    @param etag: the ETag the server sent with the copy we have (sent as If-None-Match), or None.
+    @param last_modified: the Last-Modified the server sent with the copy we have (sent as If-Modified-Since), or None.
+    With neither, this is an unconditional fetch - that still tells you the validators to keep for next time.
+    @return: a tuple (data, etag, last_modified):
+      - data is the data as bytes, or None if the server said it had not changed
+      - etag and last_modified are what the server sent this time (to keep for next time), or None if it sent none
+    Raises like download() does.
+    """
+    headers = _request_headers()
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    return _with_retries(
+        functools.partial(_conditional_attempt, url, headers, timeout), url, attempts=attempts, backoff=backoff
+    )
 
+
+def _conditional_attempt(url: str, headers: dict, timeout):
+    "For internal use by conditional_download(): one attempt at it"
+    response = session().get(url, headers=headers, timeout=timeout)
+    validators = response.headers.get("ETag"), response.headers.get("Last-Modified")
+    if response.status_code == 304:
+        return (None,) + validators
+    if not response.ok:
+        raise HTTPStatusError(
+            f"Response not OK, status={response.status_code} for url={repr(url)}",
+            status_code=response.status_code,
+            retry_after=_parse_retry_after(response.headers.get("Retry-After")),
+        )
+    expected_length = response.headers.get("Content-Length")
+    if (
+        expected_length is not None
+        and response.headers.get("Content-Encoding", "identity") == "identity"
+        and len(response.content) < int(expected_length)
+    ):
+        raise IncompleteDownloadError(
+            "Download of %r ended after %d of %s bytes" % (url, len(response.content), expected_length)
+        )
+    return (response.content,) + validators
+
+
+def _with_retries(attempt_func, url: str, attempts: int = None, backoff: float = None, show_progress=False):
+    """For internal use by download() and conditional_download(): calls attempt_func() until it succeeds,
+    retrying when it fails in a way that may be temporary (see download() for details).
+    @param url: only used in messages
+    """
+    if attempts is None:
+        attempts = _retry_config["attempts"]
+    if backoff is None:
+        backoff = _retry_config["backoff"]
+    attempt = 1
+    while True:
+        try:
+            return attempt_func()
+        except Exception as e:
+            reason = _retry_reason(e)
+            if reason is None:
+                raise
+            if attempt >= attempts:
+                _count_retry("gave_up", reason)
+                raise
+            delay = _retry_delay(e, attempt, backoff)
+            if delay is None:  # the server asked us to wait longer than we are willing to
+                _count_retry("gave_up", reason)
+                raise
+            _count_retry("retried", reason)
+            if show_progress:
+                print("\n%s fetching %r, trying again in %.1f seconds" % (reason, url, delay), file=sys.stderr)
+            time.sleep(delay)
+            attempt += 1
+
+
+def _download_attempt(
+    url: str,
+    tofile_path: str = None,
+    show_progress=None,
+    chunk_size=131072,
+    params=None,
+    timeout=10,
+    decompress: str = None,
+    total_size: int = None,
+    resume: bool = False,
+    checksum: str = None,
+    segments: int = None,
+):
+    "For internal use by download(), which explains the arguments: one attempt at it (download() retries this)."
     def progress_update():
         # TODO: consider using our own notebook.progress_bar here
         bar_str = ""
-        if total_length is not None:
-            frac = float(fetched) / total_length
+        if total_length is not None and total_length > 0:
+            frac = min(float(fetched) / total_length, 1.0)
             width = 50
-            bar_str = "[%s%s]" % (
+            bar_str = "[%s%s] %3d%%" % (
                 "=" * int(frac * width),
                 " " * (width - int(frac * width)),
+                100 * frac,
             )
         return "\rDownloaded %8sB  %s" % (
             wetsuite.helpers.format.kmgtp(fetched, kilo=1024),
             bar_str,
         )
 
-    response = requests.get(
+    headers = _request_headers()
+
+    if tofile_path is not None:
+        tofile_path = os.fspath(tofile_path)
+
+    offset = 0  # how much we already have from an earlier attempt
+    sidecar = None
+    if resume:
+        if tofile_path is None:
+            raise ValueError("resume only applies when downloading to a file (tofile_path)")
+        part_path, sidecar_path = tofile_path + ".part", tofile_path + ".part.json"
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        sidecar = _read_sidecar(sidecar_path)
+        if (
+            sidecar is not None
+            and sidecar.get("url") == full_url
+            and "segments" not in sidecar  # (that .part is preallocated, so its size says nothing)
+            and os.path.exists(part_path)
+        ):
+            offset = os.path.getsize(part_path)
+
+    if segments is not None and segments > 1:
+        if tofile_path is None:
+            raise ValueError("segments only applies when downloading to a file (tofile_path)")
+        # Not when decompressing: that has to see the data in order, so would need the whole compressed file
+        # next to the result, where the sequential path decompresses as it streams.
+        # Nor when continuing a sequential download we were interrupted in.
+        if decompress is None and offset == 0:
+            probe = _probe_ranges(url, headers, params, timeout, min_size=segments * _MIN_SEGMENT_SIZE)
+            if probe is not None:
+                _download_segmented(
+                    url, tofile_path, probe, segments, headers, params=params, timeout=timeout, chunk_size=chunk_size,
+                    show_progress=show_progress, resume=resume, checksum=checksum,
+                )
+                return None
+
+    if offset > 0:
+        headers["Range"] = "bytes=%d-" % offset
+        # If-Range means: only send that range if the file is still what we started fetching; otherwise send all of it
+        validator = _if_range_validator(sidecar)
+        if validator is not None:
+            headers["If-Range"] = validator
+
+    response = session().get(
         url,
         stream=True,
-        headers={
-            "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0"
-        },
+        headers=headers,
         params=params,
         timeout=timeout,
     )
-    total_length = response.headers.get("content-length")
 
-    if not response.ok:
-        raise ValueError(
-            f"Response not OK, status={response.status_code} for url={repr(url)}"
-        )
+    if resume and response.status_code == 416 and offset > 0:
+        # 'range not satisfiable' - we probably had all of it, and failed after that. Or something is off, so start over.
+        response.close()
+        if offset != sidecar.get("length"):
+            _remove_if_exists(part_path)
+            _remove_if_exists(sidecar_path)
+            return _download_attempt(
+                url, tofile_path=tofile_path, show_progress=show_progress, chunk_size=chunk_size, params=params,
+                timeout=timeout, decompress=decompress, total_size=total_size, resume=resume, checksum=checksum,
+            )
+        network_chunks = iter(())
+        expected_length = offset
+    else:
+        if not response.ok:
+            response.close()
+            raise HTTPStatusError(
+                f"Response not OK, status={response.status_code} for url={repr(url)}",
+                status_code=response.status_code,
+                retry_after=_parse_retry_after(response.headers.get("Retry-After")),
+            )
+        network_chunks = response.iter_content(chunk_size=chunk_size)
+        if response.status_code != 206:  # a complete response, e.g. because the file changed; start over
+            offset = 0
+        expected_length = _expected_length(response, offset)
 
-    if total_length is not None:
-        total_length = int(total_length)
-        # show_progress = True
-        # chunkrange = range(total_length/chunksize)
+    if resume:
+        _write_sidecar(sidecar_path, {
+            "url": full_url,
+            "length": expected_length,
+            "etag": response.headers.get("ETag", (sidecar or {}).get("etag") if offset > 0 else None),
+            "last_modified": response.headers.get("Last-Modified", (sidecar or {}).get("last_modified") if offset > 0 else None),
+        })
 
-    fetched = 0
-    for data in response.iter_content(chunk_size=chunk_size):
-        handle_chunk(data)
-        fetched += len(data)
-        if show_progress:
-            sys.stderr.write(progress_update())
-            sys.stderr.flush()
+    total_length = expected_length
+    if decompress is not None:
+        total_length = None  # the Content-Length is of the compressed data, so not what we count
+    if total_size is not None:
+        total_length = total_size
+
+    hasher, expected_digest = None, None
+    if checksum is not None:
+        hasher, expected_digest = _make_hasher(checksum)
+
+    # Where things go:
+    #   - with resume, the data as transferred goes into the .part file
+    #   - what you asked for (decompressed, if applicable) goes into a temporary file, or memory, or (resume without decompress) is that .part file
+    raw_f = None
+    if resume:
+        raw_f = open(part_path, "ab" if offset > 0 else "wb")
+    tmp_path = None
+    if tofile_path is not None and not (resume and decompress is None):
+        f, tmp_path = _create_beside(tofile_path, ".tmp")
+
+        def handle_chunk(data):
+            f.write(data)
+
+    elif tofile_path is None:
+        ret = []
+
+        def handle_chunk(data):
+            ret.append(data)  # CONSIDER: using bytesIO to collect that
+
+    else:  # resume without decompress: the .part file _is_ the output
+
+        def handle_chunk(data):
+            pass
+
+    received = offset  # how much of the data as transferred we have
+
+    def raw_chunks():
+        "the data as transferred, and on the way also hash and store it. Includes what we had from earlier attempts, if we need to see it again"
+        nonlocal received
+        if offset > 0 and (hasher is not None or decompress is not None):
+            with open(part_path, "rb") as earlier_f:
+                while True:
+                    data = earlier_f.read(chunk_size)
+                    if len(data) == 0:
+                        break
+                    if hasher is not None:
+                        hasher.update(data)
+                    yield data
+        for data in network_chunks:
+            if hasher is not None:
+                hasher.update(data)
+            if raw_f is not None:
+                raw_f.write(data)
+            received += len(data)
+            yield data
+
+    chunks = raw_chunks()
+    if decompress is not None:
+        chunks = _decompress_chunks(chunks, decompress)
+
+    fetched = offset if (resume and decompress is None) else 0
+    try:
+        try:
+            for data in chunks:
+                handle_chunk(data)
+                fetched += len(data)
+                if show_progress:
+                    sys.stderr.write(progress_update())
+                    sys.stderr.flush()
+        finally:
+            if raw_f is not None:
+                raw_f.close()
+            if tmp_path is not None:
+                f.close()
+
+        if expected_length is not None and received != expected_length:
+            if received > expected_length:  # something is off, don't try to continue from this
+                if resume:
+                    _remove_if_exists(part_path)
+                    _remove_if_exists(sidecar_path)
+            raise (IncompleteDownloadError if received < expected_length else ValueError)(
+                "Download of %r ended after %d of %d bytes%s"
+                % (url, received, expected_length, " (call again to resume)" if resume and received < expected_length else "")
+            )
+
+        if hasher is not None and hasher.hexdigest() != expected_digest:
+            if resume:  # do not resume from bad data
+                _remove_if_exists(part_path)
+                _remove_if_exists(sidecar_path)
+            raise ValueError(
+                "Download of %r does not match the expected checksum (got %s, expected %s)"
+                % (url, hasher.hexdigest(), expected_digest)
+            )
+    except BaseException:
+        if tmp_path is not None:
+            _remove_if_exists(tmp_path)
+        raise
 
     if show_progress:
         sys.stderr.write(progress_update() + "\n")
@@ -90,3 +619,517 @@ def download(
 
     if tofile_path is None:
         return b"".join(ret)
+
+    if tmp_path is not None:
+        os.replace(tmp_path, tofile_path)
+        if resume:
+            _remove_if_exists(part_path)
+    else:
+        os.replace(part_path, tofile_path)
+    if resume:
+        _remove_if_exists(sidecar_path)
+    return None
+
+
+_MIN_SEGMENT_SIZE = 1048576  # files smaller than segments times this are not worth segmenting
+_SEGMENT_RETRIES = 3
+
+
+def _if_range_validator(meta: dict):
+    """For internal use: what to send in If-Range, given a dict with 'etag' and 'last_modified' (e.g. a sidecar)
+    - the ETag if we have a strong one (weak ones are not allowed there), otherwise the Last-Modified, or None if we have neither.
+    """
+    etag = meta.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return meta.get("last_modified")
+
+
+def _probe_ranges(url: str, headers: dict, params, timeout, min_size: int = 0):
+    """For internal use by download(): asks the server (with a HEAD request) whether it supports Range requests for this URL.
+    @return: a dict with 'url' (after redirects), 'length', 'etag', 'last_modified' if it does (and the file is at least min_size),
+    or None if it does not, or we can't tell.
+    """
+    try:
+        response = session().head(url, headers=headers, params=params, timeout=timeout, allow_redirects=True)
+    except requests.RequestException:
+        return None
+    if (
+        not response.ok
+        or response.headers.get("Accept-Ranges", "").strip().lower() != "bytes"
+        or response.headers.get("Content-Encoding", "identity") != "identity"
+        or response.headers.get("Content-Length") is None
+    ):
+        return None
+    length = int(response.headers["Content-Length"])
+    if length < max(min_size, 1):
+        return None
+    return {
+        "url": response.url,
+        "length": length,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def _download_segmented(
+    url, tofile_path, probe, segments, headers, params, timeout, chunk_size, show_progress, resume, checksum
+):
+    """For internal use by download(), which explains the arguments: the segments variant (never used when decompressing).
+
+    Preallocates the file, downloads byte ranges into it from a few threads (each retrying its own range),
+    then, if asked to check a checksum, does that in a pass over the file, and moves it into place.
+    """
+    length = probe["length"]
+    full_url = requests.Request("GET", url, params=params).prepare().url
+    if resume:
+        part_path, sidecar_path = tofile_path + ".part", tofile_path + ".part.json"
+    else:
+        part_f, part_path = _create_beside(tofile_path, ".part")
+        part_f.close()
+        sidecar_path = None
+
+    # each segment is a list [start, position, end], with end inclusive, and position updated as we write
+    todo = None
+    if resume:
+        sidecar = _read_sidecar(sidecar_path)
+        if (  # continue an earlier segmented download of the same thing?
+            sidecar is not None
+            and sidecar.get("url") == full_url
+            and sidecar.get("length") == length
+            and _if_range_validator(sidecar) == _if_range_validator(probe)
+            and "segments" in sidecar
+            and os.path.exists(part_path)
+            and os.path.getsize(part_path) == length
+        ):
+            todo = sidecar["segments"]
+    if todo is None:
+        segment_size = -(-length // segments)  # (rounded up)
+        todo = list([start, start, min(start + segment_size, length) - 1] for start in range(0, length, segment_size))
+        with open(part_path, "wb") as f:
+            if hasattr(os, "posix_fallocate"):  # actually reserve the space, so that we fail now rather than halfway
+                os.posix_fallocate(f.fileno(), 0, length)
+            else:
+                f.truncate(length)
+
+    def write_sidecar():
+        if sidecar_path is not None:
+            _write_sidecar(sidecar_path, {
+                "url": full_url,
+                "length": length,
+                "etag": probe["etag"],
+                "last_modified": probe["last_modified"],
+                "segments": todo,
+            })
+
+    write_sidecar()
+
+    lock = threading.Lock()
+    cancel = threading.Event()
+    fetched = sum(segment[1] - segment[0] for segment in todo)
+    validator = _if_range_validator(probe)
+
+    def fetch_segment(segment):
+        """downloads the rest of one segment into the file, continuing from where it got when the connection fails.
+        Failures that may be temporary are retried (up to _SEGMENT_RETRIES times) with the same backoff and Retry-After handling as download()'s;
+        anything else cancels all segments."""
+        nonlocal fetched
+        attempt = 1
+        while segment[1] <= segment[2] and not cancel.is_set():
+            segment_headers = dict(headers)
+            segment_headers["Range"] = "bytes=%d-%d" % (segment[1], segment[2])
+            if validator is not None:
+                segment_headers["If-Range"] = validator
+            try:
+                with session().get(url, stream=True, headers=segment_headers, params=params, timeout=timeout) as response:
+                    if not response.ok:
+                        raise HTTPStatusError(
+                            f"Response not OK, status={response.status_code} for url={repr(url)}",
+                            status_code=response.status_code,
+                            retry_after=_parse_retry_after(response.headers.get("Retry-After")),
+                        )
+                    if response.status_code != 206:  # e.g. the file changed, so it sends all of it; retrying will not help
+                        raise ValueError(
+                            "Asked for a range of %r, got status %d (did the file change?)" % (url, response.status_code)
+                        )
+                    if _expected_length(response, segment[1]) != length:
+                        raise ValueError("The length of %r changed while we were downloading it" % url)
+                    with open(part_path, "r+b") as f:
+                        f.seek(segment[1])
+                        for data in response.iter_content(chunk_size=chunk_size):
+                            if cancel.is_set():
+                                return
+                            data = data[: segment[2] + 1 - segment[1]]
+                            f.write(data)
+                            segment[1] += len(data)
+                            with lock:
+                                fetched += len(data)
+                    if segment[1] <= segment[2] and not cancel.is_set():
+                        raise IncompleteDownloadError(
+                            "Range of %r ended at %d, before %d" % (url, segment[1], segment[2] + 1)
+                        )
+            except Exception as e:
+                reason = _retry_reason(e)
+                if reason is None:
+                    cancel.set()
+                    raise
+                if attempt > _SEGMENT_RETRIES:
+                    _count_retry("gave_up", reason)
+                    raise
+                delay = _retry_delay(e, attempt, _retry_config["backoff"])
+                if delay is None:  # the server asked us to wait longer than we are willing to
+                    _count_retry("gave_up", reason)
+                    raise
+                _count_retry("retried", reason)
+                cancel.wait(delay)
+                attempt += 1
+
+    def progress_update():
+        frac = min(float(fetched) / length, 1.0)
+        width = 50
+        return "\rDownloaded %8sB  [%s%s] %3d%%  (%d connections)" % (
+            wetsuite.helpers.format.kmgtp(fetched, kilo=1024),
+            "=" * int(frac * width),
+            " " * (width - int(frac * width)),
+            100 * frac,
+            len(todo),
+        )
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(todo)) as pool:
+            futures = list(pool.submit(fetch_segment, segment) for segment in todo)
+            try:
+                while True:
+                    done, not_done = concurrent.futures.wait(
+                        futures, timeout=0.25, return_when=concurrent.futures.FIRST_EXCEPTION
+                    )
+                    if show_progress:
+                        sys.stderr.write(progress_update())
+                        sys.stderr.flush()
+                    if len(not_done) == 0 or any(future.exception() is not None for future in done):
+                        break
+                for future in futures:
+                    future.result()  # raises what the segment raised, if anything
+            except BaseException:
+                cancel.set()  # (and the with waits for the threads to notice that)
+                raise
+        if show_progress:
+            sys.stderr.write(progress_update() + "\n")
+            sys.stderr.flush()
+        if any(segment[1] <= segment[2] for segment in todo):
+            raise ValueError("Download of %r did not complete" % url)
+    except BaseException:
+        if resume:
+            write_sidecar()  # so that the next call continues from here
+        else:
+            _remove_if_exists(part_path)
+        raise
+
+    # the checksum needs to see the data in order, so is a pass over the file once it is complete
+    if checksum is not None:
+        hasher, expected_digest = _make_hasher(checksum)
+        digest = wetsuite.helpers.util.hash_file(part_path, hasher.name)
+        if digest != expected_digest:
+            _remove_if_exists(part_path)  # bad data - don't keep it
+            if sidecar_path is not None:
+                _remove_if_exists(sidecar_path)
+            raise ValueError(
+                "Download of %r does not match the expected checksum (got %s, expected %s)"
+                % (url, digest, expected_digest)
+            )
+    os.replace(part_path, tofile_path)
+    if sidecar_path is not None:
+        _remove_if_exists(sidecar_path)
+
+
+def _expected_length(response, offset: int):
+    """For internal use by download(): how long the whole of the data is, judging from the response headers - or None if we can't tell.
+    For a 206 Partial Content, also checks that it starts where we asked it to (raises ValueError if not).
+    """
+    if response.status_code == 206:
+        match = re.match(r"bytes\s+(\d+)-(\d+)/(\d+|\*)", response.headers.get("Content-Range", ""))
+        if match is None or int(match.group(1)) != offset:
+            response.close()
+            raise ValueError(
+                "Asked for a range starting at %d, got Content-Range %r" % (offset, response.headers.get("Content-Range"))
+            )
+        if match.group(3) != "*":
+            return int(match.group(3))
+    content_length = response.headers.get("Content-Length")
+    if content_length is None or response.headers.get("Content-Encoding", "identity") != "identity":
+        return None  # (with a Content-Encoding, requests decodes, so we count something other than the Content-Length)
+    return offset + int(content_length)
+
+
+def _make_hasher(checksum: str):
+    "For internal use by download(): parses a checksum like 'sha256:abcd...' (or just 'abcd...', meaning sha256), returns (hashlib object, expected hex digest)"
+    if ":" in checksum:
+        algorithm, digest = checksum.split(":", 1)
+    else:
+        algorithm, digest = "sha256", checksum
+    return hashlib.new(algorithm.lower()), digest.strip().lower()
+
+
+def _read_sidecar(sidecar_path: str):
+    "For internal use by download(): the contents of a resume sidecar file, or None if it is not there or not readable"
+    try:
+        with open(sidecar_path, "r", encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_sidecar(sidecar_path: str, data: dict):
+    "For internal use by download(): writes a resume sidecar file"
+    with open(sidecar_path, "w", encoding="utf8") as f:
+        json.dump(data, f)
+
+
+def _create_beside(path: str, suffix: str):
+    """For internal use by download(): creates a new, uniquely named file in the same directory as path
+    (so that an os.replace() onto path is a rename within the same filesystem), and returns (binary file object, its path).
+
+    Unlike tempfile.mkstemp(), which makes files only we can read, this gives it the usual permissions (i.e. those allowed by the umask),
+    which is what the file should have once it becomes path.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    while True:
+        new_path = os.path.join(directory, ".%s.%s%s" % (os.path.basename(path), secrets.token_hex(4), suffix))
+        try:
+            return open(new_path, "xb"), new_path
+        except FileExistsError:
+            continue
+
+
+def _remove_if_exists(path: str):
+    "For internal use: removes a file, if it is there"
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _make_decompressor(kind: str):
+    "For internal use by _decompress_chunks(): a new decompressor object for the given compression format"
+    if kind in ("xz", "lzma"):
+        return lzma.LZMADecompressor()
+    elif kind == "bz2":
+        return bz2.BZ2Decompressor()
+    elif kind in ("gz", "gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)  # the 16 means 'expect a gzip header'
+    elif kind in ("zst", "zstd"):
+        import zstandard  # if this fails, you may need a    pip install zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise ValueError("Do not know how to decompress %r, we know xz, bz2, gz, and zstd" % kind)
+
+
+def _decompress_chunks(chunks, kind: str):
+    """For internal use by download(): takes an iterable of compressed chunks (e.g. as they come from the network),
+    yields decompressed chunks.
+
+    Handles files that are multiple compressed streams one after the other (as e.g. pbzip2 and pigz produce).
+    """
+    decompressor = _make_decompressor(kind)
+    fed = False  # whether the current decompressor has seen any data
+    for data in chunks:
+        while len(data) > 0:
+            fed = True
+            decompressed = decompressor.decompress(data)
+            if len(decompressed) > 0:
+                yield decompressed
+            if getattr(decompressor, "eof", False):  # end of a stream; anything after it is the next one
+                data = decompressor.unused_data
+                decompressor = _make_decompressor(kind)
+                fed = False
+            else:
+                data = b""
+    if hasattr(decompressor, "flush"):
+        remainder = decompressor.flush()
+        if len(remainder) > 0:
+            yield remainder
+    if fed and not getattr(decompressor, "eof", True):
+        raise ValueError("Compressed data ended before the end of its stream - incomplete download?")
+
+
+### Fetching many things concurrently
+
+
+class TokenBucket:
+    """A rate limiter: allows an average of C{rate} acquisitions per second, with bursts of up to C{burst} of them.
+
+    Used by FetchEngine (one per host), but usable by itself, either from asyncio code (C{await bucket.acquire()})
+    or from plain code (C{time.sleep( bucket.reserve() )}).
+    Not thread-safe - it is meant to be used from a single thread (e.g. an event loop's).
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        """
+        @param rate: how many acquisitions per second, on average.
+        @param burst: how many can happen in quick succession after a quiet period (at least 1).
+        """
+        if rate <= 0:
+            raise ValueError("rate should be positive, not %r" % rate)
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token, possibly one that is not there yet.
+        @return: how many seconds to wait before using it (0.0 if it is available now).
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+    async def acquire(self):
+        "waits until we may go ahead"
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class FetchEngine:
+    """Fetches many URLs concurrently, while being polite to each server:
+      - at most C{per_host} fetches to any one host at a time
+      - optionally, at most C{rate} fetches per second to any one host (a token bucket, so it allows short bursts)
+
+    The scheduling is done by an asyncio event loop, which runs in a thread of its own (so this also works
+    where there already is an event loop, as in notebooks). The fetches themselves are download()s (on the shared session())
+    in a pool of threads, so that requests's connection pooling and download()'s error handling apply as usual.
+
+    Most people will want map(), or wetsuite.helpers.localdata.cached_fetch_many() (which uses this to fill a store);
+    for asyncio code there is fetch(), to be awaited on this engine's loop.
+
+    Example::
+        with FetchEngine(per_host=2, rate=5) as engine:
+            for url, data, error in engine.map( urls ):
+                ...
+
+    (compared to a loop of fetches with a sleep in between, the throughput is no longer limited by the latency of each fetch)
+    """
+
+    def __init__(
+        self,
+        per_host: int = 2,
+        rate: float = None,
+        burst: float = 1,
+        concurrency: int = 8,
+        timeout: float = 20,
+    ):
+        """
+        @param per_host: the most fetches that may be underway to the same host at the same time.
+        @param rate: if not None, the most fetches per second to the same host (on average).
+        @param burst: with rate, how many fetches to the same host may start in quick succession (see TokenBucket).
+        @param concurrency: the most fetches that may be underway in total (the size of the thread pool doing them).
+        @param timeout: passed through to download()
+        """
+        self.per_host = per_host
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self._semaphores = {}  # host -> asyncio.Semaphore
+        self._buckets = {}  # host -> TokenBucket
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the event loop and the threads.
+        Cancels fetches that have not started; those that have are waited for (and their results dropped).
+        """
+        if self._loop.is_closed():
+            return
+
+        async def cancel_all():
+            tasks = list(task for task in asyncio.all_tasks() if task is not asyncio.current_task())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    async def fetch(self, url: str, fetcher=None):
+        """Fetches one URL, after waiting until the politeness limits for its host allow it.
+        A coroutine, that should be run on this engine's loop (submit() does that for you).
+        @param fetcher: what to do the fetch with, called like C{fetcher(url, timeout=...)} in a thread.
+        Defaults to download(); e.g. a functools.partial of conditional_download() also makes sense.
+        @return: what the fetcher returns - for download(), the data as bytes. Raises what the fetcher raises.
+        """
+        if fetcher is None:
+            fetcher = download
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host)
+            if self.rate is not None:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+        async with self._semaphores[host]:
+            if host in self._buckets:
+                await self._buckets[host].acquire()
+            return await self._loop.run_in_executor(
+                self._pool, functools.partial(fetcher, url, timeout=self.timeout)
+            )
+
+    def submit(self, url: str, fetcher=None) -> concurrent.futures.Future:
+        """Schedules fetching an URL, from any thread.
+        @param fetcher: see fetch()
+        @return: a concurrent.futures.Future, whose result() is the data (or raises what the fetch raised).
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, fetcher=fetcher), self._loop)
+
+    def map(self, urls, max_pending: int = None):
+        """Fetches the given URLs, and yields results as each completes (so not necessarily in the order given).
+
+        Takes URLs from the iterable only as fast as it needs to, so this can be given a generator of many URLs
+        (and you can do other things between results, such as store them - this generator runs in your thread).
+
+        @param urls: an iterable of URL strings.
+        @param max_pending: how many URLs we may have scheduled but not yet yielded. Defaults to a few times concurrency.
+        @return: a generator of (url, data, exception) tuples: data is None if the fetch failed, exception is None if it did not.
+        """
+        if max_pending is None:
+            max_pending = 4 * self.concurrency
+        urls = iter(urls)
+        pending = {}  # future -> url
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        url = next(urls)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[self.submit(url)] = url
+                if len(pending) == 0:
+                    break
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    exception = future.exception()
+                    if exception is None:
+                        yield url, future.result(), None
+                    else:
+                        yield url, None, exception
+        finally:  # e.g. when the caller stops early - don't start what we had not started yet
+            for future in pending:
+                future.cancel()
@@ -171,6 +171,22 @@ def hash_hex(data:bytes, as_bytes:bool = False):
         return s1h.hexdigest()
 
 
+def hash_file(path:str, algorithm:str = "sha256", chunk_size:int = 1048576) -> str:
+    """Calculate a hash of a file's contents, reading it in chunks (so it need not fit in memory).
+    @param path: the file to hash
+    @param algorithm: anything hashlib.new() takes, e.g. 'sha256' (the default), 'blake2b'
+    @return: the hash as a hex string
+    """
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if len(data) == 0:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
 def is_html(bytesdata:bytes) -> bool:
     """Do these bytes look loke a HTML document? (no specific distinction to XHTML)
     @param bytesdata: the bytestring to check is a HTML file.
@@ -2,9 +2,16 @@
 Tests related to the Dataset module
 """
 
+import os
+import json
+import sqlite3
+import hashlib
+import zipfile
+
 import pytest
 
 import wetsuite.datasets
+import wetsuite.helpers.localdata
 
 
 def test_fetch_index():
@@ -93,6 +100,184 @@ def test_dataset_class_export_zip3(tmp_path):
     ds.export_files(to_zipfile_path=tmp_path / "test.zip")
 
 
+def test_dataset_class_export_localkv(tmp_path):
+    "export from a LocalKV, which streams bytes values"
+    kv = wetsuite.helpers.localdata.LocalKV(tmp_path / "ds.db", None, None)
+    kv.put("a.xml", b'<?xml version="1.0"?><a/>' + b" " * 100000)
+    kv.put("b", b"bytes")
+    kv.put("c", "text")
+    opened = []
+    original_open_value = kv.open_value
+
+    def counting_open_value(key, *args, **kwargs):
+        opened.append(key)
+        return original_open_value(key, *args, **kwargs)
+
+    kv.open_value = counting_open_value
+    ds = wetsuite.datasets.Dataset(description="descr", data=kv, name="name")
+    ds.export_files(in_dir_path=tmp_path / "out", to_zipfile_path=tmp_path / "test.zip")
+    assert sorted(opened) == ["a.xml", "b", "c"]  # each once (the last one fails, not being bytes)
+    filenames = sorted(os.listdir(tmp_path / "out"))
+    assert len(filenames) == 3
+    assert filenames[0].endswith(".xml")
+    assert os.path.getsize(tmp_path / "out" / filenames[0]) == 100025
+    assert filenames[1].endswith(".bin")
+    assert filenames[2].endswith(".txt")
+    with zipfile.ZipFile(tmp_path / "test.zip") as zf:
+        assert sorted(zf.namelist()) == filenames
+        assert zf.read(filenames[1]) == b"bytes"
+        assert zf.read(filenames[0]) == (tmp_path / "out" / filenames[0]).read_bytes()
+
+    ds.export_files(to_zipfile_path=tmp_path / "only.zip")  # streamed straight into the zip
+    with zipfile.ZipFile(tmp_path / "only.zip") as zf:
+        assert zf.read(filenames[0]) == b'<?xml version="1.0"?><a/>' + b" " * 100000
+
+
+def test_data_from_path_mmapkv(tmp_path):
+    "_data_from_path opens MmapKV files"
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:")
+    kv.put("a", {"b": 1})
+    kv._put_meta("description", "descr")
+    wetsuite.helpers.localdata.write_mmapkv(kv, tmp_path / "ds.mmkv")
+    data, description = wetsuite.datasets._data_from_path(tmp_path / "ds.mmkv")
+    assert description == "descr"
+    assert dict(data.items()) == {"a": {"b": 1}}
+    data.close()
+
+
+def test_iter_json_dataset(tmp_path):
+    "the incremental JSON reader gives the same as json.loads, also when values straddle reads"
+    loaded = {
+        "data": {
+            "k%d" % i: [i, 1.5e10 * i, "str\u00e9\"\\ %d" % i, {"nested": {"a": None, "b": True}}, ""]
+            for i in range(200)
+        },
+        "description": "descr \u2603",
+        "other": [12345678901234567890, False],
+    }
+    path = tmp_path / "ds.json"
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(loaded, f, indent=1, ensure_ascii=False)
+    for read_size in (1, 7, 1000, 1048576):
+        got = {"data": {}}
+        for top_key, key, value in wetsuite.datasets._iter_json_dataset(path, read_size=read_size):
+            if top_key == "data":
+                got["data"][key] = value
+            else:
+                got[top_key] = value
+        assert got == loaded
+
+    with open(path, "w") as f:
+        f.write('{"data": {"a": 1, "b": 2')
+    with pytest.raises(ValueError):
+        list(wetsuite.datasets._iter_json_dataset(path))
+
+
+def test_data_from_path_json(tmp_path):
+    "JSON datasets are converted to a store on first load"
+    path = str(tmp_path / "ds")
+    with open(path, "w", encoding="utf8") as f:
+        json.dump({"data": {"a": {"b": [1, 2]}, "c": "d"}, "description": "descr"}, f)
+    for _ in range(2):  # the second time, it's a store already
+        data, description = wetsuite.datasets._data_from_path(path)
+        assert description == "descr"
+        assert isinstance(data, wetsuite.helpers.localdata.MsgpackKV)
+        assert dict(data.items()) == {"a": {"b": [1, 2]}, "c": "d"}
+        data.close()
+    assert sorted(os.listdir(tmp_path)) == ["ds"]
+
+    path = str(tmp_path / "ds_list")
+    with open(path, "w", encoding="utf8") as f:
+        json.dump({"description": "descr", "data": [1, 2, 3]}, f)
+    assert wetsuite.datasets._data_from_path(path) == ([1, 2, 3], "descr")
+
+    with open(path, "w", encoding="utf8") as f:
+        json.dump({"data": {"a": 1}}, f)
+    with pytest.raises(ValueError):
+        wetsuite.datasets._data_from_path(path)
+    assert sorted(os.listdir(tmp_path)) == ["ds", "ds_list"]
+
+
+def test_data_from_path_json_readonly(tmp_path, monkeypatch):
+    "a JSON dataset that we cannot convert (e.g. in a read-only directory) is read as-is"
+    path = str(tmp_path / "ds")
+    with open(path, "w", encoding="utf8") as f:
+        json.dump({"data": {"a": {"b": [1, 2]}, "c": "d"}, "description": "descr"}, f)
+
+    def refuse(*args, **kwargs):
+        raise PermissionError("read-only")
+
+    monkeypatch.setattr(os, "replace", refuse)  # what a read-only directory would do, even to root
+    assert wetsuite.datasets._data_from_path(path) == ({"a": {"b": [1, 2]}, "c": "d"}, "descr")
+    assert sorted(os.listdir(tmp_path)) == ["ds"]
+
+    def refuse_store(*args, **kwargs):
+        raise sqlite3.OperationalError("unable to open database file")
+
+    monkeypatch.setattr(wetsuite.helpers.localdata, "MsgpackKV", refuse_store)
+    assert wetsuite.datasets._data_from_path(path) == ({"a": {"b": [1, 2]}, "c": "d"}, "descr")
+
+
+def test_dataset_num_items():
+    "Dataset uses num_items when given, rather than len()"
+    ds = wetsuite.datasets.Dataset(description="descr", data=iter([]), name="name", num_items=5)
+    assert ds.num_items == 5
+
+
+def test_index_checksum():
+    "the digest the index mentions, in the form download() takes"
+    assert wetsuite.datasets._index_checksum({"sha256": "AB12"}) == "sha256:ab12"
+    assert wetsuite.datasets._index_checksum({"blake2b": "cd34"}) == "blake2b:cd34"
+    assert wetsuite.datasets._index_checksum({"url": "x"}) is None
+
+
+def test_check_verified(tmp_path):
+    "a cached file is hashed again only when its size or modification time changed, and judged by its recorded digest"
+    path = str(tmp_path / "ds")
+    with open(path, "wb") as f:
+        f.write(b"contents")
+
+    # no record (cached before we kept them): trusted, and recorded
+    assert wetsuite.datasets._check_verified(path)
+    assert os.path.exists(path + ".verified.json")
+
+    with open(path + ".verified.json", encoding="utf8") as f:
+        record = json.load(f)
+    assert record["checksum"] == "sha256:" + hashlib.sha256(b"contents").hexdigest()
+
+    # touched but the same: still fine, and the new time is recorded
+    os.utime(path, ns=(record["mtime_ns"] + 10**9, record["mtime_ns"] + 10**9))
+    assert wetsuite.datasets._check_verified(path)
+    with open(path + ".verified.json", encoding="utf8") as f:
+        assert json.load(f)["mtime_ns"] == record["mtime_ns"] + 10**9
+
+    # same size, different contents
+    with open(path, "wb") as f:
+        f.write(b"CONTENTS")
+    assert not wetsuite.datasets._check_verified(path)
+
+    # different size
+    wetsuite.datasets._record_verified(path, "blake2b:" + hashlib.blake2b(b"CONTENTS").hexdigest())
+    assert wetsuite.datasets._check_verified(path)
+    with open(path, "ab") as f:
+        f.write(b"more")
+    assert not wetsuite.datasets._check_verified(path)
+
+
+def test_sizecheck_resume(tmp_path, monkeypatch):
+    "only a resumable download of a compressed dataset needs space for both the compressed and decompressed data"
+    index = {"ds": {"url": "https://example.com/ds.xz", "download_size": 100, "real_size": 400}}
+    monkeypatch.setattr(wetsuite.datasets, "_index_data", index)
+    monkeypatch.setattr(wetsuite.helpers.util, "wetsuite_dir", lambda: {"datasets_dir": str(tmp_path)})
+    monkeypatch.setattr(wetsuite.helpers.util, "free_space", lambda path=None: 450)
+    data_path = tmp_path / wetsuite.helpers.util.hash_hex("https://example.com/ds.xz")
+    data_path.write_bytes(b"already here")  # (so that this does not actually download)
+
+    assert wetsuite.datasets._load_bare("ds", verbose=False) == str(data_path)
+    with pytest.raises(IOError, match=r".*only.*"):
+        wetsuite.datasets._load_bare("ds", verbose=False, resume=True)
+
+
 def test_sizecheck():
     'test whether the "do we have enough space?" check will work'
 
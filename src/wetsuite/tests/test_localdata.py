@@ -1,5 +1,7 @@
 " tests related to the localdata module, mostly LocalKV  "
 import os
+import time
+import sqlite3
 import pytest
 import wetsuite.helpers.localdata
 
@@ -25,6 +27,54 @@ def test_crud():
     assert len(kv) == 0
 
 
+def test_len_maintained(tmp_path):
+    "len() comes from a count maintained in the meta table, check that it stays correct"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str)
+    assert kv._item_count_maintained  # pylint: disable=protected-access
+    assert len(kv) == 0
+    kv.put("a", "b")
+    kv.put("a", "c")  # update, not a new item
+    assert len(kv) == 1
+    kv.put_many([("a", "d"), ("e", "f"), ("g", "h")])
+    assert len(kv) == 3
+    kv.delete("nope")
+    kv.delete_many(["a", "nope"])
+    assert len(kv) == 2
+    kv.put("i", "j", commit=False)
+    assert len(kv) == 3
+    kv.rollback()
+    assert len(kv) == 2
+    kv.truncate()
+    assert len(kv) == 0
+    assert kv.summary(get_num_items=True)["num_items"] == 0
+
+    # a store as made by older versions (no triggers, no count) gets them when opened writeable...
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE meta (key text unique NOT NULL, value text)")
+    conn.execute("CREATE TABLE kv   (key text unique NOT NULL, value text)")
+    conn.executemany("INSERT INTO kv (key, value) VALUES (?, ?)", [("1", "2"), ("3", "4")])
+    conn.commit()
+    conn.close()
+
+    # ...but read-only, we have to fall back to counting
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str, read_only=True)
+    assert not kv._item_count_maintained  # pylint: disable=protected-access
+    assert len(kv) == 2
+    kv.close()
+
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str)
+    assert kv._item_count_maintained  # pylint: disable=protected-access
+    assert kv._get_meta("num_items") == "2"  # pylint: disable=protected-access
+    kv.put("5", "6")
+    assert len(kv) == 3
+    kv.close()
+
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str, read_only=True)
+    assert kv._item_count_maintained  # pylint: disable=protected-access
+    assert len(kv) == 3
+
+
 def test_metacrud():
     "basic getter and setter tests of the (hidden) meta table"
     kv = wetsuite.helpers.localdata.LocalKV(":memory:", key_type=str, value_type=str)
@@ -37,6 +87,22 @@ def test_metacrud():
     kv._delete_meta("c")  # pylint: disable=protected-access
 
 
+def test_meta_in_transaction():
+    "_put_meta() inside an open transaction should not commit the caller's pending writes"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", key_type=str, value_type=str)
+    kv.put("a", "1", commit=False)
+    kv._put_meta("m", "x")  # pylint: disable=protected-access
+    kv.rollback()
+    assert "a" not in kv
+    with pytest.raises(KeyError):
+        kv._get_meta("m")  # pylint: disable=protected-access
+
+    # outside a transaction it still commits by itself
+    kv._put_meta("m", "y")  # pylint: disable=protected-access
+    kv.rollback()
+    assert kv._get_meta("m") == "y"  # pylint: disable=protected-access
+
+
 def test_readonly():
     "test whether read-only things refuse writing"
     kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str, read_only=True)
@@ -72,6 +138,144 @@ def test_moreapi():
     repr(kv)
 
 
+def test_bulk():
+    "put_many, get_many, delete_many"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str)
+    kv.put_many([("a", "b"), ("c", "d")])
+    kv.put_many({"e": "f", "a": "B"}.items())  # also tests update of existing
+    assert len(kv) == 3
+    assert kv.get("a") == "B"
+    assert kv._in_transaction is False  # pylint: disable=protected-access
+
+    assert kv.get_many(["e", "a"]) == {"e": "f", "a": "B"}
+    assert list(kv.get_many(["e", "a"]).keys()) == ["e", "a"]  # keeps the order we asked for
+    with pytest.raises(KeyError):
+        kv.get_many(["a", "nope"])
+    assert kv.get_many(["a", "nope"], missing_as_none=True) == {"a": "B", "nope": None}
+    # more keys than fit in one chunk
+    assert len(kv.get_many(["a"] * 1200, chunk_size=100)) == 1
+
+    kv.delete_many(["a", "c", "nope"])
+    assert list(kv.keys()) == ["e"]
+
+    # type check failure rolls back what the same call already did
+    with pytest.raises(TypeError, match=r".*are allowed*"):
+        kv.put_many([("x", "y"), ("z", 1)])
+    assert "x" not in kv
+    assert kv._in_transaction is False  # pylint: disable=protected-access
+
+    # commit=False leaves it to us
+    kv.put_many([("x", "y")], commit=False)
+    assert kv._in_transaction is True  # pylint: disable=protected-access
+    kv.rollback()
+    assert "x" not in kv
+
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str, read_only=True)
+    with pytest.raises(RuntimeError, match=r".*Attempted*"):
+        kv.put_many([("a", "b")])
+    with pytest.raises(RuntimeError, match=r".*Attempted*"):
+        kv.delete_many(["a"])
+
+
+def test_bulk_matches_loop(tmp_path):
+    "put_many/get_many give the same results as a per-key loop of put()/get(), with a single commit instead of one per write"
+    items = list((f"key{i}", "value%d" % i) for i in range(2000))
+
+    def counting_commits(kv):
+        "makes kv count its commits in kv.commits"
+        kv.commits = 0
+        original_commit = kv.commit
+
+        def commit():
+            kv.commits += 1
+            original_commit()
+
+        kv.commit = commit
+        return kv
+
+    kv_loop = counting_commits(wetsuite.helpers.localdata.LocalKV(tmp_path / "loop.db", str, str))
+    for key, value in items:
+        kv_loop.put(key, value)
+    loop_got = list(kv_loop.get(key) for key, _ in items)
+    assert kv_loop.commits == len(items)
+
+    kv_bulk = counting_commits(wetsuite.helpers.localdata.LocalKV(tmp_path / "bulk.db", str, str))
+    kv_bulk.put_many(items)
+    assert kv_bulk.commits == 1
+    bulk_got = kv_bulk.get_many(key for key, _ in items)
+
+    assert len(kv_bulk) == len(kv_loop) == len(items)
+    assert list(bulk_got.keys()) == list(key for key, _ in items)
+    assert list(bulk_got.values()) == loop_got == list(value for _, value in items)
+
+
+def test_prefix_range():
+    "iterkeys/itervalues/iteritems/count by prefix and by range"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str)
+    kv.put_many([
+        ("ECLI:NL:HR:2020:1", "a"),
+        ("ECLI:NL:HR:2021:2", "b"),
+        ("ECLI:NL:RBAMS:2020:3", "c"),
+        ("BWBR0001840", "d"),
+        ("ECLI:NL:HR;", "e"),  # ; sorts right after :, so must not be matched by a prefix ending in :
+    ])
+    assert list(kv.iterkeys(prefix="ECLI:NL:HR:")) == ["ECLI:NL:HR:2020:1", "ECLI:NL:HR:2021:2"]
+    assert kv.count(prefix="ECLI:NL:HR:") == 2
+    assert kv.count(prefix="ECLI:") == 4
+    assert kv.count(prefix="") == 5
+    assert kv.count() == 5
+    assert kv.count(prefix="nope") == 0
+    assert list(kv.itervalues(prefix="BWB")) == ["d"]
+    assert list(kv.iteritems(start="ECLI:NL:HR:2021", stop="ECLI:NL:RBAMS")) == [("ECLI:NL:HR:2021:2", "b"), ("ECLI:NL:HR;", "e")]
+    assert list(kv.iterkeys(prefix="ECLI:NL:HR:", start="ECLI:NL:HR:2021")) == ["ECLI:NL:HR:2021:2"]
+    with pytest.raises(TypeError):
+        list(kv.iterkeys(prefix=5))
+
+    # the query should use the index rather than scan the table
+    where, params = kv._key_range_where(prefix="ECLI:")  # pylint: disable=protected-access
+    plan = " ".join(str(row) for row in kv.conn.execute("EXPLAIN QUERY PLAN SELECT key FROM kv" + where, params))
+    assert "sqlite_autoindex_kv_1" in plan
+
+    # edge cases of the upper bound
+    assert wetsuite.helpers.localdata._prefix_upper_bound("ab") == "ac"  # pylint: disable=protected-access
+    assert wetsuite.helpers.localdata._prefix_upper_bound("a\U0010ffff") == "b"  # pylint: disable=protected-access
+    assert wetsuite.helpers.localdata._prefix_upper_bound("\ud7ff") == "\ue000"  # pylint: disable=protected-access
+    assert wetsuite.helpers.localdata._prefix_upper_bound(b"a\xff") == b"b"  # pylint: disable=protected-access
+    assert wetsuite.helpers.localdata._prefix_upper_bound(b"\xff") is None  # pylint: disable=protected-access
+
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:")
+    kv.put_many([("https://example.com/a", {"x": 1}), ("https://example.org/b", {"x": 2})])
+    assert list(kv.iteritems(prefix="https://example.com/")) == [("https://example.com/a", {"x": 1})]
+    assert list(kv.itervalues(prefix="https://example.org/")) == [{"x": 2}]
+
+
+def test_batched_paged_iteration():
+    "batch_size and page_size give the same results as plain iteration, and page_size can resume and be written to while iterating"
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:")
+    kv.put_many(list(("k%03d" % i, [i]) for i in range(250)))
+    everything = sorted(kv.iteritems())
+
+    assert sorted(kv.iteritems(batch_size=7)) == everything
+    assert list(kv.iteritems(page_size=7)) == everything  # paged is in key order
+    assert list(kv.iteritems(page_size=50)) == everything  # exact multiple of the page size
+    assert list(kv.iterkeys(page_size=10, prefix="k01")) == list("k01%d" % i for i in range(10))
+    assert list(kv.itervalues(page_size=3, start="k247")) == [[247], [248], [249]]
+
+    # resume from the last key seen
+    seen = []
+    for key, _ in kv.iteritems(page_size=20):
+        seen.append(key)
+        if len(seen) == 30:
+            break
+    seen.extend(key for key, _ in kv.iteritems(page_size=20, after=seen[-1]))
+    assert seen == list(key for key, _ in everything)
+
+    # altering the store between pages is fine
+    for key in kv.iterkeys(page_size=16):
+        kv.delete(key)
+    assert len(kv) == 0
+
+
 def test_moreapi_random():
     "More API stuff, randomness related"
     kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str)
@@ -96,6 +300,40 @@ def test_moreapi_random():
 
 
 
+def test_random_rowids():
+    "random sampling goes via rowids, check that it copes with gaps and with asking for most or all of the store"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str)
+    with pytest.raises(IndexError):
+        kv.random_choice()
+    assert kv.random_keys(5) == []
+    assert kv.random_sample(5) == []
+
+    kv.put_many(list((str(i), "v%d" % i) for i in range(1000)))
+    kv.delete_many(list(str(i) for i in range(0, 1000, 3)))  # gaps
+
+    keys = kv.random_keys(20)
+    assert len(keys) == 20
+    assert len(set(keys)) == 20
+    assert all(int(key) % 3 != 0 for key in keys)
+
+    sample = kv.random_sample(20)
+    assert len(sample) == 20
+    assert all(value == "v" + key for key, value in sample)
+
+    assert sorted(kv.random_keys(10000)) == sorted(kv.keys())
+
+    # mostly-empty store, which needs the fallback
+    kv.delete_many(list(str(i) for i in range(1, 990)))
+    assert len(kv.random_keys(5)) == 5
+    assert set(kv.random_keys(100)) == set(kv.keys())
+
+    # that every item can be picked
+    seen = set()
+    for _ in range(200):
+        seen.add(kv.random_choice()[0])
+    assert seen == set(kv.keys())
+
+
 def test_list():
     "we can't really know what the testing account has, so this wouldn't be deterministic, just check that it doesn't fail"
     wetsuite.helpers.localdata.list_stores()
@@ -150,6 +388,56 @@ def test_moretrans():
     kv.close()  # also a test of 'do we roll back when still in transaction' (at least, whether that code doesn't bork out)
 
 
+def test_commit_policy_count():
+    "commit_every commits after that many writes, close() commits what is pending"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str, commit_every=3)
+    kv.put("1", "a")
+    kv.put("2", "b")
+    assert kv._in_transaction is True  # pylint: disable=protected-access
+    kv.put("3", "c")
+    assert kv._in_transaction is False  # pylint: disable=protected-access
+
+    kv.delete("1")
+    assert kv._in_transaction is True  # pylint: disable=protected-access
+    kv.put("4", "d", commit=True)  # explicit commit still commits
+    assert kv._in_transaction is False  # pylint: disable=protected-access
+
+    kv.put_many([("5", "e"), ("6", "f"), ("7", "g")])  # counts per item
+    assert kv._in_transaction is False  # pylint: disable=protected-access
+    kv.put_many([("8", "h")])
+    assert kv._in_transaction is True  # pylint: disable=protected-access
+
+
+def test_commit_policy_close(tmp_path):
+    "pending writes under a commit policy are committed on close() / context manager exit"
+    path = tmp_path / "policy.db"
+    with wetsuite.helpers.localdata.LocalKV(path, str, str, commit_every=1000) as kv:
+        kv.put("a", "b")
+        assert kv._in_transaction is True  # pylint: disable=protected-access
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str, commit_every=1000)
+    assert kv.get("a") == "b"
+    kv.put("c", "d")
+    kv.close()
+
+    # without a policy, close() still rolls back
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str)
+    assert kv.get("c") == "d"
+    kv.put("e", "f", commit=False)
+    kv.close()
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str)
+    assert "e" not in kv
+
+
+def test_commit_policy_interval():
+    "commit_interval commits once the transaction is old enough"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str, commit_interval=0.2)
+    kv.put("1", "a")
+    assert kv._in_transaction is True  # pylint: disable=protected-access
+    time.sleep(0.3)
+    kv.put("2", "b")
+    assert kv._in_transaction is False  # pylint: disable=protected-access
+
+
 def test_context_manager():
     "see if use of class as context manager functions"
     with wetsuite.helpers.localdata.LocalKV(":memory:", str, str) as kv:
@@ -239,8 +527,6 @@ def DISABLED_test_multiread_and_locking(tmp_path): # (tmp_path invokes pytest fi
     the test takes longish (on purpose),
     and also isn't as deterministic as it should be.
     """
-    import sqlite3
-
     # test that both see the same data
     #   even if one was opened later
     path = tmp_path / "test1.db"
@@ -295,7 +581,7 @@ def DISABLED_test_thread(tmp_path):
 
     disabled because it (intentionally) takes some time.
     """
-    import time, threading
+    import threading
 
     # It seems threads may share the module, but not connections
     # https://docs.python.org/3/library/sqlite3.html#sqlite3.threadsafety
@@ -303,7 +589,6 @@ def DISABLED_test_thread(tmp_path):
 
     def get_sqlite3_thread_safety():  # See https://ricardoanderegg.com/posts/python-sqlite-thread-safety/ for why this is here
         "the sqlite module's threadsafety module is hardcoded for now, asking the library is more accurate"
-        import sqlite3
         conn = sqlite3.connect(":memory:")
         threadsafe_val = conn.execute(
             "SELECT *  FROM pragma_compile_options  WHERE compile_options LIKE 'THREADSAFE=%'"
@@ -364,6 +649,63 @@ def DISABLED_test_thread(tmp_path):
         )
 
 
+def test_wal_pragmas(tmp_path):
+    "test that the constructor options end up as the PRAGMAs we expect"
+    path = tmp_path / "wal.db"
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str, use_wal=True, busy_timeout=7, mmap_size=2**20)
+    assert kv.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert kv.conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert kv.conn.execute("PRAGMA busy_timeout").fetchone()[0] == 7000
+    kv.put("a", "b")
+    kv.close()
+
+    # WAL persists in the file
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str, read_only=True)
+    assert kv.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert kv.get("a") == "b"
+    kv.close()
+
+    # ignored for in-memory stores
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:", use_wal=True)
+    kv.put("a", [1])
+    assert kv.get("a") == [1]
+
+
+def _wal_writer(path, writing, done_reading):
+    """(used by test_wal_concurrent_read, at module level so that multiprocessing can find it)
+    Keeps writing until done_reading is set, setting writing once it has committed something."""
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str, use_wal=True, busy_timeout=10)
+    i = 0
+    while not done_reading.is_set():
+        kv.put_many(list(("w%d_%d" % (i, j), "0123456789" * 100) for j in range(50)))
+        writing.set()
+        i += 1
+    kv.close()
+
+
+def test_wal_concurrent_read(tmp_path):
+    "with WAL, reads from another process should keep going (and not time out) while a writer is busy"
+    import multiprocessing
+
+    path = str(tmp_path / "walconc.db")
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str, use_wal=True, busy_timeout=10)
+    kv.put("a", "b")
+
+    writing, done_reading = multiprocessing.Event(), multiprocessing.Event()
+    writer = multiprocessing.Process(target=_wal_writer, args=(path, writing, done_reading))
+    writer.start()
+    try:
+        assert writing.wait(timeout=30)  # the writer has written, and is still writing
+        for _ in range(50):  # (a 'database is locked' would raise here)
+            assert kv.get("a") == "b"
+        assert writer.is_alive()
+        assert len(kv) > 1  # and we see what the writer committed
+    finally:
+        done_reading.set()
+        writer.join()
+    assert writer.exitcode == 0
+
+
 def test_vacuum(tmp_path):
     "test that vacuum actually reduces file size, and is estimated to do so"
     path = tmp_path / "test1.db"
@@ -425,6 +767,319 @@ def test_cached_fetch_type():
         wetsuite.helpers.localdata.cached_fetch({}, kv)
 
 
+def test_expiring(tmp_path):
+    "ExpiringLocalKV's timestamps, max_age, eviction, and validators"
+    kv = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "exp.db", str, bytes, max_age=60, cache_items=10)
+    kv.put("a", b"1")
+    kv.put_many([("b", b"2"), ("c", b"3")])
+    kv.put("d", b"4", etag='"xyz"', last_modified="Mon, 10 Jun 2024 06:13:20 GMT")
+    assert abs(kv.stored_at("a") - time.time()) < 5
+    assert kv.get("b") == b"2"
+    assert kv.revalidation_headers("a") == {}
+    assert kv.revalidation_headers("d") == {
+        "If-None-Match": '"xyz"',
+        "If-Modified-Since": "Mon, 10 Jun 2024 06:13:20 GMT",
+    }
+
+    # pretend that some were stored two hours ago
+    kv.conn.execute("UPDATE expiry SET stored_at = stored_at - 7200 WHERE key IN ('b', 'c', 'd')")
+    kv.commit()
+    with pytest.raises(KeyError):
+        kv.get("b")
+    assert kv.get("b", missing_as_none=True) is None
+    assert kv.get("b", max_age=86400) == b"2"
+    assert kv.get_info("c")["age"] > 7000
+    assert "b" not in kv
+    assert "a" in kv
+    with pytest.raises(KeyError):
+        kv.get_many(["a", "b"])
+    assert kv.get_many(["a", "b", "nonexistent"], missing_as_none=True) == {"a": b"1", "b": None, "nonexistent": None}
+    assert kv.get_many(["a", "b"], max_age=86400) == {"a": b"1", "b": b"2"}
+    assert len(kv.random_sample(10)) == 4  # sampling, like iteration, does not consider age
+
+    kv.touch("d", etag='"new"')  # e.g. after a 304
+    assert kv.get("d") == b"4"
+    assert kv.get_info("d")["etag"] == '"new"'
+    assert kv.get_info("d")["last_modified"] is not None
+    with pytest.raises(KeyError):
+        kv.touch("nonexistent")
+
+    kv.put("c", b"33")  # updating refreshes the timestamp, and forgets the old validators
+    assert kv.get("c") == b"33"
+    kv.put("e", b"5", commit=False, etag='"e"')  # the value and its validators are one write
+    kv.rollback()
+    assert "e" not in kv
+    assert kv.get_info("e", missing_as_none=True) is None
+
+    assert kv.evict_expired() == 1  # b
+    assert sorted(kv.keys()) == ["a", "c", "d"]
+    kv.delete("a")
+    assert kv.get_info("a", missing_as_none=True) is None
+    assert kv.conn.execute("SELECT COUNT(*) FROM expiry").fetchone()[0] == 2
+    with pytest.raises(ValueError):
+        wetsuite.helpers.localdata.ExpiringLocalKV(":memory:", str, str).evict_expired()
+    kv.close()
+
+    # a plain LocalKV becomes an expiring one, with its existing entries counting as new
+    plain = wetsuite.helpers.localdata.LocalKV(tmp_path / "plain.db", str, str)
+    plain.put("x", "y")
+    plain.close()
+    # ...but opened read-only, it has no expiry information, so nothing is stale
+    ro = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "plain.db", str, str, max_age=60, read_only=True)
+    assert ro.get("x") == "y"
+    assert "x" in ro
+    assert ro.get_many(["x"]) == {"x": "y"}
+    assert ro.stored_at("x", missing_as_none=True) is None
+    assert ro.revalidation_headers("x") == {}
+    ro.close()
+    kv = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "plain.db", str, str, max_age=60)
+    assert kv.get("x") == "y"
+    kv.close()
+
+    # once set up, checking that does not need the write lock (so does not wait for a writer)
+    kv = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "plain.db", str, str, max_age=60, busy_timeout=0.1)
+    writer = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "plain.db", str, str, max_age=60)
+    writer.put("z", "w", commit=False)
+    kv._setup_expiry()  # pylint: disable=protected-access
+    assert kv.get("x") == "y"
+    writer.rollback()
+    writer.close()
+    kv.close()
+
+
+def test_cached_fetch_expiring(tmp_path, monkeypatch):
+    "cached_fetch refetches what an ExpiringLocalKV considers stale"
+    fetched = []
+
+    def fake_conditional_download(url, etag=None, last_modified=None, timeout=None, attempts=None):  # pylint: disable=unused-argument
+        fetched.append(url)
+        return b"data %d" % len(fetched), None, None
+
+    monkeypatch.setattr(wetsuite.helpers.net, "conditional_download", fake_conditional_download)
+    kv = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "fc.db", str, bytes, max_age=60)
+    url = "https://example.com/page"
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url) == (b"data 1", False)
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url) == (b"data 1", True)
+    kv.conn.execute("UPDATE expiry SET stored_at = stored_at - 120")
+    kv.commit()
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url, max_age=3600) == (b"data 1", True)
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url) == (b"data 2", False)
+
+    with pytest.raises(TypeError):
+        wetsuite.helpers.localdata.cached_fetch(
+            wetsuite.helpers.localdata.LocalKV(":memory:", str, bytes), url, max_age=10
+        )
+
+
+def test_present_keys(tmp_path):
+    "present_keys says which keys are there, in chunks, also for sharded and expiring stores"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str)
+    kv.put_many((f"key{i}", "v") for i in range(0, 100, 2))
+    assert kv.present_keys(f"key{i}" for i in range(10)) == {"key0", "key2", "key4", "key6", "key8"}
+    assert len(kv.present_keys((f"key{i}" for i in range(100)), chunk_size=7)) == 50
+    assert kv.present_keys([]) == set()
+
+    skv = wetsuite.helpers.localdata.ShardedLocalKV(tmp_path / "sharded", str, str, num_shards=3)
+    skv.put_many((f"key{i}", "v") for i in range(0, 100, 2))
+    assert skv.present_keys(f"key{i}" for i in range(100)) == kv.present_keys(f"key{i}" for i in range(100))
+
+    ekv = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "exp.db", str, str)
+    ekv.put_many([("old", "v"), ("new", "v")])
+    ekv.conn.execute("UPDATE expiry SET stored_at = stored_at - 120 WHERE key = 'old'")
+    ekv.commit()
+    assert ekv.present_keys(["old", "new", "none"]) == {"old", "new"}
+    assert ekv.present_keys(["old", "new", "none"], max_age=60) == {"new"}
+
+
+def test_cached_fetch_many(tmp_path, monkeypatch):
+    "cached_fetch_many fetches only what the store does not have, and stores it"
+    fetched = []
+
+    def fake_download(url, timeout=None):
+        fetched.append(url)
+        if url.endswith("/bad"):
+            raise ValueError("404 for %r" % url)
+        return url.encode("utf8")
+
+    monkeypatch.setattr(wetsuite.helpers.net, "download", fake_download)
+    kv = wetsuite.helpers.localdata.LocalKV(tmp_path / "fc.db", str, bytes)
+    urls = list("https://example.com/%d" % i for i in range(50))
+    kv.put_many((url, b"cached") for url in urls[:40])
+
+    results = list(wetsuite.helpers.localdata.cached_fetch_many(kv, iter(urls), workers=3, batch_size=4, chunk_size=9))
+    assert sorted(url for url, _, _ in results) == sorted(urls)
+    assert sum(1 for _, data, from_cache in results if from_cache and data == b"cached") == 40
+    assert sorted(fetched) == sorted(urls[40:])
+    assert all(kv.get(url) == url.encode("utf8") for url in urls[40:])
+
+    # only what we fetched
+    fetched.clear()
+    results = list(wetsuite.helpers.localdata.cached_fetch_many(kv, urls + ["https://example.com/new"], yield_cached=False))
+    assert results == [("https://example.com/new", b"https://example.com/new", False)]
+
+    # errors
+    with pytest.raises(ValueError):
+        list(wetsuite.helpers.localdata.cached_fetch_many(kv, ["https://example.com/bad"]))
+    results = list(wetsuite.helpers.localdata.cached_fetch_many(kv, ["https://example.com/bad", "https://example.com/ok"], errors="skip"))
+    assert results == [("https://example.com/ok", b"https://example.com/ok", False)]
+
+    # stopping early still writes what was fetched
+    more = list("https://example.com/more%d" % i for i in range(20))
+    for url, _, _ in wetsuite.helpers.localdata.cached_fetch_many(kv, more, batch_size=100):
+        break
+    assert url in kv
+
+    with pytest.raises(TypeError):
+        list(wetsuite.helpers.localdata.cached_fetch_many(wetsuite.helpers.localdata.LocalKV(":memory:", str, str), urls))
+    with pytest.raises(TypeError):
+        list(wetsuite.helpers.localdata.cached_fetch_many(kv, urls, max_age=10))
+
+
+def test_cached_fetch_conditional(tmp_path, monkeypatch):
+    "with an ExpiringLocalKV, refetches are conditional requests, and a 304 keeps what we have"
+    server = {"https://example.com/a": (b"a" * 1000, '"a1"'), "https://example.com/b": (b"b" * 500, '"b1"')}
+    requested = []
+
+    def fake_conditional_download(url, etag=None, last_modified=None, timeout=None, attempts=None):  # pylint: disable=unused-argument
+        requested.append((url, etag))
+        data, current_etag = server[url]
+        if etag == current_etag:
+            return None, current_etag, None
+        return data, current_etag, "Mon, 10 Jun 2024 06:13:20 GMT"
+
+    monkeypatch.setattr(wetsuite.helpers.net, "conditional_download", fake_conditional_download)
+    wetsuite.helpers.localdata.revalidation_counts(reset=True)
+    kv = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "fc.db", str, bytes, max_age=60)
+    url_a, url_b = "https://example.com/a", "https://example.com/b"
+
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url_a) == (b"a" * 1000, False)
+    assert kv.revalidation_headers(url_a) == {"If-None-Match": '"a1"', "If-Modified-Since": "Mon, 10 Jun 2024 06:13:20 GMT"}
+    assert wetsuite.helpers.localdata.revalidation_counts() == {"not_modified": 0, "modified": 0, "bytes_saved": 0}
+
+    # not changed: we keep ours, and it counts as fresh again
+    kv.conn.execute("UPDATE expiry SET stored_at = stored_at - 120")
+    kv.commit()
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url_a) == (b"a" * 1000, True)
+    assert requested[-1] == (url_a, '"a1"')
+    assert kv.get_info(url_a)["age"] < 10
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url_a, force_refetch=True) == (b"a" * 1000, True)
+    assert wetsuite.helpers.localdata.revalidation_counts() == {"not_modified": 2, "modified": 0, "bytes_saved": 2000}
+
+    # changed
+    server[url_a] = (b"A" * 10, '"a2"')
+    assert wetsuite.helpers.localdata.cached_fetch(kv, url_a, force_refetch=True) == (b"A" * 10, False)
+    assert kv.get_info(url_a)["etag"] == '"a2"'
+    assert wetsuite.helpers.localdata.revalidation_counts(reset=True)["modified"] == 1
+
+    # the same in bulk
+    list(wetsuite.helpers.localdata.cached_fetch_many(kv, [url_a, url_b]))
+    assert kv.get_info(url_b)["etag"] == '"b1"'
+    server[url_b] = (b"B", '"b2"')
+    results = sorted(wetsuite.helpers.localdata.cached_fetch_many(kv, [url_a, url_b], force_refetch=True))
+    assert results == [(url_a, b"A" * 10, True), (url_b, b"B", False)]
+    assert kv.get(url_b) == b"B" and kv.get_info(url_b)["etag"] == '"b2"'
+    assert wetsuite.helpers.localdata.revalidation_counts() == {"not_modified": 1, "modified": 1, "bytes_saved": 10}
+
+
+def test_open_value(tmp_path):
+    "open_value reads what get() would give, a piece at a time, also from compressed stores"
+    big = os.urandom(100000) + b"abc" * 500000
+    for compression in (None, "zlib"):
+        kv = wetsuite.helpers.localdata.LocalKV(tmp_path / ("ov_%s.db" % compression), str, bytes, compression=compression)
+        kv.put_many([("big", big), ("small", b"tiny"), ("empty", b"")])
+        with kv.open_value("big", chunk_size=65536) as f:
+            pieces = []
+            while True:
+                piece = f.read(70000)
+                if len(piece) == 0:
+                    break
+                pieces.append(piece)
+        assert b"".join(pieces) == big
+        for key in ("small", "empty"):
+            with kv.open_value(key) as f:
+                assert f.read() == kv.get(key)
+        with pytest.raises(KeyError):
+            kv.open_value("nonexistent")
+        if compression is None:
+            with kv.open_value("big") as f:
+                f.seek(100000)
+                assert f.read(6) == b"abcabc"
+                assert f.tell() == 100006
+        kv.close()
+
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, None)
+    kv.put("s", "a string")
+    with pytest.raises(TypeError):
+        kv.open_value("s")
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:")
+    kv.put("d", {"a": 1})
+    with pytest.raises(TypeError):
+        kv.open_value("d")
+
+
+def test_open_value_zstd(tmp_path):
+    "open_value on a zstd-compressed store"
+    pytest.importorskip("zstandard")
+    kv = wetsuite.helpers.localdata.LocalKV(tmp_path / "ovz.db", str, bytes, compression="zstd")
+    big = b"<xml>" + b"<p>some text</p>" * 100000
+    kv.put("big", big)
+    with kv.open_value("big") as f:
+        assert f.read() == big
+
+
+def test_mmapkv(tmp_path):
+    "write_mmapkv and MmapKV give back what the store had, for each value type and compression"
+    values = {
+        "bytes": list(("k%04d" % i, b"value %d " % i * (i % 30)) for i in range(300)),
+        "str": list(("k%04d" % i, "v\u00e9rdict %d " % i * (i % 30)) for i in range(300)),
+    }
+    for value_type, items in values.items():
+        for compression in (None, "zlib"):
+            kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, None)
+            kv.put_many(items)
+            kv._put_meta("description", "some description")
+            path = tmp_path / ("%s_%s.mmkv" % (value_type, compression))
+            assert wetsuite.helpers.localdata.write_mmapkv(kv, path, compression=compression) == 300
+
+            with wetsuite.helpers.localdata.MmapKV(path) as mkv:
+                assert len(mkv) == 300
+                assert mkv._get_meta("description") == "some description"
+                assert mkv.get("k0042") == dict(items)["k0042"]
+                assert mkv["k0000"] == dict(items)["k0000"]
+                assert list(mkv.items()) == sorted(items)
+                assert "k0299" in mkv
+                assert "k0300" not in mkv
+                assert "k" not in mkv
+                assert mkv.get("nonexistent", missing_as_none=True) is None
+                with pytest.raises(KeyError):
+                    mkv.get("nonexistent")
+                assert list(mkv.iterkeys(prefix="k001")) == list("k%04d" % i for i in range(10, 20))
+                assert list(mkv.iterkeys(prefix="x")) == []
+
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:")
+    kv.put_many([("\u00e9", {"a": [1, 2]}), ("e", "str"), ("f", None), ("E", 3)])
+    path = tmp_path / "msgpack.mmkv"
+    wetsuite.helpers.localdata.write_mmapkv(kv, path)
+    with wetsuite.helpers.localdata.MmapKV(path) as mkv:
+        assert list(mkv.iterkeys()) == ["E", "e", "f", "\u00e9"]  # same order as LocalKV would sort them
+        assert mkv.get("\u00e9") == {"a": [1, 2]}
+        assert mkv.get("e") == "str"
+        assert "f" in mkv
+        assert mkv.get("f") is None
+
+    wetsuite.helpers.localdata.write_mmapkv({}, tmp_path / "empty.mmkv")
+    with wetsuite.helpers.localdata.MmapKV(tmp_path / "empty.mmkv") as mkv:
+        assert len(mkv) == 0
+        assert list(mkv.items()) == []
+        assert mkv.get("a", missing_as_none=True) is None
+
+    with pytest.raises(TypeError):
+        wetsuite.helpers.localdata.write_mmapkv({"a": b"bytes", "b": "str"}, tmp_path / "mixed.mmkv")
+    assert not os.path.exists(tmp_path / "mixed.mmkv")
+    with pytest.raises(ValueError):
+        wetsuite.helpers.localdata.MmapKV(__file__)
+
+
 def test_msgpack_crud():
     "various API tests of things MsgpackKV overrides"
     kv = wetsuite.helpers.localdata.MsgpackKV(":memory:")
@@ -464,6 +1119,274 @@ def test_msgpack_moreapi():
     assert ("b", 1) in list(kv.items())
 
 
+def test_msgpack_bulk():
+    "MsgpackKV's put_many and get_many"
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:")
+    kv.put_many([("a", {"b": [1, 2]}), ("c", {1: 2})])
+    assert kv.get("a") == {"b": [1, 2]}
+    assert kv.get_many(["a", "c"]) == {"a": {"b": [1, 2]}, "c": {1: 2}}
+    assert kv.get_many(["a", "nope"], missing_as_none=True)["nope"] is None
+    kv.delete_many(["a"])
+    assert list(kv.keys()) == ["c"]
+
+
+def test_compression(tmp_path):
+    "values are compressed in the database, transparently so for get, get_many, and iteration"
+    path = tmp_path / "compressed.db"
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, bytes, compression="zlib")
+    big = b"<?xml version='1.0'?><doc>" + b"<p>blah blah</p>" * 1000 + b"</doc>"
+    kv.put("big", big)
+    kv.put("small", b"x")
+    kv.put_many([("big2", big + b"2")])
+    assert kv.get("big") == big
+    assert kv.get("small") == b"x"
+    assert kv.get_many(["big2"]) == {"big2": big + b"2"}
+    assert dict(kv.items())["big"] == big
+    assert big in list(kv.itervalues())
+    stored = kv.conn.execute("SELECT value FROM kv WHERE key='big'").fetchone()[0]
+    assert len(stored) < len(big) / 10
+
+    with pytest.raises(TypeError, match=r".*are allowed*"):
+        kv.put("a", "str")
+    kv.close()
+
+    # recorded in the store, so later opens (e.g. read-only, as datasets does) decompress without being told
+    kv = wetsuite.helpers.localdata.LocalKV(path, None, None, read_only=True)
+    assert kv.compression == "zlib"
+    assert kv.get("big") == big
+    kv.close()
+
+    with pytest.raises(ValueError, match=r".*created with.*"):
+        wetsuite.helpers.localdata.LocalKV(path, str, bytes, compression="zstd")
+
+    # cannot enable on an existing uncompressed store
+    kv = wetsuite.helpers.localdata.LocalKV(tmp_path / "plain.db", str, bytes)
+    kv.put("a", b"b")
+    kv.close()
+    with pytest.raises(ValueError, match=r".*already has.*"):
+        wetsuite.helpers.localdata.LocalKV(tmp_path / "plain.db", str, bytes, compression="zlib")
+
+    with pytest.raises(TypeError, match=r".*only applies to bytes*"):
+        wetsuite.helpers.localdata.LocalKV(":memory:", str, str, compression="zlib")
+
+
+def test_compression_dictionary():
+    "training a dictionary, values from before it stay readable"
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:", compression="zlib")
+    for i in range(50):
+        kv.put("k%d" % i, {"title": "Regeling %d" % i, "text": "Artikel 1. Deze regeling wordt aangehaald als: %d" % i})
+    kv.train_compression_dictionary()
+    with pytest.raises(ValueError, match=r".*already has.*"):
+        kv.train_compression_dictionary()
+    kv.put("new", {"title": "Regeling new", "text": "Artikel 1. Deze regeling wordt aangehaald als: new"})
+    assert kv.get("k1")["title"] == "Regeling 1"
+    assert kv.get("new")["text"].endswith("new")
+    assert len(list(kv.iteritems())) == 51
+
+
+def test_compression_zstd():
+    "the zstd variant, if available"
+    pytest.importorskip("zstandard")
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, bytes, compression="zstd")
+    for i in range(200):
+        kv.put("k%d" % i, b"<regeling><artikel nr='%d'>Deze regeling wordt aangehaald als: %d</artikel></regeling>" % (i, i))
+    kv.train_compression_dictionary(dict_size=4096)
+    kv.put("new", b"<regeling><artikel nr='new'>Deze regeling wordt aangehaald als: new</artikel></regeling>")
+    assert kv.get("k5").startswith(b"<regeling><artikel nr='5'>")
+    assert kv.get("new").endswith(b"new</artikel></regeling>")
+
+
+def test_cache():
+    "the optional LRU cache in front of get() hits, evicts, and is invalidated by our own writes"
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str)
+    assert kv.cache_info() is None
+
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, str, cache_items=2)
+    kv.put_many([("a", "1"), ("b", "2"), ("c", "3")])
+    assert kv.get("a") == "1"
+    assert kv.get("a") == "1"
+    assert kv.cache_info()["hits"] == 1
+    assert kv.cache_info()["misses"] == 1
+    kv.get("b")
+    kv.get("c")  # evicts a
+    assert kv.cache_info()["items"] == 2
+    kv.get("a")
+    assert kv.cache_info()["misses"] == 4
+
+    kv.put("a", "new")
+    assert kv.get("a") == "new"
+    kv.put_many([("a", "newer")])
+    assert kv.get_many(["a", "b"]) == {"a": "newer", "b": "2"}
+    kv.delete("a")
+    assert kv.get("a", missing_as_none=True) is None
+    kv.get("b")
+    kv.delete_many(["b"])
+    assert kv.get("b", missing_as_none=True) is None
+
+    kv.put("d", "4", commit=False)
+    kv.get("d")
+    kv.rollback()
+    assert kv.get("d", missing_as_none=True) is None
+    kv.get("c")
+    kv.truncate()
+    assert kv.get("c", missing_as_none=True) is None
+    assert 0 < kv.cache_info()["hit_rate"] < 1
+
+    # byte budget
+    kv = wetsuite.helpers.localdata.LocalKV(":memory:", str, bytes, cache_bytes=100)
+    kv.put_many([("a", b"x" * 60), ("b", b"y" * 60), ("c", b"z" * 1000)])
+    kv.get("a")
+    kv.get("b")  # evicts a
+    kv.get("c")  # too large to cache at all
+    assert kv.cache_info()["items"] == 1
+    assert kv.cache_info()["bytes"] == 60
+
+
+def test_msgpack_cache():
+    "MsgpackKV caches the unpacked value"
+    kv = wetsuite.helpers.localdata.MsgpackKV(":memory:", cache_items=10, compression="zlib")
+    kv.put("a", {"b": [1, 2] * 100})
+    assert kv.get("a") == {"b": [1, 2] * 100}
+    assert kv.get("a") is kv.get("a")
+    assert kv.cache_info()["hits"] == 2
+    assert kv.random_sample(1)[0][1] is kv.get("a")
+
+
+def test_incremental_vacuum(tmp_path):
+    "incremental_vacuum gives back free pages, and the vacuum_every policy does so as we go"
+    kv = wetsuite.helpers.localdata.LocalKV(tmp_path / "iv.db", str, bytes)
+    kv.put_many(list(("k%d" % i, b"x" * 4000) for i in range(500)))
+    size_full = kv.bytesize()
+    kv.delete_many(list("k%d" % i for i in range(400)))
+    assert kv.bytesize() == size_full  # deleting doesn't shrink the file...
+    waste = kv.estimate_waste()
+    assert waste > 1000000
+    reclaimed = kv.incremental_vacuum(max_pages=10)  # ...this does, a bounded amount at a time
+    assert 0 < reclaimed < waste
+    assert kv.estimate_waste() == waste - reclaimed
+    kv.incremental_vacuum()
+    assert kv.estimate_waste() == 0
+    assert kv.bytesize() < size_full / 2
+    assert len(kv) == 100
+    kv.close()
+
+    kv = wetsuite.helpers.localdata.LocalKV(
+        tmp_path / "policy.db", str, bytes, vacuum_every=100, vacuum_pages=100000, vacuum_on_close=True
+    )
+    for rnd in range(5):  # a cache that keeps getting refreshed with different-sized values
+        kv.put_many(list(("k%d" % i, b"x" * (1000 + 3000 * (rnd % 2))) for i in range(300)))
+        kv.delete_many(list("k%d" % i for i in range(0, 300, 2)))
+        assert kv.estimate_waste() < 100000
+    kv.put("k1", b"y" * 100000, commit=False)
+    kv.delete("k1", commit=False)
+    kv.close()
+
+    kv = wetsuite.helpers.localdata.LocalKV(tmp_path / "policy.db", str, bytes, read_only=True)
+    assert kv.estimate_waste() == 0
+    kv.close()
+
+
+def test_incremental_vacuum_old_store(tmp_path):
+    "a store created without auto_vacuum gets it at the next vacuum()"
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE kv (key text unique NOT NULL, value text)")
+    conn.executemany("INSERT INTO kv VALUES (?, ?)", list(("k%d" % i, "x" * 4000) for i in range(200)))
+    conn.commit()
+    conn.close()
+
+    kv = wetsuite.helpers.localdata.LocalKV(path, str, str)
+    kv.delete_many(list("k%d" % i for i in range(100)))
+    assert kv.estimate_waste() > 0
+    assert kv.incremental_vacuum() == 0
+    kv.vacuum()
+    kv.delete_many(list("k%d" % i for i in range(100, 150)))
+    assert kv.incremental_vacuum() > 0
+    assert kv.estimate_waste() == 0
+
+
+def _parallel_map_func(key, value):
+    "(used by test_parallel_map, at module level so that it is picklable)"
+    if value["i"] % 10 == 0:
+        return None
+    return "%s:%d" % (key, value["i"] * 2)
+
+
+def test_parallel_map(tmp_path):
+    "parallel_map gives the same results as doing it in a loop, in order, and can write into a target store"
+    kv = wetsuite.helpers.localdata.MsgpackKV(tmp_path / "src.db")
+    kv.put_many(list(("k%04d" % i, {"i": i}) for i in range(500)))
+    kv.delete_many(list("k%04d" % i for i in range(100, 200)))  # a gap in rowids
+    expected = list((key, _parallel_map_func(key, value)) for key, value in kv.iteritems())
+
+    assert list(kv.parallel_map(_parallel_map_func, processes=3, chunk_size=64)) == expected
+    assert sorted(kv.parallel_map(_parallel_map_func, processes=3, chunk_size=64, ordered=False)) == sorted(expected)
+    assert list(kv.parallel_map(_parallel_map_func, processes=2, chunk_size=50, chunk_by_rowid=False)) == sorted(expected)
+
+    target = wetsuite.helpers.localdata.LocalKV(tmp_path / "target.db", str, str)
+    written = kv.parallel_map(_parallel_map_func, processes=2, target=target)
+    assert written == 360
+    assert target.get("k0001") == "k0001:2"
+    assert "k0010" not in target
+
+    with pytest.raises(ValueError, match=r".*memory.*"):
+        wetsuite.helpers.localdata.LocalKV(":memory:", str, str).parallel_map(_parallel_map_func)
+
+
+def test_sharded(tmp_path):
+    "ShardedLocalKV basics: same API, keys spread over shards, reopening"
+    path = tmp_path / "sharded"
+    with pytest.raises(ValueError, match=r".*num_shards.*"):
+        wetsuite.helpers.localdata.ShardedLocalKV(path, str, str)
+
+    kv = wetsuite.helpers.localdata.ShardedLocalKV(path, str, str, num_shards=4)
+    kv.put("a", "b")
+    kv.put_many(list(("k%d" % i, "v%d" % i) for i in range(100)))
+    assert kv.get("a") == "b"
+    assert "k5" in kv
+    assert len(kv) == 101
+    assert all(len(shard) > 0 for shard in kv.shards)
+    assert kv.get_many(["k1", "a"]) == {"k1": "v1", "a": "b"}
+    assert sorted(kv.keys()) == sorted(["a"] + list("k%d" % i for i in range(100)))
+    assert dict(kv.items())["k7"] == "v7"
+    assert len(kv.random_keys(10)) == 10
+    assert len(kv.random_sample(1000)) == 101
+    kv.random_choice()
+    kv.delete("a")
+    kv.delete_many(["k1", "k2"])
+    assert len(kv) == 98
+    kv.vacuum()
+    kv.vacuum(shard=1)
+    assert kv.summary(get_num_items=True)["num_items"] == 98
+    kv.close()
+
+    # reopen without saying how many shards
+    kv = wetsuite.helpers.localdata.ShardedLocalKV(path, str, str, read_only=True)
+    assert kv.num_shards == 4
+    assert kv.get("k3") == "v3"
+    kv.close()
+    with pytest.raises(ValueError, match=r".*has 4 shards.*"):
+        wetsuite.helpers.localdata.ShardedLocalKV(path, str, str, num_shards=5)
+
+    # each shard is a normal store
+    assert wetsuite.helpers.localdata.is_file_a_store(path) is True
+    assert wetsuite.helpers.localdata.is_file_a_store(kv.shards[0].path) is True
+    listed = wetsuite.helpers.localdata.list_stores(look_under=tmp_path, get_num_items=True)
+    assert len(listed) == 1
+    assert listed[0]["num_shards"] == 4
+    assert listed[0]["num_items"] == 98
+
+
+def test_sharded_parallel_put(tmp_path):
+    "put_many from multiple processes, with MsgpackKV shards"
+    kv = wetsuite.helpers.localdata.ShardedLocalKV(
+        tmp_path / "par", str, None, num_shards=3, store_class=wetsuite.helpers.localdata.MsgpackKV
+    )
+    kv.put_many(list(("k%d" % i, {"i": i}) for i in range(300)), processes=3)
+    assert len(kv) == 300
+    assert kv.get("k42") == {"i": 42}
+
+
 def test_resolve_path():
     "TODO: better tests"
     assert wetsuite.helpers.localdata.resolve_path(":memory:") == ":memory:"
@@ -1,9 +1,165 @@
 " test network-related code "
 import os
+import bz2
+import gzip
+import lzma
+import socket
+import hashlib
+import threading
+import http.server
+import time
+import functools
+import json
 import pytest
+import wetsuite.helpers.net
+import wetsuite.helpers.localdata
 from wetsuite.helpers.net import download
 
 
+@pytest.fixture
+def local_server(tmp_path):
+    "serves the files in a temporary directory over HTTP on localhost; gives (base_url, directory)"
+    serve_dir = tmp_path / "served"
+    serve_dir.mkdir()
+
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        "(without logging every request to stderr)"
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(serve_dir))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1], serve_dir
+    server.shutdown()
+    server.server_close()
+
+
+class _RangeServerState:
+    "what the range_server fixture serves, and what it saw"
+
+    def __init__(self):
+        self.files = {}  # path -> bytes
+        self.etags = {}  # path -> etag
+        self.drop_after = None  # if set, the next response is cut off after this many bytes
+        self.range_support = True
+        self.requests = []  # (path, range_header) per request
+        self.lock = threading.Lock()
+        self.connections = 0  # how many connections were made to it
+        self.delay = 0  # seconds to wait before each response
+        self.active = 0  # how many responses are underway now
+        self.max_active = 0  # the most that were underway at the same time
+        self.fail_with = []  # (status, retry_after_header) to answer the next requests with, before serving normally
+        self.user_agents = set()  # the User-Agent headers we were sent
+
+
+@pytest.fixture
+def range_server():
+    """serves byte contents on localhost, with support for Range requests (and If-Range),
+    and can drop a connection partway through a response; gives (base_url, _RangeServerState)"""
+    state = _RangeServerState()
+
+    class RangeHandler(http.server.BaseHTTPRequestHandler):
+        "serves state.files"
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # (otherwise, on a kept-alive connection, each response waits for a delayed ACK)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+        def setup(self):
+            "(counts connections)"
+            super().setup()
+            with state.lock:
+                state.connections += 1
+
+        def do_HEAD(self):  # pylint: disable=invalid-name
+            "headers only"
+            self.respond(head_only=True)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            "serve a file, or part of it"
+            self.respond()
+
+        def respond(self, head_only=False):
+            "serve a file, or part of it"
+            path = self.path.split("?")[0]
+            state.requests.append((path, self.headers.get("Range")))
+            state.user_agents.add(self.headers.get("User-Agent"))
+            if state.delay:
+                with state.lock:
+                    state.active += 1
+                    state.max_active = max(state.max_active, state.active)
+                time.sleep(state.delay)
+                with state.lock:
+                    state.active -= 1
+            with state.lock:  # (only GETs, so that it does not affect download()'s probing for range support)
+                fail_with = state.fail_with.pop(0) if len(state.fail_with) > 0 and not head_only else None
+            if fail_with is not None:
+                status, retry_after = fail_with
+                self.send_response(status)
+                if retry_after is not None:
+                    self.send_header("Retry-After", retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if path not in state.files:
+                self.send_error(404)
+                return
+            data = state.files[path]
+            etag = state.etags.get(path, '"v1"')
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            start, end, status = 0, len(data) - 1, 200
+            range_header = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if state.range_support and range_header is not None and (if_range is None or if_range == etag):
+                range_start, range_end = range_header.split("=")[1].split("-")
+                start = int(range_start)
+                if range_end != "":
+                    end = min(int(range_end), end)
+                if start >= len(data):
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % len(data))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+            body = data[start : end + 1]
+            self.send_response(status)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            if state.range_support:
+                self.send_header("Accept-Ranges", "bytes")
+            if status == 206:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+            self.end_headers()
+            if head_only:
+                return
+            with state.lock:
+                drop_after, state.drop_after = state.drop_after, None
+            if drop_after is not None:
+                self.wfile.write(body[:drop_after])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1], state
+    server.shutdown()
+    server.server_close()
+
+
 def test_download():
     "test basic network download"
     # checking that these don't raise any errors (not a great test if testing host has no internet access, though)
@@ -25,3 +181,438 @@ def test_download_to_file( tmp_path ):  # note: pytest fixture will create a tem
     with pytest.raises(ValueError, match=r".*(404|500).*"):
         download("https://www.example.com/noexist", tofile_path=tofile_path)
         assert not os.path.exists(tofile_path)
+
+
+def test_download_decompress(local_server, tmp_path):
+    "test decompressing while downloading, into memory and into a file"
+    base_url, serve_dir = local_server
+    data = b"".join(b"line %d of the test data\n" % i for i in range(100000))
+    (serve_dir / "data.xz").write_bytes(lzma.compress(data))
+    (serve_dir / "data.gz").write_bytes(gzip.compress(data))
+    (serve_dir / "data.bz2").write_bytes(bz2.compress(data[:1000]) + bz2.compress(data[1000:]))  # two streams
+    (serve_dir / "data.truncated.xz").write_bytes(lzma.compress(data)[:5000])
+
+    for kind in ("xz", "gz", "bz2"):
+        assert download(base_url + "/data." + kind, decompress=kind, chunk_size=10000) == data
+        tofile_path = tmp_path / ("data_" + kind)
+        download(base_url + "/data." + kind, tofile_path=tofile_path, decompress=kind, total_size=len(data), show_progress=True)
+        assert tofile_path.read_bytes() == data
+
+    tofile_path = tmp_path / "truncated"
+    with pytest.raises(ValueError, match=r".*ended.*"):
+        download(base_url + "/data.truncated.xz", tofile_path=tofile_path, decompress="xz")
+    assert not os.path.exists(tofile_path)
+    assert sorted(os.listdir(tmp_path)) == ["data_bz2", "data_gz", "data_xz", "served"]  # no temporary files left
+
+    with pytest.raises(ValueError):
+        download(base_url + "/data.xz", decompress="rar")
+
+
+def test_download_to_file_local(local_server, tmp_path):
+    "test that a download to file replaces the file only when complete, and not on errors"
+    base_url, serve_dir = local_server
+    (serve_dir / "file").write_bytes(b"new contents")
+    tofile_path = tmp_path / "existing"
+    tofile_path.write_bytes(b"old contents")
+    with pytest.raises(ValueError, match=r".*404.*"):
+        download(base_url + "/noexist", tofile_path=tofile_path)
+    assert tofile_path.read_bytes() == b"old contents"
+    download(base_url + "/file", tofile_path=tofile_path)
+    assert tofile_path.read_bytes() == b"new contents"
+
+
+def test_download_resume(range_server, tmp_path):
+    "an interrupted download with resume=True continues where it left off"
+    base_url, state = range_server
+    data = os.urandom(300000)
+    state.files["/file"] = data
+    tofile_path = tmp_path / "file"
+
+    state.drop_after = 250000
+    with pytest.raises(Exception):  # what requests raises for a broken connection
+        download(base_url + "/file", tofile_path=tofile_path, resume=True, attempts=1, chunk_size=65536)
+    assert not os.path.exists(tofile_path)
+    # (what we had of the chunk we were receiving when the connection broke is lost)
+    partial_size = os.path.getsize(str(tofile_path) + ".part")
+    assert 0 < partial_size <= 250000
+    assert os.path.exists(str(tofile_path) + ".part.json")
+
+    download(base_url + "/file", tofile_path=tofile_path, resume=True, checksum=hashlib.sha256(data).hexdigest())
+    assert state.requests[-1] == ("/file", "bytes=%d-" % partial_size)
+    assert tofile_path.read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+
+
+def test_download_resume_changed(range_server, tmp_path):
+    "if the file changed on the server in the meantime, we start over"
+    base_url, state = range_server
+    state.files["/file"] = b"a" * 100000
+    tofile_path = tmp_path / "file"
+    state.drop_after = 50000
+    with pytest.raises(Exception):
+        download(base_url + "/file", tofile_path=tofile_path, resume=True, attempts=1)
+
+    state.files["/file"] = b"b" * 80000
+    state.etags["/file"] = '"v2"'
+    download(base_url + "/file", tofile_path=tofile_path, resume=True)
+    assert tofile_path.read_bytes() == b"b" * 80000
+
+
+def test_download_resume_no_ranges(range_server, tmp_path):
+    "a server that ignores Range gets us the whole thing again"
+    base_url, state = range_server
+    state.files["/file"] = b"c" * 100000
+    state.range_support = False
+    tofile_path = tmp_path / "file"
+    state.drop_after = 50000
+    with pytest.raises(Exception):
+        download(base_url + "/file", tofile_path=tofile_path, resume=True, attempts=1)
+    download(base_url + "/file", tofile_path=tofile_path, resume=True)
+    assert tofile_path.read_bytes() == b"c" * 100000
+
+
+def test_download_resume_decompress(range_server, tmp_path):
+    "resuming while decompressing, and checking the checksum of the compressed data"
+    base_url, state = range_server
+    data = b"".join(b"line %d\n" % i for i in range(200000))
+    compressed = lzma.compress(data)
+    state.files["/file.xz"] = compressed
+    tofile_path = tmp_path / "file"
+    state.drop_after = len(compressed) // 2
+    with pytest.raises(Exception):
+        download(base_url + "/file.xz", tofile_path=tofile_path, resume=True, attempts=1, decompress="xz")
+    assert not os.path.exists(tofile_path)
+
+    with pytest.raises(ValueError, match=r".*checksum.*"):
+        download(base_url + "/file.xz", tofile_path=tofile_path, resume=True, decompress="xz", checksum="sha256:00")
+    assert sorted(os.listdir(tmp_path)) == []  # a bad checksum means we do not keep anything
+
+    state.drop_after = len(compressed) // 3
+    with pytest.raises(Exception):
+        download(base_url + "/file.xz", tofile_path=tofile_path, resume=True, attempts=1, decompress="xz")
+    download(
+        base_url + "/file.xz", tofile_path=tofile_path, resume=True, decompress="xz",
+        checksum="sha256:" + hashlib.sha256(compressed).hexdigest(),
+    )
+    assert tofile_path.read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+
+
+def test_download_resume_complete_part(range_server, tmp_path):
+    "if the .part is already complete (e.g. we were interrupted just before renaming), the server says 416 and we finish up"
+    base_url, state = range_server
+    state.files["/file"] = b"d" * 1000
+    tofile_path = tmp_path / "file"
+    (tmp_path / "file.part").write_bytes(b"d" * 1000)
+    (tmp_path / "file.part.json").write_text(
+        '{"url": "%s/file", "length": 1000, "etag": "\\"v1\\"", "last_modified": null}' % base_url
+    )
+    download(base_url + "/file", tofile_path=tofile_path, resume=True)
+    assert state.requests[-1] == ("/file", "bytes=1000-")
+    assert tofile_path.read_bytes() == b"d" * 1000
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+
+
+def test_download_segmented(range_server, tmp_path):
+    "download over a few connections at once, with one of them breaking, into a file"
+    base_url, state = range_server
+    data = os.urandom(5000000)
+    state.files["/file"] = data
+    tofile_path = tmp_path / "file"
+
+    state.drop_after = 100000  # (the first segment to start gets cut off, and should be retried)
+    download(base_url + "/file", tofile_path=tofile_path, segments=4, checksum=hashlib.sha256(data).hexdigest())
+    assert tofile_path.read_bytes() == data
+    ranges = list(range_header for _, range_header in state.requests if range_header is not None)
+    assert len(ranges) == 5
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+
+    with pytest.raises(ValueError):
+        download(base_url + "/file", segments=4)  # not to a file
+
+
+def test_download_segmented_retries(range_server, tmp_path):
+    "a temporary error on one of the connections is retried for just that segment, not the whole download"
+    base_url, state = range_server
+    data = os.urandom(5000000)
+    state.files["/file"] = data
+    tofile_path = tmp_path / "file"
+    wetsuite.helpers.net.retry_counts(reset=True)
+
+    state.fail_with = [(503, "0")]
+    download(base_url + "/file", tofile_path=tofile_path, segments=4, attempts=1)
+    assert tofile_path.read_bytes() == data
+    assert len(list(range_header for _, range_header in state.requests if range_header is not None)) == 5
+    assert wetsuite.helpers.net.retry_counts(reset=True) == {"retried": {"status 503": 1}, "gave_up": {}}
+
+    # ...but a segment that keeps failing fails the download
+    state.fail_with = [(503, "0")] * 20
+    with pytest.raises(wetsuite.helpers.net.HTTPStatusError):
+        download(base_url + "/file", tofile_path=tmp_path / "other", segments=4, attempts=1)
+    assert not (tmp_path / "other").exists()
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+    assert "status 503" in wetsuite.helpers.net.retry_counts(reset=True)["gave_up"]
+
+    # a 404 is not worth retrying
+    state.fail_with = [(404, None)]
+    with pytest.raises(wetsuite.helpers.net.HTTPStatusError):
+        download(base_url + "/file", tofile_path=tmp_path / "other", segments=4, attempts=1)
+    assert wetsuite.helpers.net.retry_counts(reset=True) == {"retried": {}, "gave_up": {}}
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX permissions")
+def test_download_permissions(range_server, tmp_path):
+    "downloaded files get the permissions the umask allows, not those of a private temporary file"
+    base_url, state = range_server
+    state.files["/file"] = os.urandom(5000000)
+    umask = os.umask(0o022)
+    try:
+        download(base_url + "/file", tofile_path=tmp_path / "plain")
+        download(base_url + "/file", tofile_path=tmp_path / "segmented", segments=4)
+        download(base_url + "/file", tofile_path=tmp_path / "checked", segments=4, checksum=hashlib.sha256(state.files["/file"]).hexdigest())
+    finally:
+        os.umask(umask)
+    for name in ("plain", "segmented", "checked"):
+        assert os.stat(tmp_path / name).st_mode & 0o777 == 0o644
+
+
+def test_download_segmented_decompress(range_server, tmp_path, monkeypatch):
+    "when decompressing, segments is ignored, so that we decompress while streaming, without a compressed copy on disk"
+    base_url, state = range_server
+    data = os.urandom(5000000)
+    compressed = lzma.compress(data, preset=0)
+    state.files["/file.xz"] = compressed
+    tofile_path = tmp_path / "file"
+
+    sizes_seen = []  # the sizes of the files next to the target, at the end of decompressing
+    original_decompress_chunks = wetsuite.helpers.net._decompress_chunks
+
+    def watching_decompress_chunks(chunks, kind):
+        yield from original_decompress_chunks(chunks, kind)
+        sizes_seen.extend(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
+
+    monkeypatch.setattr(wetsuite.helpers.net, "_decompress_chunks", watching_decompress_chunks)
+    download(base_url + "/file.xz", tofile_path=tofile_path, segments=4, decompress="xz")
+    assert tofile_path.read_bytes() == data
+    assert len(sizes_seen) > 0 and len(compressed) not in sizes_seen
+    assert all(range_header is None for _, range_header in state.requests)
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+
+
+def test_download_segmented_fallback(range_server, tmp_path):
+    "without range support (or for small files) a segmented download is just a download"
+    base_url, state = range_server
+    data = os.urandom(5000000)
+    state.files["/file"] = data
+    state.files["/small"] = data[:1000]
+    tofile_path = tmp_path / "file"
+
+    state.range_support = False
+    download(base_url + "/file", tofile_path=tofile_path, segments=4)
+    assert tofile_path.read_bytes() == data
+    assert all(range_header is None for _, range_header in state.requests)
+
+    state.range_support = True
+    state.requests.clear()
+    download(base_url + "/small", tofile_path=tofile_path, segments=4)
+    assert tofile_path.read_bytes() == data[:1000]
+    assert all(range_header is None for _, range_header in state.requests)
+
+
+def test_download_segmented_resume(range_server, tmp_path, monkeypatch):
+    "a segmented download that fails remembers where each segment got, and continues from there"
+    base_url, state = range_server
+    data = os.urandom(5000000)
+    state.files["/file"] = data
+    tofile_path = tmp_path / "file"
+
+    monkeypatch.setattr(wetsuite.helpers.net, "_SEGMENT_RETRIES", 0)
+    state.drop_after = 300000
+    with pytest.raises(Exception):  # what requests raises for a broken connection
+        download(base_url + "/file", tofile_path=tofile_path, segments=4, resume=True, attempts=1, chunk_size=65536)
+    assert not os.path.exists(tofile_path)
+    with open(str(tofile_path) + ".part.json", encoding="utf8") as f:
+        segments = json.load(f)["segments"]
+    assert any(start < position <= end for start, position, end in segments)  # the one that broke got partway
+
+    state.requests.clear()
+    download(base_url + "/file", tofile_path=tofile_path, segments=4, resume=True, checksum=hashlib.sha256(data).hexdigest())
+    assert tofile_path.read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+    requested = sorted(range_header for _, range_header in state.requests if range_header is not None)
+    assert requested == sorted("bytes=%d-%d" % (position, end) for _, position, end in segments if position <= end)
+
+
+def test_session_benchmark(range_server):
+    "many small fetches over the shared session reuse one connection, where plain requests.get() makes a new connection per fetch"
+    import requests
+
+    base_url, state = range_server
+    state.files["/small"] = b"x" * 1000
+    fetch_count = 300
+
+    for _ in range(fetch_count):
+        assert requests.get(base_url + "/small", timeout=10).content == state.files["/small"]
+    assert state.connections == fetch_count
+
+    state.connections = 0
+    for _ in range(fetch_count):
+        assert download(base_url + "/small") == state.files["/small"]
+    assert state.connections == 1
+
+
+def test_configure_session(range_server):
+    "configure_session() replaces the shared session"
+    base_url, state = range_server
+    state.files["/small"] = b"x" * 1000
+    before = wetsuite.helpers.net.session()
+    try:
+        wetsuite.helpers.net.configure_session(keep_alive=False, headers={"User-Agent": "wetsuite-test"})
+        assert wetsuite.helpers.net.session() is not before
+        assert wetsuite.helpers.net.session().headers["User-Agent"] == "wetsuite-test"
+        for _ in range(3):
+            download(base_url + "/small")
+        assert state.connections == 3
+    finally:
+        wetsuite.helpers.net.configure_session()
+
+
+def test_token_bucket():
+    "bursts up to burst, then paces at rate"
+    bucket = wetsuite.helpers.net.TokenBucket(rate=100, burst=5)
+    assert list(bucket.reserve() for _ in range(5)) == [0.0] * 5
+    delays = list(bucket.reserve() for _ in range(3))
+    assert 0 < delays[0] <= 0.011
+    assert delays[0] < delays[1] < delays[2]  # (reserving ahead)
+
+    with pytest.raises(ValueError):
+        wetsuite.helpers.net.TokenBucket(rate=0)
+
+
+def test_fetch_engine(range_server):
+    "fetches concurrently, but no more at once per host than asked, and no faster than asked"
+    base_url, state = range_server
+    for i in range(30):
+        state.files["/%d" % i] = b"data %d" % i
+    state.delay = 0.05
+
+    with wetsuite.helpers.net.FetchEngine(per_host=3, concurrency=8) as engine:
+        results = list(engine.map(base_url + "/%d" % i for i in range(30)))
+        assert sorted(url for url, _, _ in results) == sorted(base_url + "/%d" % i for i in range(30))
+        assert all(data == state.files[url[len(base_url):]] for url, data, _ in results)
+        assert state.max_active == 3
+
+        _, data, exception = next(engine.map([base_url + "/noexist"]))
+        assert data is None and isinstance(exception, ValueError)
+
+        assert engine.submit(base_url + "/1").result() == b"data 1"
+
+    state.delay = 0
+    with wetsuite.helpers.net.FetchEngine(per_host=3, rate=20) as engine:
+        start = time.time()
+        assert len(list(engine.map(base_url + "/%d" % i for i in range(11)))) == 11
+        assert time.time() - start >= 0.45  # (the first goes right away, the next ten at 20 per second)
+
+
+def test_cached_fetch_many_http(range_server, tmp_path):
+    "cached_fetch_many over HTTP: fetches what the store does not have yet, and revalidates what went stale"
+    base_url, state = range_server
+    for i in range(20):
+        state.files["/%d" % i] = b"data %d" % i
+    urls = list(base_url + "/%d" % i for i in range(20))
+    store = wetsuite.helpers.localdata.ExpiringLocalKV(tmp_path / "fetched.db", str, bytes)
+    store.put(urls[0], b"cached")
+    store.put(urls[1], b"cached")
+
+    results = list(wetsuite.helpers.localdata.cached_fetch_many(
+        store, urls + [base_url + "/noexist"], batch_size=7, errors="skip", per_host=4
+    ))
+    assert sum(1 for _, _, from_cache in results if from_cache) == 2
+    assert sum(1 for _, _, from_cache in results if not from_cache) == 18
+    assert store.get(urls[0]) == b"cached"
+    assert store.get(urls[5]) == b"data 5"
+    assert store.get_info(urls[5])["etag"] == '"v1"'
+    assert len(store) == 20
+    assert len(list(request for request in state.requests if request[0] != "/noexist")) == 18
+
+    # refreshing: all of them are conditional requests, and the 18 with an ETag are not sent again
+    wetsuite.helpers.localdata.revalidation_counts(reset=True)
+    results = list(wetsuite.helpers.localdata.cached_fetch_many(store, urls, force_refetch=True))
+    assert sum(1 for _, _, from_cache in results if from_cache) == 18
+    assert store.get(urls[0]) == b"data 0"
+    assert wetsuite.helpers.localdata.revalidation_counts()["not_modified"] == 18
+
+    with pytest.raises(ValueError):
+        list(wetsuite.helpers.localdata.cached_fetch_many(store, [base_url + "/noexist"]))
+
+
+def test_download_retries(range_server, tmp_path):
+    "temporary failures are retried (honouring Retry-After), permanent ones are not, and all of it is counted"
+    base_url, state = range_server
+    data = os.urandom(300000)
+    state.files["/file"] = data
+    wetsuite.helpers.net.retry_counts(reset=True)
+
+    state.fail_with = [(503, "0"), (429, "0"), (502, None)]
+    start = time.time()
+    assert download(base_url + "/file", attempts=4, backoff=0.01) == data
+    assert time.time() - start < 1
+    assert wetsuite.helpers.net.retry_counts() == {
+        "retried": {"status 503": 1, "status 429": 1, "status 502": 1},
+        "gave_up": {},
+    }
+
+    state.fail_with = [(503, "0"), (503, "0")]
+    with pytest.raises(wetsuite.helpers.net.HTTPStatusError) as excinfo:
+        download(base_url + "/file", attempts=2, backoff=0.01)
+    assert excinfo.value.status_code == 503
+    assert wetsuite.helpers.net.retry_counts(reset=True)["gave_up"] == {"status 503": 1}
+
+    state.fail_with = [(503, "3600")]  # asks us to wait longer than we want to
+    with pytest.raises(ValueError, match=r".*503.*"):
+        download(base_url + "/file", attempts=5, backoff=0.01)
+    state.requests.clear()
+    with pytest.raises(ValueError, match=r".*404.*"):
+        download(base_url + "/noexist", attempts=5, backoff=0.01)
+    assert len(state.requests) == 1
+    wetsuite.helpers.net.retry_counts(reset=True)
+
+    # a connection that breaks partway: starts over without resume, continues with it
+    state.drop_after = 100000
+    tofile_path = tmp_path / "file"
+    download(base_url + "/file", tofile_path=tofile_path, attempts=2, backoff=0.01)
+    assert tofile_path.read_bytes() == data
+    state.drop_after = 100000
+    state.requests.clear()
+    download(base_url + "/file", tofile_path=tofile_path, resume=True, attempts=2, backoff=0.01, chunk_size=16384)
+    assert tofile_path.read_bytes() == data
+    assert state.requests[-1][1] is not None and state.requests[-1][1] != "bytes=0-"
+    assert sum(wetsuite.helpers.net.retry_counts()["retried"].values()) == 2
+    assert sorted(os.listdir(tmp_path)) == ["file"]
+
+
+def test_parse_retry_after():
+    "Retry-After can be seconds or a date"
+    import email.utils
+
+    assert wetsuite.helpers.net._parse_retry_after("120") == 120.0
+    assert wetsuite.helpers.net._parse_retry_after(None) is None
+    assert wetsuite.helpers.net._parse_retry_after("soon") is None
+    in_a_minute = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < wetsuite.helpers.net._parse_retry_after(in_a_minute) <= 60
+    assert wetsuite.helpers.net._parse_retry_after("Thu, 01 Jan 1970 00:00:00 GMT") == 0.0
+
+
+def test_conditional_download(range_server):
+    "a conditional request gets the data only when it changed"
+    base_url, state = range_server
+    state.files["/doc"] = b"contents"
+    assert wetsuite.helpers.net.conditional_download(base_url + "/doc") == (b"contents", '"v1"', None)
+    assert wetsuite.helpers.net.conditional_download(base_url + "/doc", etag='"v1"') == (None, '"v1"', None)
+    state.files["/doc"] = b"new contents"
+    state.etags["/doc"] = '"v2"'
+    assert wetsuite.helpers.net.conditional_download(base_url + "/doc", etag='"v1"') == (b"new contents", '"v2"', None)
+    with pytest.raises(wetsuite.helpers.net.HTTPStatusError):
+        wetsuite.helpers.net.conditional_download(base_url + "/noexist")
+    download(base_url + "/doc")
+    assert len(state.user_agents) == 1  # revalidations identify themselves the same way as other fetches
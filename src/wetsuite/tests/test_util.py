@@ -2,6 +2,7 @@
 
 import os
 import re
+import hashlib
 
 import pytest
 
@@ -47,6 +48,15 @@ def test_hash_hex():
         wetsuite.helpers.util.hash_hex(re.compile("foo"))
 
 
+def test_hash_file(tmp_path):
+    "test hashing a file in chunks"
+    data = os.urandom(100000)
+    path = tmp_path / 'file'
+    path.write_bytes(data)
+    assert wetsuite.helpers.util.hash_file(path) == hashlib.sha256(data).hexdigest()
+    assert wetsuite.helpers.util.hash_file(path, 'blake2b', chunk_size=1000) == hashlib.blake2b(data).hexdigest()
+
+
 def test_hash_color():
     "test that 'give consistent (CSS) color for a string' functions at all"
     wetsuite.helpers.util.hash_color("foo")